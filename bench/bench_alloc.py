@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the per-request overhead of BaseApplication.dispatch() for a
+trivial endpoint, as the number of application resources grows. Run
+with::
+
+  PYTHONPATH=. python bench/bench_alloc.py
+
+Besides the dispatch time, the objects dispatch has allocated and
+still holds by the time the endpoint runs are counted, with the
+garbage collector disabled. "objs" is how many of those the collector
+tracks (dicts, lists, frames and so on), and "obj size" their total
+sys.getsizeof(). This shows how much is being copied around per
+request, independent of the endpoint. Objects dispatch allocates and
+frees before the endpoint runs aren't counted.
+"""
+
+import gc
+import sys
+import time
+
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request, Response
+
+from clastic import Application
+
+RESOURCE_COUNTS = (0, 10, 100, 1000)
+ITERATIONS = 20000
+RESPONSE = Response('ok')
+
+_before_ids = None
+_new_objects = []
+
+
+def endpoint(item_id):
+    if _before_ids is not None:
+        _new_objects.extend([obj for obj in gc.get_objects()
+                             if id(obj) not in _before_ids])
+    return RESPONSE
+
+
+def make_app(resource_count):
+    resources = dict([('res_%s' % i, i) for i in range(resource_count)])
+    routes = [('/items/<item_id:int>', endpoint)]
+    return Application(routes, resources=resources)
+
+
+def time_dispatch(app, request, iterations=ITERATIONS):
+    dispatch = app.dispatch
+    start = time.time()
+    for _ in xrange(iterations):
+        dispatch(request)
+    return (time.time() - start) / iterations
+
+
+def count_allocs(app, request):
+    "Returns the count and total size of the objects dispatch holds."
+    global _before_ids
+    app.dispatch(request)  # warm up any caches first
+    gc.disable()
+    try:
+        _before_ids = set([id(obj) for obj in gc.get_objects()])
+        app.dispatch(request)
+        new_objects = [obj for obj in _new_objects
+                       if obj is not _new_objects and obj is not _before_ids]
+        return (len(new_objects),
+                sum([sys.getsizeof(obj) for obj in new_objects]))
+    finally:
+        _before_ids = None
+        del _new_objects[:]
+        gc.enable()
+
+
+def main():
+    request = Request(EnvironBuilder(path='/items/42').get_environ())
+    print '%10s %12s %6s %10s' % ('resources', 'dispatch', 'objs',
+                                  'obj size')
+    for resource_count in RESOURCE_COUNTS:
+        app = make_app(resource_count)
+        obj_count, obj_size = count_allocs(app, request)
+        print '%10s %10.1fus %6s %9sB' % (resource_count,
+                                          time_dispatch(app, request) * 1e6,
+                                          obj_count, obj_size)
+
+
+if __name__ == '__main__':
+    main()
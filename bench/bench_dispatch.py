@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Measures BaseApplication.dispatch() as the route table grows, with
+and without the route trie. Run with::
+
+  PYTHONPATH=. python bench/bench_dispatch.py
+
+Each application has N routes shaped like
+``/section<i>/items/<item_id:int>``. The "hit" request targets the
+last route, the worst case for a linear scan. The "miss" request
+matches nothing.
+"""
+
+import time
+
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request, Response
+
+from clastic import Application
+
+ROUTE_COUNTS = (10, 100, 1000, 10000)
+ITERATIONS = 2000
+
+
+def endpoint(item_id):
+    return Response('item %s' % item_id)
+
+
+def make_app(route_count, use_trie):
+    routes = [('/section%s/items/<item_id:int>' % i, endpoint)
+              for i in range(route_count)]
+    return Application(routes, use_trie=use_trie)
+
+
+def make_request(path):
+    return Request(EnvironBuilder(path=path).get_environ())
+
+
+def time_dispatch(app, path, iterations=ITERATIONS):
+    request = make_request(path)
+    dispatch = app.dispatch
+    start = time.time()
+    for _ in xrange(iterations):
+        dispatch(request)
+    return (time.time() - start) / iterations
+
+
+def main():
+    print '%8s %12s %12s %12s %12s' % ('routes', 'linear hit', 'trie hit',
+                                       'linear miss', 'trie miss')
+    for route_count in ROUTE_COUNTS:
+        linear_app = make_app(route_count, use_trie=False)
+        trie_app = make_app(route_count, use_trie=True)
+        hit_path = '/section%s/items/42' % (route_count - 1)
+        miss_path = '/nowhere/items/42'
+        # fewer iterations for slow linear scans on big tables
+        iters = max(50, ITERATIONS * 10 / route_count)
+        results = [time_dispatch(linear_app, hit_path, iters),
+                   time_dispatch(trie_app, hit_path),
+                   time_dispatch(linear_app, miss_path, iters),
+                   time_dispatch(trie_app, miss_path)]
+        print '%8s %10.1fus %10.1fus %10.1fus %10.1fus' % (
+            (route_count,) + tuple([r * 1e6 for r in results]))
+
+
+if __name__ == '__main__':
+    main()
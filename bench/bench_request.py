@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Compares werkzeug's full Request with clastic's LightRequest, as an
+application's ``request_type``. Run with::
+
+  PYTHONPATH=. python bench/bench_request.py
+
+"construct" times creating the request and reading the path and
+method, which is all dispatch needs. "wsgi call" times a full WSGI
+call of a small application, with an endpoint that reads one query
+argument.
+"""
+
+import time
+
+from werkzeug.test import EnvironBuilder
+from werkzeug.wrappers import Request, Response
+
+from clastic import Application
+from clastic.request import LightRequest
+
+ITERATIONS = 50000
+RESPONSE = Response('{}', mimetype='application/json')
+
+
+def endpoint(request, item_id):
+    request.args.get('fields')
+    return RESPONSE
+
+
+def start_response(status, headers, exc_info=None):
+    return lambda data: None
+
+
+def time_calls(func, iterations=ITERATIONS):
+    start = time.time()
+    for _ in xrange(iterations):
+        func()
+    return (time.time() - start) / iterations
+
+
+def main():
+    environ = EnvironBuilder(path='/items/42',
+                             query_string='fields=name').get_environ()
+    print '%14s %12s %12s' % ('request_type', 'construct', 'wsgi call')
+    for request_type in (Request, LightRequest):
+        def construct():
+            request = request_type(dict(environ))
+            return request.path, request.method
+
+        class BenchApplication(Application):
+            pass
+        BenchApplication.request_type = request_type
+        app = BenchApplication([('/items/<item_id:int>', endpoint)])
+
+        def call():
+            return app(dict(environ), start_response)
+        results = [time_calls(construct), time_calls(call)]
+        print '%14s %10.2fus %10.2fus' % ((request_type.__name__,) +
+                                          tuple([r * 1e6 for r in results]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Measures how long it takes to build an application with many routes.
+Run with::
+
+  PYTHONPATH=. python bench/bench_startup.py
+
+"add" registers routes one at a time with Application.add(), the way
+Cline's route decorators do. "bulk" passes them all to the
+constructor, which uses add_routes(), so that routes of the same
+shape (here, all of them) share one compiled chain. "bulk lazy" adds
+``lazy_chains=True``, so no middleware chain is compiled until its
+route executes.
+"""
+
+import time
+
+from werkzeug.wrappers import Response
+
+from clastic import Application, Middleware
+
+ROUTE_COUNTS = (100, 1000, 5000)
+
+
+class PassMiddleware(Middleware):
+    def request(self, next, request):
+        return next()
+
+
+class ProvideMiddleware(Middleware):
+    provides = ('user',)
+
+    def request(self, next, request):
+        return next(user=None)
+
+
+MIDDLEWARES = [PassMiddleware(), ProvideMiddleware()]
+
+
+def endpoint(user, item_id):
+    return Response('item %s' % item_id)
+
+
+def make_routes(route_count):
+    return [('/section%s/items/<item_id:int>' % i, endpoint)
+            for i in range(route_count)]
+
+
+def build_incremental(routes):
+    app = Application(middlewares=MIDDLEWARES)
+    for route in routes:
+        app.add(route)
+    return app
+
+
+def build_bulk(routes):
+    return Application(routes, middlewares=MIDDLEWARES)
+
+
+def build_lazy(routes):
+    return Application(routes, middlewares=MIDDLEWARES, lazy_chains=True)
+
+
+def time_build(build, routes):
+    start = time.time()
+    build(routes)
+    return time.time() - start
+
+
+def main():
+    print '%8s %12s %12s %12s' % ('routes', 'add', 'bulk', 'bulk lazy')
+    for route_count in ROUTE_COUNTS:
+        routes = make_routes(route_count)
+        results = [time_build(build, routes) for build in
+                   (build_incremental, build_bulk, build_lazy)]
+        print '%8s %11.3fs %11.3fs %11.3fs' % ((route_count,) +
+                                               tuple(results))
+
+
+if __name__ == '__main__':
+    main()
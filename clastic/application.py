@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 from collections import Sequence
 from argparse import ArgumentParser
 
@@ -9,14 +10,18 @@ from werkzeug.wrappers import (Request,
                                Response,
                                BaseResponse)
 from .server import run_simple
+from .trie import RouteTrie
 from .route import (Route,
                     BaseRoute,
                     NullRoute,
                     S_STRICT,
+                    S_REWRITE,
                     S_REDIRECT,
+                    HTTP_METHODS,
                     RESERVED_ARGS,
                     normalize_path,
                     check_render_error)
+from .utils import LRU
 from .tbutils import ExceptionInfo
 from .middleware import check_middlewares
 from .errors import (NotFound,
@@ -30,7 +35,7 @@ _meta_exc_msg = ('as of Clastic 0.4, MetaApplication is now an Application'
 
 def cast_to_route_factory(in_arg):
     from meta import MetaApplication
-    if isinstance(in_arg, BaseRoute):
+    if isinstance(in_arg, (BaseRoute, SubApplication)):
         return in_arg
     elif isinstance(in_arg, Sequence):
         try:
@@ -59,6 +64,11 @@ class BaseApplication(object):
                  render_factory=None, render_error=None, **kwargs):
         self.debug = kwargs.pop('debug', None)
         self.slash_mode = kwargs.pop('slash_mode', S_REDIRECT)
+        self.use_trie = kwargs.pop('use_trie', False)
+        self.flat_chains = kwargs.pop('flat_chains', False)
+        self.lazy_chains = kwargs.pop('lazy_chains', False)
+        self.instrument_chains = kwargs.pop('instrument_chains', False)
+        dispatch_cache_size = kwargs.pop('dispatch_cache_size', None)
         if kwargs:
             raise TypeError('unexpected keyword args: %r' % kwargs.keys())
         self.resources = dict(resources or {})
@@ -78,28 +88,138 @@ class BaseApplication(object):
         self.render_error = render_error or default_render_error
         check_render_error(self.render_error, self.resources)
 
+        self._dispatch_cache = None
+        self._chain_cache = None  # only set while adding routes
+        if dispatch_cache_size:
+            self._dispatch_cache = LRU(dispatch_cache_size)
+
         routes = routes or []
         self.routes = []
+        self._build_route_tables()
         self._null_route = NullRoute()
         self._null_route.bind(self)
-        for entry in routes:
-            self.add(entry)
+        self.add_routes(routes)
 
     def iter_routes(self):
         for rt in self.routes:
             yield rt
 
     def add(self, entry, index=None, rebind_render=True, inherit_slashes=True):
-        if index is None:
-            index = len(self.routes)
-        rf = cast_to_route_factory(entry)
-        rebind_render = getattr(rf, 'rebind_render', rebind_render)
-        kwargs = {'rebind_render': rebind_render,
-                  'inherit_slashes': inherit_slashes}
-        for route in rf.iter_routes():
-            route.bind(self, **kwargs)
-            self.routes.insert(index, route)
-            index += 1
+        self.add_routes([entry], index=index, rebind_render=rebind_render,
+                        inherit_slashes=inherit_slashes)
+
+    def add_routes(self, entries, index=None, rebind_render=True,
+                   inherit_slashes=True):
+        """
+        Adds several route entries at once, in order, at *index*
+        (defaulting to the end). Every route is bound, and so checked,
+        before any is added, so if one fails the application's routes
+        are unchanged. The route tables are updated once for the whole
+        batch, and routes in it with the same middlewares, endpoint,
+        render function and arguments share one compiled chain.
+        """
+        new_routes = []
+        own_chain_cache = self._chain_cache is None
+        if own_chain_cache:
+            self._chain_cache = {}
+        try:
+            for entry in entries:
+                rf = cast_to_route_factory(entry)
+                kwargs = {'rebind_render': getattr(rf, 'rebind_render',
+                                                   rebind_render),
+                          'inherit_slashes': inherit_slashes}
+                for route in rf.iter_routes():
+                    route.bind(self, **kwargs)
+                    new_routes.append(route)
+        finally:
+            if own_chain_cache:
+                self._chain_cache = None
+        if index is None or index == len(self.routes):
+            self.routes.extend(new_routes)
+            for route in new_routes:
+                self._index_route(route)
+        else:
+            self.routes[index:index] = new_routes
+            self._build_route_tables()
+        if self._dispatch_cache is not None:
+            self._dispatch_cache.clear()
+
+    def _build_route_tables(self):
+        """
+        Routes are partitioned by HTTP method, so that dispatch only
+        considers routes which accept the request's method. Each method
+        also gets a table of the routes which don't accept it, used to
+        find allowed methods for 405s. Methods outside HTTP_METHODS are
+        looked up under None.
+        """
+        table_type = RouteTrie if self.use_trie else _RouteList
+        self._method_tables = {}
+        self._method_misses = {}
+        for method in list(HTTP_METHODS) + [None]:
+            self._method_tables[method] = table_type()
+            self._method_misses[method] = table_type()
+        for route in self.routes:
+            self._index_route(route)
+
+    def _index_route(self, route):
+        methods = route.methods
+        for method, table in self._method_tables.items():
+            if not methods or method in methods:
+                table.append(route)
+            else:
+                self._method_misses[method].append(route)
+
+    def _get_candidate_routes(self, url_path, method):
+        table = self._method_tables.get(method)
+        if table is None:
+            table = self._method_tables[None]
+        return table.get_candidates(url_path)
+
+    def _get_allowed_methods(self, url_path, method):
+        misses = self._method_misses.get(method)
+        if misses is None:
+            misses = self._method_misses[None]
+        ret = set()
+        for route in misses.get_candidates(url_path):
+            if route.match_path(url_path) is not None:
+                ret.update(route.methods)
+        return ret
+
+    def _iter_matches(self, url_path, method, dispatch_state):
+        """
+        Yields (route, path_params) for each route matching the path
+        and method, in order, ending with the NullRoute. With the
+        dispatch cache enabled, the first match for a given path and
+        method is remembered, so repeat requests skip straight to it.
+        """
+        cache, start = self._dispatch_cache, 0
+        if cache is not None:
+            cached = cache.get((url_path, method))
+            if cached is not None:
+                index, route, path_params = cached
+                yield route, _thaw_path_params(path_params)
+                start = index + 1
+        routes = self._get_candidate_routes(url_path, method)
+        for index in xrange(start, len(routes)):
+            route = routes[index]
+            path_params = route.match_path(url_path)
+            if path_params is None:
+                continue
+            if cache is not None and not start:
+                cache[(url_path, method)] = (index, route,
+                                             _freeze_path_params(path_params))
+                start = -1  # only the first match gets cached
+            yield route, path_params
+
+        allowed = self._get_allowed_methods(url_path, method)
+        dispatch_state.update_methods(allowed)
+        null_route = self._null_route
+        yield null_route, null_route.match_path(url_path)
+
+    def get_dispatch_cache_stats(self):
+        if self._dispatch_cache is None:
+            return None
+        return self._dispatch_cache.get_stats()
 
     def __call__(self, environ, start_response):
         request = self.request_type(environ)
@@ -107,23 +227,16 @@ class BaseApplication(object):
         return response(environ, start_response)
 
     def dispatch(self, request):
+        # nothing is copied per candidate route; the injectables are
+        # only built once a route has matched, by dispatch_execute()
         ret = None
         url_path, method = request.path, request.method
+        resources = self.resources
         dispatch_state = DispatchState()
-        base_params = dict(self.resources,
-                           request=request,
-                           _dispatch_state=dispatch_state)
 
-        for route in self.routes + [self._null_route]:
-            path_params = route.match_path(url_path)
-            if path_params is None:
-                continue
+        matches = self._iter_matches(url_path, method, dispatch_state)
+        for route, path_params in matches:
             request.path_params = path_params
-            params = dict(base_params, **path_params)
-            method_allowed = route.match_method(method)
-            if not method_allowed:
-                dispatch_state.update_methods(route.methods)
-                continue
             if route.is_branch:
                 norm_path = normalize_path(url_path, route.is_branch)
                 if norm_path != url_path:
@@ -135,7 +248,8 @@ class BaseApplication(object):
                         dispatch_state.add_exception(nf_exc)
                         continue
             try:
-                ret = route.execute(**params)
+                ret = route.dispatch_execute(request, dispatch_state,
+                                             path_params, resources)
                 if not isinstance(ret, BaseResponse):
                     msg = 'expected Response, received %r' % type(ret)
                     raise TypeError(msg)
@@ -158,7 +272,11 @@ class BaseApplication(object):
                 dispatch_state.add_exception(ret)
 
         if isinstance(ret, HTTPException):
-            error_params = dict(params, _error=ret)
+            error_params = dict(resources,
+                                request=request,
+                                _dispatch_state=dispatch_state)
+            error_params.update(path_params)
+            error_params['_error'] = ret
             try:
                 ret = ret.source_route.render_error(**error_params)
             except:
@@ -166,7 +284,27 @@ class BaseApplication(object):
         return ret
 
 
+class _RouteList(list):
+    "A plain route table, with the same interface as RouteTrie."
+    def get_candidates(self, path):
+        return self
+
+
+def _freeze_path_params(path_params):
+    # multi-segment values are lists, which endpoints are free to
+    # mutate, so the cache keeps tuples and hands out fresh lists
+    return dict([(k, tuple(v) if isinstance(v, list) else v)
+                 for k, v in path_params.items()])
+
+
+def _thaw_path_params(path_params):
+    return dict([(k, list(v) if isinstance(v, tuple) else v)
+                 for k, v in path_params.items()])
+
+
 class DispatchState(object):
+    __slots__ = ('exceptions', 'allowed_methods')
+
     def __init__(self):
         self.exceptions = []
         self.allowed_methods = set()
@@ -184,13 +322,29 @@ class DispatchState(object):
 
 
 class SubApplication(object):
-    def __init__(self, prefix, app, rebind_render=False, inherit_slashes=True):
+    """
+    Mounts *app* under *prefix*. By default, each of the app's routes is
+    copied, prefixed and rebound to the parent application. With
+    *delegate* set, the parent instead gets a single MountRoute, which
+    hands matching requests off to the app's own dispatch(), with the
+    app's own middlewares, resources and render settings. The parent's
+    middlewares still run first, around the hand-off.
+    """
+    def __init__(self, prefix, app, rebind_render=False, inherit_slashes=True,
+                 delegate=False):
         self.prefix = prefix.rstrip('/')
         self.app = app
         self.rebind_render = rebind_render
         self.inherit_slashes = inherit_slashes
+        self.delegate = delegate
 
     def iter_routes(self):
+        if self.delegate:
+            yld = MountRoute(self.prefix, self.app)
+            if self.inherit_slashes:
+                yld.slash_mode = self.app.slash_mode
+            yield yld
+            return
         # TODO: if `self.app` is `application` don't re-embed?
         for routes in self.app.iter_routes():
             for rt in routes.iter_routes():
@@ -204,6 +358,80 @@ class SubApplication(object):
                 yield yld
 
 
+_MOUNT_SUFFIX = '/<_mount_path*>'
+
+
+class MountRoute(Route):
+    """
+    Matches any path under its prefix and dispatches it to another
+    application, with the prefix moved from PATH_INFO to SCRIPT_NAME,
+    the same as any other WSGI mount. The mounted application owns the
+    whole prefix, so its 404s are final.
+
+    The hand-off is the route's endpoint, so like any other route, the
+    application it's bound to runs its middlewares (auth, stats,
+    caching and so on) around it, before the mounted application runs
+    its own. As with regex routes, runs of slashes in the path are
+    treated as one, unless the route's slash mode is strict.
+    """
+    def __init__(self, prefix, app, **kwargs):
+        kwargs.setdefault('slash_mode', S_REWRITE)
+        self.app = app
+        pattern = prefix.rstrip('/') + _MOUNT_SUFFIX
+        super(MountRoute, self).__init__(pattern, self._delegate, **kwargs)
+
+    @property
+    def prefix(self):
+        # derived, so that re-prefixing by a SubApplication carries over
+        return self.pattern[:-len(_MOUNT_SUFFIX)]
+
+    def _compile(self):
+        super(MountRoute, self)._compile()
+        sep = '/' if self.slash_mode == S_STRICT else '/+'
+        segments = [re.escape(s) for s in self.prefix.split('/') if s]
+        self._prefix_regex = re.compile(
+            '^%s(?=/|$)' % ''.join([sep + s for s in segments]), re.U)
+
+    def match_path(self, path):
+        if self._prefix_regex.match(path) is None:
+            return None
+        return {}
+
+    def _delegate(self, request):
+        path = request.path
+        prefix_len = self._prefix_regex.match(path).end()
+        if prefix_len == len(path) and self.slash_mode == S_REDIRECT:
+            return redirect(request.url_root.rstrip('/') + self.prefix + '/')
+        environ = dict(request.environ)
+        # the path's prefix may have had extra slashes, so it's cut at
+        # the same place in the encoded PATH_INFO as in the decoded path
+        enc_prefix_len = len(path[:prefix_len].encode(request.charset))
+        path_info = '/' + environ.get('PATH_INFO', '').lstrip('/')
+        environ['PATH_INFO'] = path_info[enc_prefix_len:]
+        script_name = environ.get('SCRIPT_NAME', '').rstrip('/')
+        environ['SCRIPT_NAME'] = script_name + \
+            self.prefix.encode(request.charset)
+        app = self.app
+        return app.dispatch(app.request_type(environ))
+
+    def bind(self, app, **kwargs):
+        # the mounted application keeps its own slash handling
+        kwargs['inherit_slashes'] = False
+        return super(MountRoute, self).bind(app, **kwargs)
+
+    def empty(self):
+        ret = type(self)(self.prefix, self.app, slash_mode=self.slash_mode)
+        ret.pattern = self.pattern
+        ret._middlewares = list(self._middlewares)
+        ret._resources = dict(self._resources)
+        ret._bound_apps = list(self._bound_apps)
+        return ret
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return '<%s prefix=%r app=%r>' % (cn, self.prefix, self.app)
+
+
 class Application(BaseApplication):
     def serve(self,
               address='0.0.0.0',
@@ -275,7 +503,6 @@ def create_dev_server_parser():
 Notes
 =====
 
-TODO: divide up paths by HTTP method (minor optimization for match speed)
 TODO: special handling for HTTPExceptions objects raised in debug mode
 TODO: should TracebackInfo optionally know about exc_type and exc_msg?
 
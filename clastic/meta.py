@@ -34,7 +34,10 @@ except ImportError:
         sysconfig = None
 
 
-from application import Application, NullRoute, RESERVED_ARGS
+from application import (Application,
+                         NullRoute,
+                         MountRoute,
+                         RESERVED_ARGS)
 from sinter import getargspec, inject
 from render import render_json, AshesRenderFactory
 from static import StaticApplication
@@ -42,6 +45,7 @@ from utils import bytes2human, rel_datetime
 
 from middleware.url import ScriptRootMiddleware
 from middleware.context import SimpleContextProcessor
+from middleware.stats import _find_stats_mw
 
 
 _CUR_PATH = os.path.dirname(os.path.abspath(__file__))
@@ -68,6 +72,13 @@ def get_route_infos(_application):
         r_info = {}
         r_info['url_pattern'] = r.pattern
         r_info['url_regex_pattern'] = r.regex.pattern
+        if isinstance(r, MountRoute):
+            r_info['endpoint'] = {'name': 'mounted %s'
+                                  % r.app.__class__.__name__}
+            r_info['render'] = {'type': None, 'arg': None}
+            r_info['args'] = []
+            ret.append(r_info)
+            continue
         r_info['endpoint'] = get_endpoint_info(r)
         r_info['render'] = get_render_info(r)
         r_info['args'] = get_route_arg_info(r)
@@ -335,9 +346,67 @@ class RoutePeripheral(AshesMetaPeripheral):
 
     def get_context(self, _application, script_root):
         return {'routes': get_route_infos(_application),
+                'dispatch_cache': _application.get_dispatch_cache_stats(),
                 'script_root': script_root}
 
 
+def get_stats_window_rows(_application):
+    stats_mw = _find_stats_mw(_application)
+    if stats_mw is None:
+        return None
+    window_stats = stats_mw.get_window_stats()
+    window_names = [name for name, _, _ in stats_mw.window_specs]
+    ret = []
+    route_items = [('(all routes)', window_stats['all'])]
+    route_items.extend(sorted(window_stats['routes'].items()))
+    for pattern, route_windows in route_items:
+        for name in window_names:
+            row = dict(route_windows[name], pattern=pattern, window=name)
+            ret.append(row)
+    return ret
+
+
+class StatsPeripheral(AshesMetaPeripheral):
+    title = 'Request Statistics'
+    group_key = 'stats'
+    template_path = 'meta_stats_section.html'
+
+    def get_context(self, _application):
+        rows = get_stats_window_rows(_application)
+        return {'installed': rows is not None, 'rows': rows or []}
+
+    def get_general_items(self, context):
+        for row in context.get('rows') or []:
+            # the first row is the shortest window, for all routes
+            return [('Requests (%s)' % row['window'],
+                     '%s/s, %s%% errors' % (row['rate'],
+                                            row['error_rate'] * 100))]
+        return []
+
+
+def get_chain_timing_rows(_application):
+    ret = []
+    for route in _application.routes:
+        chain_timings = getattr(route, 'chain_timings', None)
+        if chain_timings is None:
+            continue
+        for row in chain_timings.get_rows():
+            row['pattern'] = route.pattern
+            ret.append(row)
+    return ret
+
+
+class ChainTimingPeripheral(AshesMetaPeripheral):
+    title = 'Middleware Timings'
+    group_key = 'stats'
+    template_path = 'meta_chain_timing_section.html'
+
+    def get_context(self, _application):
+        return {'timings_enabled': getattr(_application,
+                                           'instrument_chains', False),
+                'timing_rows': get_chain_timing_rows(_application)}
+
+
 class MiddlewarePeripheral(AshesMetaPeripheral):
     title = 'Application-wide Middlewares'
     group_key = 'app'
@@ -421,6 +490,8 @@ class SysconfigPeripheral(MetaPeripheral):
 
 DEFAULT_PERIPHERALS = [BasicPeripheral(),
                        RoutePeripheral(),
+                       StatsPeripheral(),
+                       ChainTimingPeripheral(),
                        MiddlewarePeripheral(),
                        ResourcePeripheral(),
                        HostPeripheral(),
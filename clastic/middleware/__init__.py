@@ -4,10 +4,16 @@ from .core import (Middleware,
                    check_middlewares,
                    merge_middlewares,
                    make_middleware_chain,
+                   ChainTimings,
                    DummyMiddleware)
 from .url import GetParamMiddleware
 from .context import (ContextProcessor,
                       SimpleContextProcessor)
 from .compress import GzipMiddleware
-from .profile import SimpleProfileMiddleware
-from .client_cache import HTTPCacheMiddleware
+from .profile import (SimpleProfileMiddleware,
+                      SamplingProfileMiddleware,
+                      SlowRequestProfileMiddleware)
+from .client_cache import HTTPCacheMiddleware, ConditionalMiddleware
+from .server_cache import (ResponseCacheMiddleware,
+                           MemoryCacheBackend,
+                           SQLiteCacheBackend)
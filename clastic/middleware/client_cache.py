@@ -1,10 +1,37 @@
 # -*- coding: utf-8 -*-
 
+import time
+import datetime
+from hashlib import md5
 
+from werkzeug.http import http_date, quote_etag, is_resource_modified
+from werkzeug.wrappers import BaseResponse, Response
+
+from ..sinter import ArgSpec, get_arg_names, inject
+from ..utils import LRU, get_vary_names, get_vary_items
 from .core import Middleware
 
 
+DEFAULT_STREAM_ETAG_TTL = 60
+
+
 class HTTPCacheMiddleware(Middleware):
+    """
+    Sets Cache-Control directives on responses, and with *use_etags*,
+    adds ETags and answers conditional requests with 304s.
+
+    Streamed bodies can't be hashed up front without buffering them,
+    so by default they only get the ETag they already have, if any.
+    With *stream_etags*, bodies are hashed as they're sent instead,
+    and the digest is recorded for the URL and the request headers
+    named in the response's Vary header. Later responses for the URL
+    are sent with that ETag, and matching conditional requests get a
+    304 without the stream being read at all. A recorded ETag is used
+    for up to *stream_etag_ttl* seconds, and only while the response's
+    Last-Modified and Content-Length stay the same. Streams without a
+    Last-Modified could change at any time, even keeping their length,
+    so aren't given ETags.
+    """
     cache_attrs = ('max_age', 's_maxage', 'no_cache', 'no_store',
                    'no_transform', 'must_revalidate', 'proxy_revalidate',
                    'public', 'private')
@@ -18,10 +45,19 @@ class HTTPCacheMiddleware(Middleware):
                  proxy_revalidate=None,
                  public=None,
                  private=None,
-                 use_etags=True):
+                 use_etags=True,
+                 stream_etags=False,
+                 stream_etag_ttl=DEFAULT_STREAM_ETAG_TTL,
+                 max_stream_etags=1024):
         for attr in self.cache_attrs:
             setattr(self, attr, locals()[attr])
         self.use_etags = use_etags
+        self.stream_etag_ttl = stream_etag_ttl
+        self._stream_etags = None
+        if stream_etags:
+            # (path, query string, vary items) ->
+            #     (etag, validators, expiry time)
+            self._stream_etags = LRU(max_stream_etags)
 
     def request(self, next, request):
         resp = next()
@@ -30,8 +66,143 @@ class HTTPCacheMiddleware(Middleware):
                 cache_val = getattr(self, attr, None)
                 if cache_val:
                     setattr(resp.cache_control, attr, cache_val)
-            if self.use_etags and not resp.is_streamed:
-                # TODO: do streamed responses too?
-                resp.add_etag()
-                resp.make_conditional(request)
+            if self.use_etags:
+                if not resp.is_streamed:
+                    resp.add_etag()
+                    resp.make_conditional(request)
+                else:
+                    self._make_streamed_conditional(request, resp)
         return resp
+
+    def _make_streamed_conditional(self, request, resp):
+        if request.method not in ('GET', 'HEAD') or resp.status_code != 200:
+            return
+        validators = (resp.headers.get('Content-Length'),
+                      resp.headers.get('Last-Modified'))
+        # without a Last-Modified, there's no telling if the body has
+        # changed, a Content-Length alone survives same-length edits
+        if 'ETag' not in resp.headers and self._stream_etags is not None \
+                and validators[1] is not None:
+            environ = request.environ
+            key = (request.path, environ.get('QUERY_STRING', ''),
+                   get_vary_items(environ, get_vary_names(resp)))
+            recorded = self._stream_etags.get(key)
+            if recorded is not None and recorded[1] == validators \
+                    and time.time() < recorded[2]:
+                resp.set_etag(recorded[0])
+            else:
+                self._hash_streamed(resp, key, validators)
+                return
+        # unlike make_conditional(), this never reads the stream
+        if not is_resource_modified(request.environ,
+                                    resp.headers.get('ETag'),
+                                    None,
+                                    resp.headers.get('Last-Modified')):
+            # the body isn't sent, and the response closes the stream
+            resp.status_code = 304
+
+    def _hash_streamed(self, resp, key, validators):
+        orig_iter = resp.response
+        resp.direct_passthrough = False
+        if hasattr(orig_iter, 'close'):
+            resp.call_on_close(orig_iter.close)
+        resp.response = self._iter_hashed(resp.iter_encoded(), key,
+                                          validators)
+
+    def _iter_hashed(self, body_iter, key, validators):
+        digest = md5()
+        for chunk in body_iter:
+            digest.update(chunk)
+            yield chunk
+        # only reached if the whole body was sent
+        expires = time.time() + self.stream_etag_ttl
+        self._stream_etags[key] = (digest.hexdigest(), validators, expires)
+
+
+def _to_datetime(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.utcfromtimestamp(value)
+
+
+class ConditionalMiddleware(Middleware):
+    """
+    Answers conditional GET and HEAD requests with a 304 before the
+    endpoint and render run, using cheap validator functions instead
+    of the rendered body. *etag_func* returns an ETag value (as for
+    Response.set_etag()), and *last_modified_func* a UTC datetime or
+    timestamp. Either may return None to skip the check. Both are
+    injected like endpoints, so they can take path parameters,
+    resources and the request.
+
+    Full responses get the validators' ETag and Last-Modified headers,
+    unless they have their own. Usually added by passing *etag_func*
+    or *last_modified_func* to a Route, which runs this innermost,
+    after the other middlewares.
+    """
+    unique = False
+
+    def __init__(self, etag_func=None, last_modified_func=None):
+        if etag_func is None and last_modified_func is None:
+            raise ValueError('expected etag_func and/or last_modified_func')
+        self.etag_func = etag_func
+        self.last_modified_func = last_modified_func
+        self.request = self._create_request()
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return '%s(etag_func=%r, last_modified_func=%r)' % (
+            cn, self.etag_func, self.last_modified_func)
+
+    def _create_request(self):
+        etag_func, lm_func = self.etag_func, self.last_modified_func
+
+        def conditional_request(next, request, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return next()
+            kwargs['request'] = request
+            etag = last_modified = None
+            if etag_func is not None:
+                etag = inject(etag_func, kwargs)
+            if lm_func is not None:
+                last_modified = inject(lm_func, kwargs)
+                if last_modified is not None:
+                    last_modified = _to_datetime(last_modified)
+            if self._is_not_modified(request, etag, last_modified):
+                resp = Response(status=304)
+            else:
+                resp = next()
+                if not isinstance(resp, BaseResponse):
+                    return resp
+            headers = resp.headers
+            if etag is not None and 'ETag' not in headers:
+                headers['ETag'] = quote_etag(etag)
+            if last_modified is not None and 'Last-Modified' not in headers:
+                headers['Last-Modified'] = http_date(last_modified)
+            return resp
+
+        arg_names = set()
+        for func in (etag_func, lm_func):
+            if func is not None:
+                arg_names.update(get_arg_names(func, only_required=True))
+        arg_names -= set(['next', 'request'])
+        _req_args = ['next', 'request'] + sorted(arg_names)
+        conditional_request._argspec = ArgSpec(args=_req_args,
+                                               varargs=None,
+                                               keywords=None,
+                                               defaults=None)
+        return conditional_request
+
+    def _is_not_modified(self, request, etag, last_modified):
+        # as in RFC 7232, If-None-Match takes precedence when present
+        if 'HTTP_IF_NONE_MATCH' in request.environ:
+            if etag is None:
+                return False
+            return request.if_none_match.contains_weak(etag)
+        if last_modified is None:
+            return False
+        if_modified_since = request.if_modified_since
+        if if_modified_since is None:
+            return False
+        # HTTP dates don't go below whole seconds
+        return last_modified.replace(microsecond=0) <= if_modified_since
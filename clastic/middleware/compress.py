@@ -1,44 +1,246 @@
 # -*- coding: utf-8 -*-
 
-from gzip import GzipFile
-from StringIO import StringIO
+import zlib
+from hashlib import md5
 
+from ..utils import SizedLRU, get_vary_names, get_vary_items
 from .core import Middleware
 
 
+# zlib writes a gzip header and trailer given 16 + the window size
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+DEFAULT_BLOCK_SIZE = 16 * 1024
+
+DEFAULT_MIN_SIZE = 256
+DEFAULT_CACHE_BYTES = 8 * 1024 * 1024
+
+# statuses which have no body to compress
+_NO_BODY_STATUSES = frozenset([204, 304])
+
+# formats which are compressed already, and which gzip would only grow
+_COMPRESSED_MIMETYPES = frozenset(['application/gzip',
+                                   'application/x-gzip',
+                                   'application/x-bzip2',
+                                   'application/x-xz',
+                                   'application/zip',
+                                   'application/x-7z-compressed',
+                                   'application/x-rar-compressed',
+                                   'application/font-woff',
+                                   'font/woff',
+                                   'font/woff2'])
+_COMPRESSED_MEDIA = ('image', 'audio', 'video')
+_COMPRESSIBLE_MEDIA_MIMETYPES = frozenset(['image/svg+xml',
+                                           'image/bmp',
+                                           'image/x-icon'])
+
+
+def is_compressed_mimetype(mimetype):
+    """
+    Returns True for archives, and image, audio and video formats,
+    except for a few uncompressed image formats like SVG.
+    """
+    if not mimetype:
+        return False
+    mimetype = mimetype.lower()
+    if mimetype in _COMPRESSED_MIMETYPES:
+        return True
+    if mimetype.split('/', 1)[0] in _COMPRESSED_MEDIA:
+        return mimetype not in _COMPRESSIBLE_MEDIA_MIMETYPES
+    return False
+
+
 def compress(data, level=6):
-    out = StringIO()
-    f = GzipFile(fileobj=out, mode='wb', compresslevel=level)
-    f.write(data)
-    f.close()
-    return out.getvalue()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def iter_compress(iterable, level=6, block_size=DEFAULT_BLOCK_SIZE):
+    """
+    Gzips an iterable of bytestrings, yielding the compressed stream
+    piece by piece. The compressor is flushed every *block_size* bytes
+    of input, so that clients get data as it's produced, without the
+    overhead of flushing after every (possibly tiny) chunk.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _GZIP_WBITS)
+    unflushed = 0
+    for chunk in iterable:
+        if not chunk:
+            continue
+        out = compressor.compress(chunk)
+        unflushed += len(chunk)
+        if unflushed >= block_size:
+            out += compressor.flush(zlib.Z_SYNC_FLUSH)
+            unflushed = 0
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def _entry_size(entry):
+    return len(entry[0])
 
 
 class GzipMiddleware(Middleware):
-    def __init__(self, compress_level=6):
+    """
+    Gzips response bodies for clients which accept it. Streamed
+    bodies are compressed incrementally, as they're sent.
+
+    Bodies shorter than *min_size* bytes aren't worth compressing,
+    and neither are mimetypes which are compressed already (see
+    is_compressed_mimetype()), so both are sent as-is.
+
+    Compressed bodies are kept in an LRU capped at *cache_bytes* (0
+    disables it). Responses with a strong ETag are cached by their
+    path, query string, ETag and the request headers named in their
+    Vary header. Other non-streamed responses are cached by a digest
+    of their body. Cache hits and misses, as well as the bytes saved
+    by compression, are available from get_stats().
+    """
+    def __init__(self, compress_level=6, block_size=DEFAULT_BLOCK_SIZE,
+                 min_size=DEFAULT_MIN_SIZE, cache_bytes=DEFAULT_CACHE_BYTES):
         self.compress_level = compress_level
+        self.block_size = block_size
+        self.min_size = min_size
+        self._cache = None
+        if cache_bytes:
+            self._cache = SizedLRU(cache_bytes, size_func=_entry_size)
+        self.bytes_in = self.bytes_out = 0
 
     def request(self, next, request):
         resp = next()
-        # TODO: shortcut redirects/304s/responses without content?
         resp.vary.add('Accept-Encoding')
         if resp.content_encoding or not request.accept_encodings['gzip']:
             return resp
+        if resp.status_code < 200 or resp.status_code in _NO_BODY_STATUSES:
+            return resp
+        if is_compressed_mimetype(resp.mimetype):
+            return resp
+        if resp.content_length is not None \
+                and resp.content_length < self.min_size:
+            return resp
 
-        if 'msie' in request.user_agent.browser:
+        if 'msie' in (request.user_agent.browser or ''):
             if not (resp.content_type.startswith('text/') or
                     'javascript' in resp.content_type):
                 return resp
 
         if resp.is_streamed:
-            return resp  # TODO
-        else:
-            comp_content = compress(resp.data, self.compress_level)
-            if len(comp_content) >= len(resp.data):
-                return resp
-            resp.response = [comp_content]
-            resp.content_length = len(comp_content)
+            self._compress_streamed(request, resp)
+        elif not self._compress_sequence(request, resp):
+            return resp
 
         resp.content_encoding = 'gzip'
         # TODO: regenerate etag?
         return resp
+
+    def get_stats(self):
+        ret = {'hit_count': 0, 'miss_count': 0}
+        if self._cache is not None:
+            ret.update(self._cache.get_stats())
+        ret['bytes_in'] = self.bytes_in
+        ret['bytes_out'] = self.bytes_out
+        ret['bytes_saved'] = self.bytes_in - self.bytes_out
+        return ret
+
+    def _get_etag_key(self, request, resp):
+        # weak etags don't promise byte-identical bodies
+        etag, weak = resp.get_etag()
+        if not etag or weak:
+            return None
+        # the same etag may be given to each variant of a resource,
+        # though the body doesn't depend on what gzip itself varies on
+        vary_names = [n for n in get_vary_names(resp)
+                      if n != 'accept-encoding']
+        return ('etag', request.path, request.environ.get('QUERY_STRING', ''),
+                get_vary_items(request.environ, vary_names), etag,
+                self.compress_level)
+
+    def _compress_streamed(self, request, resp):
+        orig_iter = resp.response
+        # the compressed body replaces any file wrapper, so the
+        # response has to be iterated, and has to close the original
+        resp.direct_passthrough = False
+        if hasattr(orig_iter, 'close'):
+            resp.call_on_close(orig_iter.close)
+
+        cache_key = cached = None
+        if self._cache is not None:
+            cache_key = self._get_etag_key(request, resp)
+            if cache_key is not None:
+                cached = self._cache.get(cache_key)
+        if cached is not None:
+            comp_data, orig_size = cached
+            self._count(orig_size, len(comp_data))
+            resp.response = [comp_data]
+            resp.content_length = len(comp_data)
+            return
+        resp.response = self._iter_streamed(resp.iter_encoded(), cache_key)
+        resp.headers.pop('Content-Length', None)
+
+    def _iter_streamed(self, body_iter, cache_key):
+        orig_size = [0]
+
+        def counted(chunks):
+            for chunk in chunks:
+                orig_size[0] += len(chunk)
+                yield chunk
+
+        comp_size, comp_chunks = 0, None
+        if cache_key is not None:
+            comp_chunks = []
+        for comp_chunk in iter_compress(counted(body_iter),
+                                        self.compress_level,
+                                        self.block_size):
+            comp_size += len(comp_chunk)
+            if comp_chunks is not None:
+                if comp_size > self._cache.max_bytes:
+                    comp_chunks = None  # too big to cache anyway
+                else:
+                    comp_chunks.append(comp_chunk)
+            yield comp_chunk
+        # only reached if the whole body was sent
+        self._count(orig_size[0], comp_size)
+        if comp_chunks is not None:
+            self._cache[cache_key] = (''.join(comp_chunks), orig_size[0])
+
+    def _compress_sequence(self, request, resp):
+        chunks = list(resp.iter_encoded())
+        orig_size = sum([len(c) for c in chunks])
+        if orig_size < self.min_size:
+            return False
+
+        cache_key = cached = None
+        if self._cache is not None:
+            cache_key = self._get_etag_key(request, resp)
+            if cache_key is None:
+                # md5 is several times cheaper than sha2 here, and a
+                # collision would need both bodies to be attacker-chosen
+                digest = md5()
+                for chunk in chunks:
+                    digest.update(chunk)
+                cache_key = ('digest', digest.digest(), orig_size,
+                             self.compress_level)
+            cached = self._cache.get(cache_key)
+        if cached is not None:
+            comp_data = cached[0]
+        else:
+            # the body's already in memory, but compress it a chunk at
+            # a time anyway, rather than joining it into one big string
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+                                          _GZIP_WBITS)
+            comp_chunks = [compressor.compress(c) for c in chunks]
+            comp_chunks.append(compressor.flush())
+            comp_data = ''.join(comp_chunks)
+            if cache_key is not None:
+                # cached even if it didn't shrink, to skip trying again
+                self._cache[cache_key] = (comp_data, orig_size)
+        if len(comp_data) >= orig_size:
+            return False
+        self._count(orig_size, len(comp_data))
+        resp.response = [comp_data]
+        resp.content_length = len(comp_data)
+        return True
+
+    def _count(self, orig_size, comp_size):
+        self.bytes_in += orig_size
+        self.bytes_out += comp_size
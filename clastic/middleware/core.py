@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import time
 import itertools
+from threading import Lock
 from collections import defaultdict
 
 from werkzeug.utils import cached_property
 from werkzeug.wrappers import BaseResponse  # TODO: remove dependency
 
-from ..sinter import make_chain, get_arg_names, _VERBOSE
+from ..sinter import (make_chain, get_arg_names, getargspec,
+                      get_func_name, _VERBOSE)
 
 
 class Middleware(object):
@@ -125,10 +128,110 @@ class DummyMiddleware(Middleware):
         return ret
 
 
-def make_middleware_chain(middlewares, endpoint, render, preprovided):
+class ChainTimings(object):
+    """
+    Time spent in each stage of a compiled middleware chain, as a
+    count and total in seconds per (stage, section). Middleware
+    functions' sections are 'pre' and 'post', for their code before
+    and after calling next(), and the endpoint's and render
+    function's section is 'call'.
+    """
+    def __init__(self):
+        self.stages = []  # stage names, outermost first
+        self._totals = {}  # (stage, section) -> [count, total]
+        self._lock = Lock()
+
+    def add_stage(self, stage, sections):
+        with self._lock:
+            if stage in self.stages:
+                return  # e.g., a lazily-built chain built twice
+            self.stages.append(stage)
+            for section in sections:
+                self._totals[(stage, section)] = [0, 0.0]
+
+    def add(self, stage, section, elapsed_time):
+        with self._lock:
+            totals = self._totals[(stage, section)]
+            totals[0] += 1
+            totals[1] += elapsed_time
+
+    def get_rows(self):
+        """
+        Returns a list of dicts with the stage, section, count, mean
+        and total, in milliseconds, in the order the stages run.
+        """
+        ret = []
+        with self._lock:
+            for stage in self.stages:
+                for section in ('pre', 'call', 'post'):
+                    try:
+                        count, total = self._totals[(stage, section)]
+                    except KeyError:
+                        continue
+                    mean = total / count if count else 0.0
+                    ret.append({'stage': stage,
+                                'section': section,
+                                'count': count,
+                                'mean': round(mean * 1000, 3),
+                                'total': round(total * 1000, 3)})
+        return ret
+
+
+def _make_timed_mw_func(func, timings, stage):
+    timings.add_stage(stage, ('pre', 'post'))
+
+    def timed_mw_func(next, **kwargs):
+        next_times = []  # (start, end) of each call to next
+
+        def timed_next(*a, **kw):
+            next_start = time.time()
+            try:
+                return next(*a, **kw)
+            finally:
+                next_times.append((next_start, time.time()))
+
+        start_time = time.time()
+        try:
+            return func(next=timed_next, **kwargs)
+        finally:
+            end_time = time.time()
+            if next_times:
+                pre_time = next_times[0][0] - start_time
+                own_time = end_time - start_time - sum([e - s for s, e
+                                                        in next_times])
+                timings.add(stage, 'pre', pre_time)
+                timings.add(stage, 'post', own_time - pre_time)
+            else:
+                timings.add(stage, 'pre', end_time - start_time)
+
+    timed_mw_func._argspec = getargspec(func)
+    return timed_mw_func
+
+
+def _make_timed_func(func, timings, stage):
+    timings.add_stage(stage, ('call',))
+
+    def timed_func(**kwargs):
+        start_time = time.time()
+        try:
+            return func(**kwargs)
+        finally:
+            timings.add(stage, 'call', time.time() - start_time)
+
+    timed_func._argspec = getargspec(func)
+    return timed_func
+
+
+def make_middleware_chain(middlewares, endpoint, render, preprovided,
+                          flat=False, timings=None):
     """
     Expects de-duplicated and conflict-free middleware/endpoint/render
-    functions.
+    functions. With *flat* set, the chains are compiled with
+    sinter.compile_flat_chain(), avoiding per-request closures.
+
+    Given a ChainTimings as *timings*, every middleware function, the
+    endpoint and the render function are wrapped to record their time
+    into it. Otherwise, the chain is built without any wrappers.
 
     # TODO: better name to differentiate a compiled/chained stack from
     # the core functions themselves (endpoint/render)
@@ -138,6 +241,9 @@ def make_middleware_chain(middlewares, endpoint, render, preprovided):
         raise NameError(_next_exc_msg % endpoint)
     if 'next' in get_arg_names(render):
         raise NameError(_next_exc_msg % render)
+    if timings is not None:
+        return _make_timed_middleware_chain(middlewares, endpoint, render,
+                                            preprovided, flat, timings)
 
     req_avail = set(preprovided) - set(['next', 'context'])
     req_sigs = [(mw.request, mw.provides)
@@ -152,7 +258,8 @@ def make_middleware_chain(middlewares, endpoint, render, preprovided):
     ep_chain, ep_args, ep_unres = make_chain(ep_funcs,
                                              ep_provides,
                                              endpoint,
-                                             ep_avail)
+                                             ep_avail,
+                                             flat=flat)
     if ep_unres:
         raise NameError("unresolved endpoint middleware arguments: %r"
                         % list(ep_unres))
@@ -164,7 +271,8 @@ def make_middleware_chain(middlewares, endpoint, render, preprovided):
     rn_chain, rn_args, rn_unres = make_chain(rn_funcs,
                                              rn_provides,
                                              render,
-                                             rn_avail)
+                                             rn_avail,
+                                             flat=flat)
     if rn_unres:
         raise NameError("unresolved render middleware arguments: %r"
                         % list(rn_unres))
@@ -178,13 +286,53 @@ def make_middleware_chain(middlewares, endpoint, render, preprovided):
     req_chain, req_chain_args, req_unres = make_chain(req_funcs,
                                                       req_provides,
                                                       req_func,
-                                                      req_avail)
+                                                      req_avail,
+                                                      flat=flat)
     if req_unres:
         raise NameError("unresolved request middleware arguments: %r"
                         % list(req_unres))
     return req_chain
 
 
+def _make_timed_middleware_chain(middlewares, endpoint, render,
+                                 preprovided, flat, timings):
+    stage_funcs = {}
+    for func_name in ('request', 'endpoint', 'render'):
+        stage_counts = {}
+        for i, mw in enumerate(middlewares):
+            func = getattr(mw, func_name, None)
+            if not func:
+                continue
+            stage = '%s.%s' % (mw.name, func_name)
+            stage_counts[stage] = stage_counts.get(stage, 0) + 1
+            if stage_counts[stage] > 1:  # non-unique middlewares
+                stage += ' #%s' % stage_counts[stage]
+            stage_funcs[i, func_name] = \
+                _make_timed_mw_func(func, timings, stage)
+        if func_name == 'endpoint':
+            endpoint = _make_timed_func(
+                endpoint, timings, 'endpoint (%s)' % get_func_name(endpoint))
+        elif func_name == 'render':
+            render = _make_timed_func(render, timings, 'render')
+
+    timed_mws = []
+    for i, mw in enumerate(middlewares):
+        timed_mw = _TimedMiddleware(mw)
+        for func_name in ('request', 'endpoint', 'render'):
+            setattr(timed_mw, func_name, stage_funcs.get((i, func_name)))
+        timed_mws.append(timed_mw)
+    return make_middleware_chain(timed_mws, endpoint, render, preprovided,
+                                 flat=flat)
+
+
+class _TimedMiddleware(object):
+    "Stands in for a middleware, with its functions' timed wrappers."
+    def __init__(self, mw):
+        self.provides = mw.provides
+        self.endpoint_provides = mw.endpoint_provides
+        self.render_provides = mw.render_provides
+
+
 _REQ_INNER_TMPL = \
 '''
 def process_request({all_args}):
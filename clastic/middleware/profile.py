@@ -1,13 +1,23 @@
 # -*- coding: utf-8 -*-
 
+import os
+import sys
+import json
+import time
+import random
+import logging
 import cProfile
+import threading
 from pstats import Stats
 from cStringIO import StringIO
 
+from werkzeug.wrappers import Response
 
 from .core import Middleware
 
 
+_logger = logging.getLogger(__name__)
+
 _prof_tmpl = '<html><body><pre>%s</pre></body</html>'
 _sort_keys = {'cumulative': 'cumulative time, i.e., includes time in called functions.',
               'file': 'source file',
@@ -21,9 +31,17 @@ _sort_keys = {'cumulative': 'cumulative time, i.e., includes time in called func
 
 
 class SimpleProfileMiddleware(Middleware):
-    def __init__(self, sort_param_name='_prof_sort', get_param_name='_prof'):
+    """
+    Profiles requests with the *get_param_name* query parameter set,
+    and responds with the profile instead of the usual body. If the
+    request raises an exception, the profile is served with a 500
+    status, unless *raise_exc* is set.
+    """
+    def __init__(self, sort_param_name='_prof_sort', get_param_name='_prof',
+                 raise_exc=False):
         self.get_param_name = get_param_name
         self.sort_param_name = sort_param_name
+        self.raise_exc = raise_exc
 
     def request(self, next, request):
         if not request.args.get(self.get_param_name):
@@ -38,8 +56,358 @@ class SimpleProfileMiddleware(Middleware):
         except:
             if self.raise_exc:
                 raise
+            ret = Response(status=500, mimetype='text/html')
         buff = StringIO()
         stats = Stats(profiler, stream=buff).sort_stats(sort_param).print_stats()
         body = _prof_tmpl % buff.getvalue()
         ret.set_data(body)
         return ret
+
+
+DEFAULT_SLOW_THRESHOLD = 1.0
+DEFAULT_MAX_DUMPS = 100
+
+
+class SlowRequestProfileMiddleware(Middleware):
+    """
+    Profiles a random *sample_rate* fraction of requests, and keeps
+    the profiles of those which took *threshold* seconds or more, so
+    that pathologically slow requests can be caught in production
+    without profiling everything.
+
+    Each kept profile is written to *directory* as a pstats dump
+    (``<id>.prof``) with its route, path and timing in a JSON file
+    alongside (``<id>.json``). Once there are more than *max_dumps*,
+    the oldest are removed. See create_slow_profile_app() for listing
+    and reading them.
+    """
+    def __init__(self, directory, sample_rate=0.01,
+                 threshold=DEFAULT_SLOW_THRESHOLD,
+                 max_dumps=DEFAULT_MAX_DUMPS):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError('expected sample_rate between 0 and 1, not %r'
+                             % sample_rate)
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.max_dumps = max_dumps
+        self.dump_count = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def request(self, next, request, _route):
+        if random.random() >= self.sample_rate:
+            return next()
+        profiler = cProfile.Profile()
+        start_time = time.time()
+        resp_status = None
+        try:
+            ret = profiler.runcall(next)
+            resp_status = getattr(ret, 'status_code', None)
+            return ret
+        except Exception as e:
+            resp_status = getattr(e, 'code', None) or repr(type(e))
+            raise
+        finally:
+            elapsed_time = time.time() - start_time
+            if elapsed_time >= self.threshold:
+                info = {'pattern': _route.pattern,
+                        'path': request.path,
+                        'method': request.method,
+                        'status': resp_status,
+                        'start_time': start_time,
+                        'elapsed_time': elapsed_time}
+                try:
+                    self._dump(profiler, info)
+                except Exception:
+                    # the request itself went fine, don't fail it
+                    _logger.exception('failed to dump the profile of %s %s',
+                                      request.method, request.path)
+
+    def _dump(self, profiler, info):
+        with self._lock:
+            self.dump_count += 1
+            dump_id = '%d-%d-%d' % (info['start_time'] * 1000, os.getpid(),
+                                    self.dump_count)
+            info['id'] = dump_id
+            path = os.path.join(self.directory, dump_id)
+            profiler.dump_stats(path + '.prof')
+            with open(path + '.json', 'w') as f:
+                json.dump(info, f)
+            self._prune()
+
+    def _prune(self):
+        dump_ids = self._get_dump_ids()
+        for dump_id in dump_ids[:-self.max_dumps or None]:
+            for ext in ('.json', '.prof'):
+                try:
+                    os.remove(os.path.join(self.directory, dump_id + ext))
+                except OSError:
+                    pass  # another process got there first
+
+    def _get_dump_ids(self):
+        """
+        Returns the ids of the dumps on disk, oldest first. Files not
+        named like a dump are ignored.
+        """
+        dump_ids = []
+        for fn in os.listdir(self.directory):
+            if not fn.endswith('.json'):
+                continue
+            dump_id = fn[:-len('.json')]
+            try:
+                sort_key = [int(p) for p in dump_id.split('-')]
+            except ValueError:
+                continue
+            dump_ids.append((sort_key, dump_id))
+        return [dump_id for _, dump_id in sorted(dump_ids)]
+
+    def get_dumps(self):
+        "Returns the info of each dump on disk, newest first."
+        ret = []
+        for dump_id in reversed(self._get_dump_ids()):
+            try:
+                with open(os.path.join(self.directory,
+                                       dump_id + '.json')) as f:
+                    ret.append(json.load(f))
+            except (IOError, ValueError):
+                continue  # pruned, or still being written
+        return ret
+
+    def get_dump_text(self, dump_id, sort_key='cumulative'):
+        """
+        Returns the stats of the dump with *dump_id* as text, sorted by
+        *sort_key*, or None if there's no such dump.
+        """
+        if sort_key not in _sort_keys:
+            raise KeyError('%s is not a supported sort_key. choose from: %r'
+                           % (sort_key, _sort_keys))
+        if dump_id not in self._get_dump_ids():
+            return None
+        buff = StringIO()
+        path = os.path.join(self.directory, dump_id + '.prof')
+        try:
+            stats = Stats(path, stream=buff)
+        except IOError:
+            return None
+        stats.sort_stats(sort_key).print_stats()
+        return buff.getvalue()
+
+
+def create_slow_profile_app(profile_mw):
+    """
+    Returns an Application serving the dumps kept by the
+    SlowRequestProfileMiddleware *profile_mw*: '/' lists them, newest
+    first, and '/<dump_id>' shows one as text, sorted by the optional
+    'sort' query parameter.
+    """
+    from ..application import Application  # avoids a circular import
+    from ..render import render_basic
+
+    def list_dumps():
+        return {'dumps': profile_mw.get_dumps()}
+
+    def get_dump(request, dump_id):
+        sort_key = request.args.get('sort', 'cumulative')
+        if sort_key not in _sort_keys:
+            return Response('unsupported sort: choose from %s\n'
+                            % ', '.join(sorted(_sort_keys)), status=400)
+        text = profile_mw.get_dump_text(dump_id, sort_key)
+        if text is None:
+            return Response('no dump with id %r\n' % dump_id, status=404)
+        return Response(text, mimetype='text/plain')
+
+    return Application([('/', list_dumps, render_basic),
+                        ('/<dump_id>', get_dump)])
+
+
+DEFAULT_SAMPLE_INTERVAL = 0.05
+DEFAULT_SAMPLE_WINDOW = 300
+DEFAULT_MAX_DEPTH = 64
+
+
+class SamplingProfileMiddleware(Middleware):
+    """
+    A statistical profiler, cheap enough to leave on in production.
+    A background thread wakes every *interval* seconds, and records
+    the stack of each thread that's in the middle of a request, from
+    the middleware down, keeping the innermost *max_depth* frames.
+    Counts of identical stacks are aggregated by route pattern. A
+    request dispatched from within another on the same thread is
+    sampled as its own route until it returns.
+
+    Samples are kept for *window* seconds, after which they become
+    the previous window, and the one before that is dropped, so
+    get_stacks() covers between one and two windows. See
+    create_sampling_profile_app() for serving them.
+    """
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL,
+                 window=DEFAULT_SAMPLE_WINDOW, max_depth=DEFAULT_MAX_DEPTH):
+        self.interval = interval
+        self.window = window
+        self.max_depth = max_depth
+        self.sample_count = 0
+        self._active = {}  # thread ident -> (pattern, middleware frame)
+        self._cur_stacks = {}  # pattern -> {stack tuple: count}
+        self._prev_stacks = {}
+        self._window_start = time.time()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def request(self, next, _route):
+        if self._pid != os.getpid() and not self._stopped.is_set():
+            self._start()  # threads don't survive forks
+        ident = threading.current_thread().ident
+        prev_active = self._active.get(ident)
+        self._active[ident] = (_route.pattern, sys._getframe())
+        try:
+            return next()
+        finally:
+            if prev_active is None:
+                del self._active[ident]
+            else:
+                self._active[ident] = prev_active  # back to the outer one
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run,
+                                            name='SamplingProfiler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        "Stops the sampling thread. Samples taken so far are kept."
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        "Records the stack of every thread handling a request."
+        frames = sys._current_frames()
+        with self._lock:
+            now = time.time()
+            if now - self._window_start >= self.window:
+                self._prev_stacks, self._cur_stacks = self._cur_stacks, {}
+                self._window_start = now
+            for ident, (pattern, mw_frame) in self._active.items():
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None and frame is not mw_frame:
+                    stack.append(_get_frame_label(frame))
+                    frame = frame.f_back
+                # the frames nearest the root are the ones to drop
+                stack = tuple(reversed(stack[:self.max_depth]))
+                route_stacks = self._cur_stacks.setdefault(pattern, {})
+                route_stacks[stack] = route_stacks.get(stack, 0) + 1
+                self.sample_count += 1
+
+    def get_stacks(self, pattern=None):
+        """
+        Returns a dict mapping stacks, as tuples of frame labels from
+        the outermost in, to sample counts, for *pattern*'s route, or
+        for every route, in which case each stack starts with the
+        route's pattern.
+        """
+        ret = {}
+        with self._lock:
+            for route_stacks in (self._prev_stacks, self._cur_stacks):
+                for cur_pattern, stacks in route_stacks.items():
+                    if pattern is None:
+                        prefix = (cur_pattern,)
+                    elif cur_pattern == pattern:
+                        prefix = ()
+                    else:
+                        continue
+                    for stack, count in stacks.items():
+                        stack = prefix + stack
+                        ret[stack] = ret.get(stack, 0) + count
+        return ret
+
+
+def _get_frame_label(frame):
+    code = frame.f_code
+    # semicolons separate frames in the collapsed format
+    return ('%s (%s:%s)' % (code.co_name, code.co_filename,
+                            code.co_firstlineno)).replace(';', ':')
+
+
+def get_collapsed_text(stacks):
+    """
+    Renders *stacks*, as returned by get_stacks(), in the "collapsed"
+    format read by flamegraph.pl and similar tools: one line per
+    stack, with its frames joined by semicolons, then its count.
+    """
+    lines = ['%s %s' % (';'.join(stack), count)
+             for stack, count in sorted(stacks.items())]
+    return '\n'.join(lines + [''])
+
+
+def get_flame_text(stacks, min_ratio=0.005):
+    """
+    Renders *stacks* as an indented text tree, like a flame graph on
+    its side, with each frame's share of all samples. Frames with a
+    smaller share than *min_ratio* are left out.
+    """
+    tree = {}  # label -> [count, child tree]
+    total = 0
+    for stack, count in stacks.items():
+        total += count
+        cur = tree
+        for label in stack:
+            node = cur.setdefault(label, [0, {}])
+            node[0] += count
+            cur = node[1]
+    lines = ['%s samples' % total]
+
+    def _add_lines(subtree, depth):
+        for label, (count, children) in sorted(subtree.items(),
+                                               key=lambda x: -x[1][0]):
+            if count < total * min_ratio:
+                continue
+            lines.append('%s%5.1f%% %s' % ('  ' * depth,
+                                           100.0 * count / total, label))
+            _add_lines(children, depth + 1)
+    _add_lines(tree, 0)
+    return '\n'.join(lines + [''])
+
+
+def create_sampling_profile_app(profile_mw=None):
+    """
+    Returns an Application serving *profile_mw*'s samples, or those
+    of the SamplingProfileMiddleware installed on the application the
+    routes are bound to. '/' serves the collapsed format, and
+    '/flame' the text tree. Both take an optional 'route' query
+    parameter to show only the route with that pattern.
+    """
+    from ..application import Application  # avoids a circular import
+
+    def _get_profile_mw(application):
+        if profile_mw is not None:
+            return profile_mw
+        for mw in application.middlewares:
+            if isinstance(mw, SamplingProfileMiddleware):
+                return mw
+        return None
+
+    def _make_endpoint(render_func):
+        def get_profile(request, _application):
+            cur_profile_mw = _get_profile_mw(_application)
+            if cur_profile_mw is None:
+                return Response("SamplingProfileMiddleware doesn't seem to"
+                                " be installed\n", status=404)
+            stacks = cur_profile_mw.get_stacks(request.args.get('route'))
+            return Response(render_func(stacks), mimetype='text/plain')
+        return get_profile
+
+    return Application([('/', _make_endpoint(get_collapsed_text)),
+                        ('/flame', _make_endpoint(get_flame_text))])
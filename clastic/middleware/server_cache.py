@@ -0,0 +1,416 @@
+# -*- coding: utf-8 -*-
+"""
+Server-side caching of whole responses. Where HTTPCacheMiddleware
+only tells clients (and proxies) what they may cache,
+ResponseCacheMiddleware keeps rendered responses itself, so repeat
+requests are answered without running the endpoint or render at all.
+
+Responses are stored in a backend, which by default is an in-process
+MemoryCacheBackend. With a forking server, each worker would fill its
+own copy of that, so SQLiteCacheBackend keeps entries in a file that
+every process on the host shares. Any object with the same get(),
+set(), claim(), release() and purge() methods can be used instead.
+"""
+
+import os
+import time
+import sqlite3
+from collections import namedtuple
+from contextlib import contextmanager
+from threading import Lock, local
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from werkzeug.http import parse_cache_control_header
+from werkzeug.datastructures import ResponseCacheControl
+from werkzeug.wrappers import Response
+
+from ..utils import SizedLRU, get_vary_names, get_vary_items
+from .core import Middleware
+
+
+DEFAULT_TTL = 60
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_MAX_ENTRY_BYTES = 1024 * 1024
+
+# the statuses RFC 2616 allows caching by default
+CACHEABLE_STATUSES = frozenset([200, 203, 300, 301, 410])
+
+CacheEntry = namedtuple('CacheEntry', 'status headers body created'
+                                      ' expires stale_until')
+
+
+def get_entry_size(entry):
+    "Roughly how many bytes a cached entry (or Vary list) takes up."
+    if not isinstance(entry, CacheEntry):
+        return sum([len(v) for v in entry])
+    ret = len(entry.body)
+    for name, value in entry.headers:
+        ret += len(name) + len(value)
+    return ret
+
+
+def _get_item_size(item):
+    return get_entry_size(item[1])
+
+
+class MemoryCacheBackend(object):
+    """
+    Keeps cache entries in an LRU in this process's memory, bounded
+    both by entry count and by total size.
+    """
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_entries=4096):
+        # values are stored as (path, value), for purging
+        self._lru = SizedLRU(max_bytes, max_entries,
+                             size_func=_get_item_size)
+        self._claims = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        item = self._lru.get(key)
+        if item is None:
+            return None
+        return item[1]
+
+    def set(self, key, value, path):
+        self._lru[key] = (path, value)
+
+    def claim(self, key, timeout):
+        """
+        Returns True if the caller may refresh *key*, which it then
+        holds for up to *timeout* seconds, or until release().
+        """
+        now = time.time()
+        with self._lock:
+            if self._claims.get(key, 0) > now:
+                return False
+            self._claims[key] = now + timeout
+            return True
+
+    def release(self, key):
+        with self._lock:
+            self._claims.pop(key, None)
+
+    def purge(self, path=None):
+        if path is None:
+            self._lru.clear()
+            return
+        for key, (key_path, _) in self._lru.items():
+            if key_path == path:
+                self._lru.pop(key, None)
+
+    def get_stats(self):
+        return self._lru.get_stats()
+
+
+_SQLITE_SCHEMA = """
+BEGIN IMMEDIATE;
+CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY,
+                                    path TEXT,
+                                    size INTEGER,
+                                    accessed REAL,
+                                    value BLOB);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE INDEX IF NOT EXISTS entries_path ON entries (path);
+CREATE TABLE IF NOT EXISTS claims (key BLOB PRIMARY KEY, expires REAL);
+CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY,
+                                   entry_count INTEGER,
+                                   byte_count INTEGER);
+INSERT OR IGNORE INTO totals VALUES (0, 0, 0);
+CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+  UPDATE totals SET entry_count = entry_count + 1,
+                    byte_count = byte_count + NEW.size;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+  UPDATE totals SET entry_count = entry_count - 1,
+                    byte_count = byte_count - OLD.size;
+END;
+COMMIT;
+"""
+
+
+class SQLiteCacheBackend(object):
+    """
+    Keeps cache entries in a SQLite database at *path*, shared by
+    every process which opens the same file, such as the workers of
+    Application.serve(processes=N). A response is then rendered once
+    per host rather than once per worker, and claims on stale entries
+    hold across processes too.
+
+    Like MemoryCacheBackend, the cache is bounded both by entry count
+    and by total (pickled) size, evicting the least recently used
+    entries first. Access times are only written every
+    *touch_interval* seconds, so that most hits are read-only.
+
+    Each process and thread opens its own connection on first use,
+    and SQLite's file locking serializes writers, waiting up to
+    *timeout* seconds for the lock. Entries are pickled, so the file
+    must only be writable by the application's own user.
+    """
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, max_entries=4096,
+                 timeout=5.0, touch_interval=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.touch_interval = touch_interval
+        self.hit_count = self.miss_count = 0
+        self._local = local()
+        conn = self._get_conn()
+        conn.execute('PRAGMA journal_mode=WAL')  # readers don't block writers
+        conn.executescript(_SQLITE_SCHEMA)
+
+    def _get_conn(self):
+        # connections can't be used across a fork, nor by default
+        # across threads, so each process and thread gets its own
+        conn_local, pid = self._local, os.getpid()
+        if getattr(conn_local, 'pid', None) != pid:
+            conn_local.conn = sqlite3.connect(self.path,
+                                              timeout=self.timeout,
+                                              isolation_level=None)
+            conn_local.conn.execute('PRAGMA synchronous=NORMAL')
+            conn_local.pid = pid
+        return conn_local.conn
+
+    @contextmanager
+    def _transaction(self, conn):
+        conn.execute('BEGIN IMMEDIATE')  # take the write lock up front
+        try:
+            yield
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def get(self, key):
+        conn = self._get_conn()
+        key = sqlite3.Binary(key)
+        row = conn.execute('SELECT accessed, value FROM entries WHERE key = ?',
+                           (key,)).fetchone()
+        if row is None:
+            self.miss_count += 1
+            return None
+        self.hit_count += 1
+        now = time.time()
+        if now - row[0] > self.touch_interval:
+            try:
+                conn.execute('UPDATE entries SET accessed = ? WHERE key = ?',
+                             (now, key))
+            except sqlite3.OperationalError:
+                pass  # busy; the access time is only for eviction order
+        return pickle.loads(str(row[1]))
+
+    def set(self, key, value, path):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        conn = self._get_conn()
+        key = sqlite3.Binary(key)
+        with self._transaction(conn):
+            # an explicit delete, as REPLACE wouldn't fire the trigger
+            conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            if len(data) > self.max_bytes:
+                return
+            conn.execute('INSERT INTO entries VALUES (?, ?, ?, ?, ?)',
+                         (key, path, len(data), time.time(),
+                          sqlite3.Binary(data)))
+            self._evict(conn)
+
+    def _evict(self, conn):
+        entry_count, byte_count = conn.execute(
+            'SELECT entry_count, byte_count FROM totals').fetchone()
+        if entry_count <= self.max_entries and byte_count <= self.max_bytes:
+            return
+        doomed = []
+        cursor = conn.execute('SELECT key, size FROM entries'
+                              ' ORDER BY accessed')
+        for key, size in cursor:
+            if entry_count <= self.max_entries \
+                    and byte_count <= self.max_bytes:
+                break
+            doomed.append((key,))
+            entry_count -= 1
+            byte_count -= size
+        cursor.close()
+        conn.executemany('DELETE FROM entries WHERE key = ?', doomed)
+
+    def claim(self, key, timeout):
+        """
+        Returns True if the caller may refresh *key*, which it then
+        holds for up to *timeout* seconds, or until release(), against
+        every process sharing the cache.
+        """
+        now = time.time()
+        conn = self._get_conn()
+        key = sqlite3.Binary(key)
+        with self._transaction(conn):
+            row = conn.execute('SELECT expires FROM claims WHERE key = ?',
+                               (key,)).fetchone()
+            if row is not None and row[0] > now:
+                return False
+            conn.execute('INSERT OR REPLACE INTO claims VALUES (?, ?)',
+                         (key, now + timeout))
+        return True
+
+    def release(self, key):
+        self._get_conn().execute('DELETE FROM claims WHERE key = ?',
+                                 (sqlite3.Binary(key),))
+
+    def purge(self, path=None):
+        conn = self._get_conn()
+        with self._transaction(conn):
+            if path is None:
+                conn.execute('DELETE FROM entries')
+                conn.execute('DELETE FROM claims')
+            else:
+                conn.execute('DELETE FROM entries WHERE path = ?', (path,))
+
+    def get_stats(self):
+        entry_count, byte_count = self._get_conn().execute(
+            'SELECT entry_count, byte_count FROM totals').fetchone()
+        return {'size': entry_count,
+                'max_size': self.max_entries,
+                'byte_count': byte_count,
+                'max_bytes': self.max_bytes,
+                'hit_count': self.hit_count,
+                'miss_count': self.miss_count}
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return '%s(%r, max_bytes=%r)' % (cn, self.path, self.max_bytes)
+
+
+class ResponseCacheMiddleware(Middleware):
+    """
+    Caches full responses to GET and HEAD requests, keyed by method,
+    path, query string and the request headers named in the
+    response's Vary header.
+
+    Responses are fresh for *ttl* seconds, which can be overridden
+    per route pattern with *route_ttls* (a TTL of 0 disables caching
+    for that route). For *stale_ttl* seconds after that, one request
+    at a time refreshes the entry, while concurrent requests are
+    answered with the stale response.
+
+    Only non-streamed responses with cacheable statuses and at most
+    *max_entry_bytes* of body are stored, and never ones which set
+    cookies, are marked private or no-store, or vary on everything.
+    Requests with an Authorization header bypass the cache, as do
+    those with cookies, which may carry a session the response was
+    built from, except on routes with patterns in
+    *cookie_route_patterns*. Those routes' responses are shared
+    between every requester, unless they vary on Cookie. Call purge()
+    to drop entries for a path, or the whole cache.
+    """
+    def __init__(self, ttl=DEFAULT_TTL, route_ttls=None, stale_ttl=0,
+                 max_entry_bytes=DEFAULT_MAX_ENTRY_BYTES,
+                 methods=('GET', 'HEAD'), backend=None, refresh_timeout=30,
+                 cookie_route_patterns=()):
+        self.ttl = ttl
+        self.route_ttls = dict(route_ttls or {})
+        self.cookie_route_patterns = frozenset(cookie_route_patterns)
+        self.stale_ttl = stale_ttl
+        self.max_entry_bytes = max_entry_bytes
+        self.methods = frozenset(methods)
+        self.refresh_timeout = refresh_timeout
+        if backend is None:
+            backend = MemoryCacheBackend()
+        self.backend = backend
+        self.hit_count = self.stale_count = self.miss_count = 0
+        self.store_count = 0
+
+    def request(self, next, request, _route):
+        if request.method not in self.methods \
+                or 'HTTP_AUTHORIZATION' in request.environ:
+            return next()
+        if 'HTTP_COOKIE' in request.environ \
+                and _route.pattern not in self.cookie_route_patterns:
+            return next()
+        ttl = self.route_ttls.get(_route.pattern, self.ttl)
+        if not ttl:
+            return next()
+
+        backend = self.backend
+        base_key = self._get_base_key(request)
+        key, claimed = None, False
+        vary_names = backend.get('vary:' + base_key)
+        if vary_names is not None:
+            key = self._get_key(base_key, vary_names, request)
+            entry = backend.get(key)
+            if entry is not None:
+                now = time.time()
+                if now < entry.expires:
+                    self.hit_count += 1
+                    return self._make_response(entry, now)
+                if now < entry.stale_until:
+                    claimed = backend.claim(key, self.refresh_timeout)
+                    if not claimed:  # someone else is refreshing it
+                        self.stale_count += 1
+                        return self._make_response(entry, now)
+        self.miss_count += 1
+        try:
+            resp = next()
+            self._store(request, base_key, resp, ttl)
+        finally:
+            if claimed:
+                backend.release(key)
+        return resp
+
+    def purge(self, path=None):
+        "Drops all cached responses for *path*, or everything."
+        self.backend.purge(path)
+
+    def get_stats(self):
+        ret = {'hit_count': self.hit_count,
+               'stale_count': self.stale_count,
+               'miss_count': self.miss_count,
+               'store_count': self.store_count}
+        backend_stats = getattr(self.backend, 'get_stats', None)
+        if backend_stats:
+            ret['backend'] = backend_stats()
+        return ret
+
+    def _get_base_key(self, request):
+        query = request.environ.get('QUERY_STRING', '')
+        path = request.path.encode('utf-8')
+        return '%s %s?%s' % (request.method, path, query)
+
+    def _get_key(self, base_key, vary_names, request):
+        parts = [base_key]
+        for item in get_vary_items(request.environ, vary_names):
+            parts.append('%s=%s' % item)
+        return '\n'.join(parts)
+
+    def _store(self, request, base_key, resp, ttl):
+        if resp.status_code not in CACHEABLE_STATUSES or resp.is_streamed:
+            return
+        if 'Set-Cookie' in resp.headers:
+            return
+        cache_control = parse_cache_control_header(
+            resp.headers.get('Cache-Control'), cls=ResponseCacheControl)
+        if cache_control.no_store or cache_control.private:
+            return
+        vary_names = get_vary_names(resp)
+        if '*' in vary_names:
+            return
+        body = resp.get_data()
+        if len(body) > self.max_entry_bytes:
+            return
+        now = time.time()
+        entry = CacheEntry(resp.status_code,
+                           resp.headers.to_wsgi_list(),
+                           body,
+                           now,
+                           now + ttl,
+                           now + ttl + self.stale_ttl)
+        path = request.path
+        key = self._get_key(base_key, vary_names, request)
+        self.backend.set('vary:' + base_key, tuple(vary_names), path)
+        self.backend.set(key, entry, path)
+        self.store_count += 1
+
+    def _make_response(self, entry, now):
+        resp = Response(entry.body, status=entry.status,
+                        headers=entry.headers)
+        resp.headers['Age'] = str(int(now - entry.created))
+        return resp
@@ -1,52 +1,227 @@
 # -*- coding: utf-8 -*-
 
 import time
+import itertools
+from copy import deepcopy
+from math import floor, ceil
+from threading import Lock
 from collections import namedtuple
 
-from application import Application
-from middleware import Middleware
-from render import render_basic
+from werkzeug.wrappers import Response
+
+from ..application import Application
+from ..render import render_basic
+from ..statsutils import (HitRing, LogHistogram, RollingWindow,
+                          BucketCounter, TopKCounter, SharedStats)
+from .core import Middleware
 
 # TODO: what are some sane-default intervals?
 
-Hit = namedtuple('Hit', 'start_time url pattern status_code '
-                 ' elapsed_time content_type')
+DEFAULT_MAX_HITS = 10000
+DEFAULT_MAX_URLS = 1000
+DEFAULT_TOP_URL_COUNT = 20
+# (name, length in seconds, slot count)
+DEFAULT_WINDOWS = (('1m', 60, 12),
+                   ('5m', 300, 10),
+                   ('1h', 3600, 12))
+# the Prometheus client libraries' defaults, in seconds
+DEFAULT_LATENCY_BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                          1.0, 2.5, 5.0, 10.0)
+DEFAULT_SIZE_BOUNDS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+Hit = namedtuple('Hit', 'start_time pattern status_code elapsed_time')
 
 
 class StatsMiddleware(Middleware):
-    def __init__(self):
-        self.hits = []
-        self.route_hits = {}
-        self.url_hits = {}
+    """
+    Records the status and timing of every request. The most recent
+    *max_hits* hits are kept in a HitRing, and every hit's elapsed
+    time is added to a LogHistogram per route pattern and status, so
+    memory use stays constant however long the process runs.
+
+    Request counts per URL path are kept by a TopKCounter, which only
+    tracks the *max_urls* most frequent paths, so that IDs in URLs or
+    floods of 404s can't grow it without bound.
+
+    Recent request rates, error rates (5xx responses and unhandled
+    exceptions) and latencies per route pattern are kept in a
+    RollingWindow for each of *windows*, and combined for the overall
+    figures when they're read.
+
+    For metrics exports (see create_metrics_app()), latencies are also
+    counted into BucketCounters with fixed *latency_bounds*, and
+    response sizes, where known, into ones with *size_bounds*. The
+    number of requests in progress is kept in in_flight.
+
+    A server with several worker processes can pass a SharedStats as
+    *shared* (or True, for an anonymous one made with this
+    middleware's bounds, shared with processes forked afterward). The
+    per-route histograms, BucketCounters and in-flight count are then
+    kept there instead, so that any worker reports host-wide figures.
+    Hits, top URLs and windows stay per-process.
+    """
+    def __init__(self, max_hits=DEFAULT_MAX_HITS, max_urls=DEFAULT_MAX_URLS,
+                 windows=DEFAULT_WINDOWS,
+                 latency_bounds=DEFAULT_LATENCY_BOUNDS,
+                 size_bounds=DEFAULT_SIZE_BOUNDS, shared=None):
+        self.hit_ring = HitRing(max_hits)
+        self.patterns, self._pattern_idxs = [], {}
+        self.statuses, self._status_idxs = [], {}
+        self.route_stats = {}  # (pattern idx, status idx) -> LogHistogram
+        self.url_counter = TopKCounter(max_urls)
+        self.window_specs = tuple(windows)
+        # never added to, these only hold the start time for the totals
+        self.windows = self._make_windows()
+        self.route_windows = {}  # pattern idx -> RollingWindows
+        self.latency_bounds = tuple(latency_bounds)
+        self.size_bounds = tuple(size_bounds)
+        self.latency_counters = {}  # (pattern idx, status idx) -> counter
+        self.size_counters = {}  # pattern idx -> BucketCounter
+        self.in_flight = 0
+        if shared is True:
+            shared = SharedStats(self.latency_bounds, self.size_bounds)
+        elif shared and (shared.latency_bounds, shared.size_bounds) != \
+                (tuple(sorted(self.latency_bounds)),
+                 tuple(sorted(self.size_bounds))):
+            raise ValueError('expected SharedStats with the same bounds as'
+                             ' the StatsMiddleware, not %r' % shared)
+        self.shared = shared or None
+        self._lock = Lock()
 
     def request(self, next, request, _route):
+        if self.shared is not None:
+            self.shared.add_in_flight(1)
+        with self._lock:
+            self.in_flight += 1
         start_time = time.time()
+        resp_size = None
         try:
             resp = next()
             resp_status = repr(getattr(resp, 'status_code', type(resp)))
-            resp_mime_type = resp.content_type.partition(';')[0]
+            resp_size = getattr(resp, 'content_length', None)
         except Exception as e:
             # see Werkzeug #388
             resp_status = repr(getattr(e, 'code', type(e)))
-            resp_mime_type = getattr(e, 'content_type', '').partition(';')[0]
             raise
         finally:
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            hit = Hit(start_time,
-                      request.path,
-                      _route.rule,
-                      resp_status,
-                      elapsed_time,
-                      resp_mime_type)
-            self.hits.append(hit)
-            self.route_hits.setdefault(_route, []).append(hit)
-            self.url_hits.setdefault(request.path, []).append(hit)
+            elapsed_time = time.time() - start_time
+            self._record(start_time, elapsed_time, request.path,
+                         _route.pattern, resp_status, resp_size)
         return resp
 
+    def _record(self, start_time, elapsed_time, path, pattern, status,
+                resp_size=None):
+        shared = self.shared
+        if shared is not None:
+            shared.add(pattern, status, elapsed_time, resp_size)
+            shared.add_in_flight(-1)
+        with self._lock:
+            self.in_flight -= 1
+            pattern_idx = self._pattern_idxs.get(pattern)
+            if pattern_idx is None:
+                pattern_idx = self._pattern_idxs[pattern] = len(self.patterns)
+                self.patterns.append(pattern)
+            status_idx = self._status_idxs.get(status)
+            if status_idx is None:
+                status_idx = self._status_idxs[status] = len(self.statuses)
+                self.statuses.append(status)
+            self.hit_ring.append(start_time, elapsed_time,
+                                 status_idx, pattern_idx)
+            if shared is None:
+                self._add_counters(pattern_idx, status_idx,
+                                   elapsed_time, resp_size)
+            self.url_counter.add(path)
+            try:
+                route_windows = self.route_windows[pattern_idx]
+            except KeyError:
+                route_windows = self.route_windows[pattern_idx] = \
+                    self._make_windows()
+            is_error = not status.isdigit() or int(status) >= 500
+            now = start_time + elapsed_time
+            for window in route_windows:
+                window.add(elapsed_time, is_error, now)
 
-from math import floor, ceil
-import itertools
+    def _add_counters(self, pattern_idx, status_idx, elapsed_time,
+                      resp_size):
+        key = (pattern_idx, status_idx)
+        try:
+            self.route_stats[key].add(elapsed_time)
+        except KeyError:
+            self.route_stats[key] = LogHistogram()
+            self.route_stats[key].add(elapsed_time)
+            self.latency_counters[key] = BucketCounter(self.latency_bounds)
+        self.latency_counters[key].add(elapsed_time)
+        if resp_size is not None:
+            try:
+                self.size_counters[pattern_idx].add(resp_size)
+            except KeyError:
+                size_counter = BucketCounter(self.size_bounds)
+                size_counter.add(resp_size)
+                self.size_counters[pattern_idx] = size_counter
+
+    def get_counters(self):
+        """
+        Returns a snapshot of the per-route counters, from the
+        SharedStats if there is one, as a dict mapping (pattern,
+        status) to a LogHistogram and a latency BucketCounter, a dict
+        mapping patterns to response size BucketCounters, and the
+        number of requests in flight.
+        """
+        if self.shared is not None:
+            route_counters, size_counters = {}, {}
+            for key, (hist, latencies, sizes) \
+                    in self.shared.get_route_stats().items():
+                route_counters[key] = (hist, latencies)
+                if not sizes.count:
+                    continue
+                try:
+                    size_counters[key[0]].merge(sizes)
+                except KeyError:
+                    size_counters[key[0]] = sizes
+            return route_counters, size_counters, self.shared.in_flight
+        route_counters, size_counters = {}, {}
+        with self._lock:
+            for key, hist in self.route_stats.items():
+                pattern_idx, status_idx = key
+                route_key = (self.patterns[pattern_idx],
+                             self.statuses[status_idx])
+                route_counters[route_key] = (
+                    deepcopy(hist), deepcopy(self.latency_counters[key]))
+            for pattern_idx, counter in self.size_counters.items():
+                size_counters[self.patterns[pattern_idx]] = deepcopy(counter)
+            return route_counters, size_counters, self.in_flight
+
+    def _make_windows(self):
+        return tuple([RollingWindow(length, slot_count)
+                      for _, length, slot_count in self.window_specs])
+
+    def get_window_stats(self, now=None):
+        """
+        Returns RollingWindow stats by window name, for all requests
+        ('all'), and for each route pattern ('routes').
+        """
+        names = [name for name, _, _ in self.window_specs]
+        with self._lock:
+            all_windows = self.route_windows.values()
+            ret = {'all': {}, 'routes': {}}
+            for i, name in enumerate(names):
+                others = [route_windows[i] for route_windows in all_windows]
+                ret['all'][name] = self.windows[i].get_stats(now, others)
+            for pattern_idx, route_windows in self.route_windows.items():
+                pattern = self.patterns[pattern_idx]
+                ret['routes'][pattern] = dict(
+                    [(name, window.get_stats(now)) for name, window
+                     in zip(names, route_windows)])
+        return ret
+
+    def get_hits(self):
+        "Returns the most recent hits as a list of Hits, oldest first."
+        patterns, statuses = self.patterns, self.statuses
+        with self._lock:
+            return [Hit(start_time, patterns[route_idx],
+                        statuses[status_idx], elapsed_time)
+                    for start_time, elapsed_time, status_idx, route_idx
+                    in self.hit_ring]
 
 
 def hits_minutes_ago(hit_list, minutes=None):
@@ -88,32 +263,138 @@ def float_round(n):
     return n - (n % 2 ** -6)
 
 
-def get_route_stats(rt_hits):
+def get_route_stats(stats_mw):
+    """
+    Returns timing stats in milliseconds per route pattern and status,
+    read off the histograms, so the cost doesn't grow with traffic.
+    """
     ret = {}
-    hbs = hits_by_status(rt_hits)
-    for status, hits in hbs.items():
-        ret[status] = cur = {}
-        durs = [round(h.elapsed_time * 1000, 2) for h in hits]
-        cur['min'] = min(durs)
-        cur['max'] = max(durs)
-        cur['mean'] = mean(durs)
-        cur['count'] = len(durs)
-        cur['median'] = percentile(durs, 50)
-        cur['ninefive'] = percentile(durs, 95)
+    route_counters = stats_mw.get_counters()[0]
+    for (pattern, status), (hist, _) in route_counters.items():
+        ret.setdefault(pattern, {})[status] = get_hist_stats(hist)
     return ret
 
 
+def get_hist_stats(hist):
+    to_ms = lambda val: round(val * 1000, 2)
+    return {'min': to_ms(hist.min),
+            'max': to_ms(hist.max),
+            'mean': to_ms(hist.mean),
+            'count': hist.count,
+            'median': to_ms(hist.get_percentile(50)),
+            'ninefive': to_ms(hist.get_percentile(95)),
+            'ninenine': to_ms(hist.get_percentile(99)),
+            'ninenineninine': to_ms(hist.get_percentile(99.9))}
+
+
+def _find_stats_mw(application):
+    for mw in application.middlewares:
+        if isinstance(mw, StatsMiddleware):
+            return mw
+    return None
+
+
 def _get_stats_dict(_application):
-    try:
-        stats_mw = [mw for mw in _application.middlewares
-                    if isinstance(mw, StatsMiddleware)][0]
-    except IndexError:
+    stats_mw = _find_stats_mw(_application)
+    if stats_mw is None:
         return {'error': "StatsMiddleware doesn't seem to be installed"}
-    rt_hits = stats_mw.route_hits
-    return {'resp_counts': dict([(url, len(rh)) for url, rh
-                                 in stats_mw.url_hits.items()]),
-            'route_stats': dict([(rt.rule, get_route_stats(rh)) for rt, rh
-                                 in rt_hits.items() if rh])}
+    with stats_mw._lock:
+        resp_counts = stats_mw.url_counter.get_counts()
+        top_urls = stats_mw.url_counter.get_top(DEFAULT_TOP_URL_COUNT)
+    return {'resp_counts': resp_counts,
+            'top_urls': [{'url': url, 'count': count, 'max_error': error}
+                         for url, count, error in top_urls],
+            'route_stats': get_route_stats(stats_mw),
+            'windows': stats_mw.get_window_stats()}
+
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _prom_escape(value):
+    value = value.replace('\\', '\\\\').replace('\n', '\\n')
+    return value.replace('"', '\\"')
+
+
+def _prom_labels(labels):
+    return '{%s}' % ','.join(['%s="%s"' % (name, _prom_escape(value))
+                              for name, value in labels])
+
+
+def _prom_float(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _prom_bucket_lines(lines, name, labels, count, total, cumulative):
+    for bound, bound_count in cumulative:
+        bucket_labels = _prom_labels(labels + [('le', _prom_float(bound))])
+        lines.append('%s_bucket%s %s' % (name, bucket_labels, bound_count))
+    lines.append('%s_sum%s %s' % (name, _prom_labels(labels),
+                                  _prom_float(total)))
+    lines.append('%s_count%s %s' % (name, _prom_labels(labels), count))
+
+
+def get_prometheus_text(stats_mw, prefix='clastic'):
+    """
+    Renders a StatsMiddleware's counters in the Prometheus text
+    exposition format. Everything comes from totals kept as requests
+    are recorded, so the cost depends only on the number of routes
+    and statuses seen. With a SharedStats, the totals cover every
+    worker process sharing it.
+    """
+    route_counters, size_counters, in_flight = stats_mw.get_counters()
+    latency_items = sorted([(key, latencies) for key, (_, latencies)
+                            in route_counters.items()])
+    lines = []
+    name = prefix + '_requests_total'
+    lines.append('# HELP %s Requests handled, by route and status.' % name)
+    lines.append('# TYPE %s counter' % name)
+    for (pattern, status), counter in latency_items:
+        labels = [('route', pattern), ('status', status)]
+        lines.append('%s%s %s' % (name, _prom_labels(labels), counter.count))
+
+    name = prefix + '_request_duration_seconds'
+    lines.append('# HELP %s Request latency, by route and status.' % name)
+    lines.append('# TYPE %s histogram' % name)
+    for (pattern, status), counter in latency_items:
+        labels = [('route', pattern), ('status', status)]
+        _prom_bucket_lines(lines, name, labels, counter.count,
+                           counter.total, counter.iter_cumulative())
+
+    name = prefix + '_response_size_bytes'
+    lines.append('# HELP %s Response sizes, where known, by route.' % name)
+    lines.append('# TYPE %s histogram' % name)
+    for pattern, counter in sorted(size_counters.items()):
+        _prom_bucket_lines(lines, name, [('route', pattern)], counter.count,
+                           counter.total, counter.iter_cumulative())
+
+    name = prefix + '_requests_in_flight'
+    lines.append('# HELP %s Requests currently being handled.' % name)
+    lines.append('# TYPE %s gauge' % name)
+    lines.append('%s %s' % (name, in_flight))
+    lines.append('')
+    return '\n'.join(lines).encode('utf-8')
+
+
+def create_metrics_app(stats_mw=None, prefix='clastic'):
+    """
+    Returns an Application which serves *stats_mw*'s counters in the
+    Prometheus text format, for mounting wherever the scraper expects,
+    e.g., SubApplication('/metrics', create_metrics_app(stats_mw)).
+    Without *stats_mw*, the StatsMiddleware installed on the
+    application the routes are bound to is used.
+    """
+    def get_metrics(_application):
+        cur_stats_mw = stats_mw or _find_stats_mw(_application)
+        if cur_stats_mw is None:
+            return Response("# StatsMiddleware doesn't seem to be"
+                            " installed\n", status=404,
+                            content_type=PROMETHEUS_CONTENT_TYPE)
+        return Response(get_prometheus_text(cur_stats_mw, prefix),
+                        content_type=PROMETHEUS_CONTENT_TYPE)
+    return Application([('/', get_metrics)])
 
 
 def _create_app():
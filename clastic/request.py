@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+A slimmer alternative to werkzeug's full Request, for applications
+where per-request overhead matters more than the long tail of request
+attributes. To use it, set it as an application's ``request_type``::
+
+  class JSONApplication(Application):
+      request_type = LightRequest
+
+LightRequest uses ``__slots__``, so there's no instance dictionary,
+and everything beyond the WSGI environ (path, query args, form data,
+cookies, headers, accept headers, etc.) is parsed the first time it's
+accessed, then kept in a slot. The exception is the path, which
+dispatch always needs. Parsing is done with the same werkzeug
+functions the full Request uses, so the values are the same.
+
+Unlike werkzeug's Request, it does not add itself to the environ
+under ``werkzeug.request``, and it does not support arbitrary
+attribute assignment.
+"""
+
+from cStringIO import StringIO
+
+from werkzeug.http import (parse_accept_header,
+                           parse_authorization_header,
+                           parse_cache_control_header,
+                           parse_cookie,
+                           parse_date,
+                           parse_etags,
+                           parse_options_header)
+from werkzeug.urls import url_decode
+from werkzeug.formparser import FormDataParser, default_stream_factory
+from werkzeug.wsgi import (get_current_url,
+                           get_host,
+                           get_input_stream,
+                           get_content_length)
+from werkzeug.datastructures import (MultiDict,
+                                     CombinedMultiDict,
+                                     EnvironHeaders,
+                                     ImmutableMultiDict,
+                                     ImmutableTypeConversionDict,
+                                     ImmutableList,
+                                     MIMEAccept,
+                                     CharsetAccept,
+                                     LanguageAccept,
+                                     RequestCacheControl,
+                                     iter_multi_items)
+
+
+def _decode_environ(value, charset, errors):
+    # WSGI environ values are bytestrings, decoded the same way
+    # werkzeug's Request does
+    return value.decode(charset, errors)
+
+
+class lazy_slot(object):
+    """
+    Like werkzeug's cached_property, but for classes with
+    ``__slots__``. The computed value is stored in the slot named
+    after the property, with a leading underscore.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+        self.slot_name = '_' + func.__name__
+
+    def __get__(self, obj, obj_type=None):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.slot_name)
+        except AttributeError:
+            ret = self.func(obj)
+            setattr(obj, self.slot_name, ret)
+            return ret
+
+
+class LightRequest(object):
+    __slots__ = ('environ', 'path', 'path_params', '_cached_data',
+                 '_script_root', '_full_path',
+                 '_url', '_base_url', '_url_root', '_host_url', '_host',
+                 '_stream', '_args', '_form', '_files', '_values',
+                 '_cookies', '_headers', '_access_route', '_content_length',
+                 '_accept_mimetypes', '_accept_charsets',
+                 '_accept_encodings', '_accept_languages',
+                 '_cache_control', '_if_match', '_if_none_match',
+                 '_if_modified_since', '_if_unmodified_since',
+                 '_user_agent', '_authorization', '__weakref__')
+
+    charset = 'utf-8'
+    encoding_errors = 'replace'
+    max_content_length = None
+    max_form_memory_size = None
+    trusted_hosts = None
+    parameter_storage_class = ImmutableMultiDict
+    dict_storage_class = ImmutableTypeConversionDict
+    list_storage_class = ImmutableList
+    form_data_parser_class = FormDataParser
+
+    def __init__(self, environ):
+        self.environ = environ
+        self.path_params = None
+        # dispatch always reads the path, so it's not worth deferring
+        raw_path = _decode_environ(environ.get('PATH_INFO') or '',
+                                   self.charset, self.encoding_errors)
+        self.path = '/' + raw_path.lstrip('/')
+
+    def __repr__(self):
+        try:
+            args = "'%s' [%s]" % (self.url, self.method)
+        except Exception:
+            args = '(invalid WSGI environ)'
+        return '<%s %s>' % (self.__class__.__name__, args)
+
+    @property
+    def url_charset(self):
+        return self.charset
+
+    @property
+    def method(self):
+        return self.environ.get('REQUEST_METHOD', 'GET').upper()
+
+    @property
+    def query_string(self):
+        return self.environ.get('QUERY_STRING', '')
+
+    @property
+    def scheme(self):
+        return self.environ.get('wsgi.url_scheme')
+
+    @property
+    def is_secure(self):
+        return self.environ['wsgi.url_scheme'] == 'https'
+
+    @property
+    def is_xhr(self):
+        requested_with = self.environ.get('HTTP_X_REQUESTED_WITH', '')
+        return requested_with.lower() == 'xmlhttprequest'
+
+    @property
+    def remote_addr(self):
+        return self.environ.get('REMOTE_ADDR')
+
+    @property
+    def content_type(self):
+        return self.environ.get('CONTENT_TYPE')
+
+    @property
+    def mimetype(self):
+        content_type = self.environ.get('CONTENT_TYPE', '')
+        return parse_options_header(content_type)[0].lower()
+
+    @lazy_slot
+    def script_root(self):
+        raw_path = _decode_environ(self.environ.get('SCRIPT_NAME') or '',
+                                   self.charset, self.encoding_errors)
+        return raw_path.rstrip('/')
+
+    @lazy_slot
+    def full_path(self):
+        return self.path + u'?' + self.query_string.decode(self.url_charset)
+
+    @lazy_slot
+    def url(self):
+        return get_current_url(self.environ,
+                               trusted_hosts=self.trusted_hosts)
+
+    @lazy_slot
+    def base_url(self):
+        return get_current_url(self.environ, strip_querystring=True,
+                               trusted_hosts=self.trusted_hosts)
+
+    @lazy_slot
+    def url_root(self):
+        return get_current_url(self.environ, True,
+                               trusted_hosts=self.trusted_hosts)
+
+    @lazy_slot
+    def host_url(self):
+        return get_current_url(self.environ, host_only=True,
+                               trusted_hosts=self.trusted_hosts)
+
+    @lazy_slot
+    def host(self):
+        return get_host(self.environ, trusted_hosts=self.trusted_hosts)
+
+    @lazy_slot
+    def access_route(self):
+        environ = self.environ
+        if 'HTTP_X_FORWARDED_FOR' in environ:
+            addrs = environ['HTTP_X_FORWARDED_FOR'].split(',')
+            return self.list_storage_class([a.strip() for a in addrs])
+        elif 'REMOTE_ADDR' in environ:
+            return self.list_storage_class([environ['REMOTE_ADDR']])
+        return self.list_storage_class()
+
+    @lazy_slot
+    def content_length(self):
+        return get_content_length(self.environ)
+
+    @lazy_slot
+    def headers(self):
+        return EnvironHeaders(self.environ)
+
+    @lazy_slot
+    def cookies(self):
+        return parse_cookie(self.environ, self.charset, self.encoding_errors,
+                            cls=self.dict_storage_class)
+
+    @lazy_slot
+    def args(self):
+        return url_decode(self.query_string, self.url_charset,
+                          errors=self.encoding_errors,
+                          cls=self.parameter_storage_class)
+
+    # request body
+
+    @lazy_slot
+    def stream(self):
+        return get_input_stream(self.environ)
+
+    def _load_form_data(self):
+        try:
+            self._form
+            return  # already parsed, and the stream consumed
+        except AttributeError:
+            pass
+        environ = self.environ
+        content_type = environ.get('CONTENT_TYPE')
+        if content_type:
+            mimetype, options = parse_options_header(content_type)
+            parser = self.form_data_parser_class(default_stream_factory,
+                                                 self.charset,
+                                                 self.encoding_errors,
+                                                 self.max_form_memory_size,
+                                                 self.max_content_length,
+                                                 self.parameter_storage_class)
+            try:
+                stream = StringIO(self._cached_data)
+            except AttributeError:
+                stream = self.stream
+            data = parser.parse(stream, mimetype,
+                                get_content_length(environ), options)
+        else:
+            data = (self.stream, self.parameter_storage_class(),
+                    self.parameter_storage_class())
+        self._stream, self._form, self._files = data
+
+    @property
+    def form(self):
+        self._load_form_data()
+        return self._form
+
+    @property
+    def files(self):
+        self._load_form_data()
+        return self._files
+
+    @lazy_slot
+    def values(self):
+        dicts = []
+        for d in (self.args, self.form):
+            if not isinstance(d, MultiDict):
+                d = MultiDict(d)
+            dicts.append(d)
+        return CombinedMultiDict(dicts)
+
+    def get_data(self, cache=True, as_text=False, parse_form_data=False):
+        try:
+            ret = self._cached_data
+        except AttributeError:
+            if parse_form_data:
+                self._load_form_data()
+            ret = self.stream.read()
+            if cache:
+                self._cached_data = ret
+        if as_text:
+            ret = ret.decode(self.charset, self.encoding_errors)
+        return ret
+
+    @property
+    def data(self):
+        return self.get_data(parse_form_data=True)
+
+    def close(self):
+        for key, value in iter_multi_items(getattr(self, '_files', ())):
+            value.close()
+
+    # parsed headers
+
+    @lazy_slot
+    def accept_mimetypes(self):
+        return parse_accept_header(self.environ.get('HTTP_ACCEPT'),
+                                   MIMEAccept)
+
+    @lazy_slot
+    def accept_charsets(self):
+        return parse_accept_header(self.environ.get('HTTP_ACCEPT_CHARSET'),
+                                   CharsetAccept)
+
+    @lazy_slot
+    def accept_encodings(self):
+        return parse_accept_header(self.environ.get('HTTP_ACCEPT_ENCODING'))
+
+    @lazy_slot
+    def accept_languages(self):
+        return parse_accept_header(self.environ.get('HTTP_ACCEPT_LANGUAGE'),
+                                   LanguageAccept)
+
+    @lazy_slot
+    def cache_control(self):
+        return parse_cache_control_header(
+            self.environ.get('HTTP_CACHE_CONTROL'), None, RequestCacheControl)
+
+    @lazy_slot
+    def if_match(self):
+        return parse_etags(self.environ.get('HTTP_IF_MATCH'))
+
+    @lazy_slot
+    def if_none_match(self):
+        return parse_etags(self.environ.get('HTTP_IF_NONE_MATCH'))
+
+    @lazy_slot
+    def if_modified_since(self):
+        return parse_date(self.environ.get('HTTP_IF_MODIFIED_SINCE'))
+
+    @lazy_slot
+    def if_unmodified_since(self):
+        return parse_date(self.environ.get('HTTP_IF_UNMODIFIED_SINCE'))
+
+    @lazy_slot
+    def user_agent(self):
+        from werkzeug.useragents import UserAgent
+        return UserAgent(self.environ)
+
+    @lazy_slot
+    def authorization(self):
+        return parse_authorization_header(
+            self.environ.get('HTTP_AUTHORIZATION'))
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
 import re
+from types import FunctionType
 
-from .sinter import inject, get_arg_names, getargspec
+from .sinter import inject, get_arg_names, getargspec, _VERBOSE
+from .utils import LRU
 from .errors import NotFound, MethodNotAllowed
 from .middleware import (check_middlewares,
                          merge_middlewares,
-                         make_middleware_chain)
+                         make_middleware_chain,
+                         ChainTimings)
+from .middleware.client_cache import ConditionalMiddleware
 
 
 _REQUEST_BUILTINS = ('request', '_application', '_route', '_dispatch_state')
@@ -44,8 +48,10 @@ BINDING = re.compile(r'<'
 _FLOAT_PATTERN = r'[+-]?\ *(\d+(\.\d*)?|\.\d+)([eE][+-]?\d+)?'
 _INT_PATTERN = r'[+-]?\ *[0-9]+'
 _STR_PATTERN = r'[^/]+'
+# builtin patterns, which never match a slash
+_SEGMENT_PATTERNS = (_INT_PATTERN, _FLOAT_PATTERN, _STR_PATTERN)
 
-_SEG_TMPL = '(?P<{name}>({sep}{pattern}){arity})'
+_SEG_TMPL = '(?P<{name}>({sep}({pattern})){arity})'
 _PATH_SEG_TMPL = '(?P<%s>(/[^/]+)%s)'
 _OP_ARITY_MAP = {'': False,  # whether or not an op is "multi"
                  '?': False,
@@ -104,6 +110,7 @@ def collapse_token(text, token=None, sub=None):
 def _compile_path_pattern(pattern, mode=S_REWRITE):
     processed = []
     var_converter_map = {}
+    bindings = []
 
     if not pattern.startswith('/'):
         raise InvalidPattern('URL path patterns must start with a forward'
@@ -139,6 +146,7 @@ def _compile_path_pattern(pattern, mode=S_REWRITE):
             _tmpl = 'unknown arity operator %r, expected one of %r'
             raise InvalidPattern(_tmpl % (op, _OP_ARITY_MAP.keys()))
         var_converter_map[name] = build_converter(cur_conv, multi=multi)
+        bindings.append((name, cur_conv, cur_patt, op))
 
         path_seg_pattern = _SEG_TMPL.format(name=name,
                                             sep=sep,
@@ -152,7 +160,87 @@ def _compile_path_pattern(pattern, mode=S_REWRITE):
     if mode != S_STRICT:
         full_pattern += '/*'
     regex = re.compile(full_pattern + '$')
-    return regex, var_converter_map
+    matcher = _compile_path_matcher(regex, bindings)
+    return regex, var_converter_map, matcher
+
+
+_MATCHER_TMPL = \
+'''
+def match_path(path, _match=regex.match{conv_args}):
+    match = _match(path)
+    if match is None:
+        return None
+    {group_vars} = match.group({group_idxs})
+    try:
+        return {{{conv_items}}}
+    except (KeyError, TypeError, ValueError):
+        return None
+'''
+
+_STATIC_MATCHER_TMPL = \
+'''
+def match_path(path, _match=regex.match):
+    if _match(path) is None:
+        return None
+    return {}
+'''
+
+
+# generated source -> match_path's code, reused for routes of the same
+# shape, which only differ in their default arguments. Only the code is
+# kept, so no route's regex or converters are, and the LRU bounds it
+# for applications which keep generating new shapes.
+_MATCHER_CACHE = LRU(1024)
+
+
+def _compile_path_matcher(regex, bindings, verbose=_VERBOSE):
+    """
+    Generates a match_path() function specialized for a single
+    route. Matches are picked out of the regex by group number, and
+    each value is passed straight to its converter, equivalent to (but
+    cheaper than) calling build_converter()'s converters on groupdict().
+    """
+    defaults = (regex.match,) + tuple([b[1] for b in bindings])
+    if not bindings:
+        code_str = _STATIC_MATCHER_TMPL
+        namespace = {'regex': regex}
+    else:
+        namespace = {'regex': regex}
+        group_idxs, conv_items = [], []
+        for i, (name, conv, patt, op) in enumerate(bindings):
+            conv_name, var_name = '_conv%s' % i, '_g%s' % i
+            namespace[conv_name] = conv
+            group_idx = regex.groupindex[name]
+            if _OP_ARITY_MAP[op]:
+                # multi: the whole group, leading separators and all
+                expr = ("[{conv}(v) for v in {var}.split('/')[1:]]")
+            else:
+                # single: the inner group, without the separator
+                group_idx += 2
+                if op == '?':
+                    expr = "{conv}({var} or '')"
+                elif patt in _SEGMENT_PATTERNS:
+                    expr = '{conv}({var})'
+                else:
+                    expr = "{conv}({var}.replace('/', ''))"
+            group_idxs.append(str(group_idx))
+            conv_items.append('%r: %s' % (name, expr.format(conv=conv_name,
+                                                            var=var_name)))
+        group_vars = ', '.join(['_g%s' % i for i in range(len(bindings))])
+        conv_args = ''.join([', _conv%s=_conv%s' % (i, i)
+                             for i in range(len(bindings))])
+        code_str = _MATCHER_TMPL.format(conv_args=conv_args,
+                                        group_vars=group_vars,
+                                        group_idxs=', '.join(group_idxs),
+                                        conv_items=', '.join(conv_items))
+    code = _MATCHER_CACHE.get(code_str)
+    if code is None:
+        if verbose:
+            print code_str  # pragma: nocover
+        exec compile(code_str, '<string>', 'single') in namespace
+        code = _MATCHER_CACHE[code_str] = namespace['match_path'].func_code
+    # the body only refers to its arguments and builtins
+    return FunctionType(code, globals(), 'match_path', defaults)
 
 
 def normalize_path(path, is_branch):
@@ -179,8 +267,8 @@ class BaseRoute(object):
     def _compile(self):
         # maybe: if not getattr(self, 'regex', None) or \
         #          self.regex.pattern != self.pattern:
-        self.regex, self.converters = _compile_path_pattern(self.pattern,
-                                                            self.slash_mode)
+        compiled = _compile_path_pattern(self.pattern, self.slash_mode)
+        self.regex, self.converters, self._match_path = compiled
         self.path_args = self.converters.keys()
         if self.methods:
             unknown_methods = list(self.methods - HTTP_METHODS)
@@ -195,17 +283,7 @@ class BaseRoute(object):
         return self.pattern.endswith('/')
 
     def match_path(self, path):
-        ret = {}
-        match = self.regex.match(path)
-        if not match:
-            return None
-        groups = match.groupdict()
-        try:
-            for conv_name, conv in self.converters.items():
-                ret[conv_name] = conv(groups[conv_name])
-        except (KeyError, TypeError, ValueError):
-            return None
-        return ret
+        return self._match_path(path)
 
     def match_method(self, method):
         if method and self.methods:
@@ -220,6 +298,18 @@ class BaseRoute(object):
         kwargs['request'] = request
         return inject(self._execute, kwargs)
 
+    def dispatch_execute(self, request, dispatch_state, path_params,
+                         resources):
+        """
+        Called by BaseApplication.dispatch() once the route has matched,
+        with the application's *resources*. Subclasses can skip building
+        the full keyword arguments for execute() by overriding this.
+        """
+        kwargs = dict(resources)
+        kwargs['_dispatch_state'] = dispatch_state
+        kwargs.update(path_params)
+        return self.execute(request, **kwargs)
+
     def iter_routes(self):
         yield self
 
@@ -246,6 +336,28 @@ def _noop_render(context):
     return context
 
 
+def _make_shared_chain(chain_cache, chain_args):
+    """
+    Compiled chains only depend on their arguments, so while an
+    application is adding a batch of routes, it passes a *chain_cache*
+    for routes with the same middlewares, endpoint, render function
+    and provided arguments to share one chain. Instrumented chains
+    each record into their own route's ChainTimings, so aren't shared.
+    """
+    middlewares, endpoint, render, provided, flat, timings = chain_args
+    if chain_cache is None or timings is not None:
+        return make_middleware_chain(*chain_args)
+    # each cached chain refers to, and so keeps alive, what it was keyed
+    # by, so the ids can't be reused while the cache is
+    key = (tuple([id(mw) for mw in middlewares]), id(endpoint),
+           id(render), frozenset(provided), flat)
+    try:
+        return chain_cache[key]
+    except KeyError:
+        chain = chain_cache[key] = make_middleware_chain(*chain_args)
+        return chain
+
+
 def check_render_error(render_error, resources):
     re_avail_args = set(_REQUEST_BUILTINS) | set(resources)
     re_avail_args.add('_error')
@@ -259,30 +371,58 @@ def check_render_error(render_error, resources):
 
 
 class Route(BaseRoute):
+    """
+    A Route can take an *etag_func* and/or *last_modified_func*,
+    injected like the endpoint, which are checked against conditional
+    requests before the endpoint runs. See ConditionalMiddleware.
+
+    If the application it's bound to has instrument_chains set, the
+    route's chain_timings is a ChainTimings, recording the time spent
+    in each middleware, the endpoint and the render function.
+    """
     def __init__(self, pattern, endpoint, render=None,
                  render_error=None, **kwargs):
         self._middlewares = list(kwargs.pop('middlewares', []))
         self._resources = dict(kwargs.pop('resources', []))
+        etag_func = kwargs.pop('etag_func', None)
+        last_modified_func = kwargs.pop('last_modified_func', None)
+        self._conditional_mw = None
+        if etag_func is not None or last_modified_func is not None:
+            self._conditional_mw = ConditionalMiddleware(etag_func,
+                                                         last_modified_func)
         super(Route, self).__init__(pattern, endpoint, **kwargs)
 
         self._bound_apps = []
         self.endpoint_args = get_arg_names(endpoint)
 
         self._execute = None
+        self._chain_args = None
+        self._injectables = None
+        self._route_injectables = None
         self._render = None
         self._render_factory = None
+        self.chain_timings = None
         self.render_arg = render
         if callable(self.render_arg):
             self._render = self.render_arg
         self._render_error = render_error
 
     def execute(self, request, **kwargs):
-        injectables = {'_route': self,
-                       'request': request,
-                       '_application': self._bound_apps[-1]}
-        injectables.update(self._resources)
+        injectables = dict(self._injectables, request=request)
         injectables.update(kwargs)
-        return inject(self._execute, injectables)
+        return inject(self._execute or self._compile_chain(), injectables)
+
+    def dispatch_execute(self, request, dispatch_state, path_params,
+                         resources):
+        # the application's *resources* may have changed since bind
+        # time, so they're copied in as they are now, and then the
+        # route's own resources and builtins
+        injectables = dict(resources)
+        injectables.update(self._route_injectables)
+        injectables['request'] = request
+        injectables['_dispatch_state'] = dispatch_state
+        injectables.update(path_params)
+        return inject(self._execute or self._compile_chain(), injectables)
 
     def render_error(self, request, _error, **kwargs):
         if not callable(self._render_error):
@@ -324,6 +464,11 @@ class Route(BaseRoute):
             render_error = self._render_error
 
         merged_mw = merge_middlewares(self._middlewares, middlewares)
+        conditional_mw = self._conditional_mw
+        if conditional_mw is not None:
+            # innermost, so that e.g. auth middlewares still run first
+            merged_mw = [mw for mw in merged_mw if mw is not conditional_mw]
+            merged_mw.append(conditional_mw)
 
         params = {'app': app,
                   'resources': dict(self._resources, **resources),
@@ -331,19 +476,19 @@ class Route(BaseRoute):
                   'render_factory': render_factory,
                   'render_error': render_error}
 
-        # test a copy of the route before making any changes, for extra safety
-        r_copy = self.empty()
-        if inherit_slashes:
-            r_copy.slash_mode = app.slash_mode
-        r_copy._bind_args(**params)
-        r_copy._compile()
-        # if none of the above raised an exception, we're golden
-
-        if inherit_slashes:
-            self.slash_mode = app.slash_mode
+        # _bind_args() does all its checking before it changes anything,
+        # so a route which fails to bind is left as it was
         self._bind_args(**params)
-        self._compile()
+        if inherit_slashes and self.slash_mode != app.slash_mode:
+            self.slash_mode = app.slash_mode
+            self._compile()
         self._bound_apps += (app,)
+        self._injectables = dict(self._resources,
+                                 _route=self,
+                                 _application=app)
+        self._route_injectables = dict([(k, v) for k, v
+                                        in self._injectables.items()
+                                        if k not in resources])
         return self
 
     def _bind_args(self, app, resources, middlewares,
@@ -364,7 +509,16 @@ class Route(BaseRoute):
             _render = self._render
         else:
             _render = _noop_render
-        _execute = make_middleware_chain(middlewares, self.endpoint, _render, provided)
+        chain_timings = None
+        if getattr(app, 'instrument_chains', False):
+            chain_timings = ChainTimings()
+        chain_args = (middlewares, self.endpoint, _render, provided,
+                      getattr(app, 'flat_chains', False), chain_timings)
+        if getattr(app, 'lazy_chains', False):
+            _execute = None  # see _compile_chain()
+        else:
+            _execute = _make_shared_chain(getattr(app, '_chain_cache', None),
+                                          chain_args)
 
         if callable(render_error):
             check_render_error(render_error, resources)
@@ -375,6 +529,20 @@ class Route(BaseRoute):
         self._render = _render
         self._render_error = render_error
         self._execute = _execute
+        self._chain_args = chain_args
+        self.chain_timings = chain_timings
+
+    def _compile_chain(self):
+        """
+        With lazy_chains enabled on the application, the middleware
+        chain is built the first time the route executes, rather than
+        at bind time. This makes startup cheaper, but endpoint
+        arguments nothing provides aren't reported until then either.
+        Concurrent first requests may each build a chain, but the
+        results are equivalent.
+        """
+        self._execute = make_middleware_chain(*self._chain_args)
+        return self._execute
 
     def get_info(self):
         ret = {}
@@ -4,6 +4,8 @@ import re
 import types
 import inspect
 from inspect import ArgSpec
+from functools import partial
+from weakref import WeakKeyDictionary
 
 _VERBOSE = False
 _INDENT = '    '
@@ -40,6 +42,14 @@ def get_arg_names(f, only_required=False):
 
 
 def inject(f, injectables):
+    try:
+        injector = get_injector(f)
+    except TypeError:
+        injector = _inject_uncached
+    return injector(f, injectables)
+
+
+def _inject_uncached(f, injectables):
     arg_names, _, kw_name, defaults = getargspec(f)
     defaults = dict(reversed(zip(reversed(arg_names),
                                  reversed(defaults or []))))
@@ -52,6 +62,75 @@ def inject(f, injectables):
     return f(**kwargs)
 
 
+# function -> injector, kept separate for bound methods, which
+# are recreated on every attribute access, so key on their im_func
+_FUNC_INJECTORS = WeakKeyDictionary()
+_METHOD_INJECTORS = WeakKeyDictionary()
+
+
+def get_injector(f):
+    """
+    Returns a function which, called as ``injector(f, injectables)``,
+    is equivalent to ``inject(f, injectables)``, but with the
+    argspec work done ahead of time. Injectors are cached per function
+    (or per underlying function, for bound methods). Raises TypeError
+    for callables which can't be cached, like callable objects.
+    """
+    if isinstance(f, types.FunctionType):
+        cache, key = _FUNC_INJECTORS, f
+    elif isinstance(f, types.MethodType) and f.im_self is not None:
+        cache, key = _METHOD_INJECTORS, f.im_func
+    else:
+        raise TypeError('can only cache injectors for functions and'
+                        ' bound methods, not %r' % (f,))
+    try:
+        return cache[key]
+    except KeyError:
+        pass
+    ret = cache[key] = compile_injector(getargspec(f))
+    return ret
+
+
+def compile_injector(argspec, verbose=_VERBOSE):
+    """
+    Generates an injector for functions with the given argspec, which
+    picks exactly the arguments it needs out of the injectables
+    mapping. If a required argument is missing, it falls back to
+    _inject_uncached(), so that the same TypeError is raised.
+    """
+    arg_names, _, kw_name, defaults = argspec
+    if kw_name:
+        return _inject_kwargs
+    defaults = defaults or ()
+    def_offs = len(arg_names) - len(defaults)
+    namespace = {'_inject_uncached': _inject_uncached}
+    lines, call_args = [], []
+    for i, arg in enumerate(arg_names):
+        if i < def_offs:
+            lines.append('%s_a%s = _injectables[%r]\n' % (_INDENT * 2, i, arg))
+            call_args.append('%s=_a%s' % (arg, i))
+        else:
+            namespace['_d%s' % i] = defaults[i - def_offs]
+            call_args.append('%s=_injectables.get(%r, _d%s)' % (arg, arg, i))
+    def_args = ''.join([', _d%s=_d%s' % (i, i)
+                        for i in range(def_offs, len(arg_names))])
+    code_str = 'def injector(_f, _injectables%s):\n' % def_args
+    if lines:
+        code_str += _INDENT + 'try:\n' + ''.join(lines)
+        code_str += _INDENT + 'except KeyError:\n'
+        code_str += _INDENT * 2 + 'return _inject_uncached(_f, _injectables)\n'
+    code_str += _INDENT + 'return _f(%s)\n' % ', '.join(call_args)
+    if verbose:
+        print code_str
+    exec compile(code_str, '<string>', 'single') in namespace
+    return namespace['injector']
+
+
+def _inject_kwargs(f, injectables):
+    # any defaults not in injectables are filled in by the call itself
+    return f(**injectables)
+
+
 def chain_argspec(func_list, provides):
     provided_sofar = set(['next'])  # 'next' is an extremely special case
     optional_sofar = set()
@@ -124,7 +203,93 @@ def compile_chain(funcs, params, verbose=_VERBOSE):
     return d['next']
 
 
-def make_chain(funcs, provides, final_func, preprovided):
+def _flat_slot_name(level, name):
+    return '_%s_%s' % (level, name)
+
+
+def build_flat_chain_str(funcs, params):
+    """
+    Like build_chain_str(), but instead of nesting one ``def next()``
+    per level, which creates a closure per level on every call, each
+    level's next is a module-level function, defined once when the
+    chain is compiled.
+
+    Arguments provided by outer levels and needed by inner ones are
+    passed down explicitly: a level's next is a functools.partial()
+    of the inner level's function, bound to just those values. Levels
+    which need nothing from further out get the plain function, so a
+    chain where no level does allocates nothing per call. Each value
+    is bound per providing level, so that if two levels provide the
+    same name, every level sees the same value it would with nested
+    closures. Nothing is kept outside of the call, so as with nested
+    closures, next() can be called from another thread, or after the
+    chain has returned.
+    """
+    level_count = len(funcs)
+    sofar = set(['next'])
+    providers = {}  # name -> level of the nearest provider
+    level_args = []  # (arg name, providing level) per level
+    for level in range(level_count):
+        sofar.update(params[level])
+        for name in params[level]:
+            providers[name] = level
+        level_args.append([(a, providers.get(a))
+                           for a in getargspec(funcs[level]).args
+                           if a in sofar])
+
+    # carried[level]: the (provider, name) values level's function
+    # takes from outer levels, for itself or for levels further in
+    carried = [set() for _ in range(level_count + 1)]
+    for level in reversed(range(level_count)):
+        carried[level].update([(p, n) for p, n in carried[level + 1]
+                               if p < level])
+        carried[level].update([(p, n) for n, p in level_args[level]
+                               if n != 'next' and p < level])
+    carried = [sorted(c) for c in carried]
+
+    def value_str(level, provider, name):
+        if provider == level:
+            return name
+        return _flat_slot_name(provider, name)
+
+    def call_str(level):
+        kwargs = []
+        for name, provider in level_args[level]:
+            if name != 'next':
+                value = value_str(level, provider, name)
+            elif carried[level + 1]:
+                value = '_partial(%s)' % ', '.join(
+                    ['_next_%s' % (level + 1)] +
+                    [value_str(level, p, n) for p, n in carried[level + 1]])
+            else:
+                value = '_next_%s' % (level + 1)
+            kwargs.append('%s=%s' % (name, value))
+        return 'return _f%s(%s)\n' % (level, ', '.join(kwargs))
+
+    lines = []
+    for level in range(1, level_count):
+        arg_names = [_flat_slot_name(p, n) for p, n in carried[level]]
+        arg_names.extend(params[level])
+        lines.append('def _next_%s(%s):\n' % (level, ', '.join(arg_names)))
+        lines.append(_INDENT + call_str(level) + '\n\n')
+    lines.append('def next(%s):\n' % ', '.join(params[0]))
+    lines.append(_INDENT + call_str(0))
+    return ''.join(lines)
+
+
+def compile_flat_chain(funcs, params, verbose=_VERBOSE):
+    params = [list(p) for p in params]
+    call_str = build_flat_chain_str(funcs, params)
+    code = compile(call_str, '<string>', 'exec')
+    if verbose:
+        print call_str
+    d = dict([('_f%s' % i, f) for i, f in enumerate(funcs)])
+    d['_partial'] = partial
+    exec code in d
+    return d['next']
+
+
+def make_chain(funcs, provides, final_func, preprovided, flat=False):
     funcs = list(funcs)
     provides = list(provides)
     preprovided = set(preprovided)
@@ -133,8 +298,9 @@ def make_chain(funcs, provides, final_func, preprovided):
 
     unresolved = tuple(reqs - preprovided)
     args = reqs | (preprovided & opts)
-    chain = compile_chain(funcs + [final_func],
-                          [args] + provides)
+    compiler = compile_flat_chain if flat else compile_chain
+    chain = compiler(funcs + [final_func],
+                     [args] + provides)
     return chain, set(args), set(unresolved)
 
 
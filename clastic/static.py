@@ -57,6 +57,16 @@ def get_file_mtime(path, rounding=0):
     return datetime.utcfromtimestamp(unix_mtime)
 
 
+def get_stat_etag(stat_result):
+    """
+    Builds an ETag from a file's stat() result, which changes whenever
+    the file is modified or replaced, without reading its contents.
+    """
+    return '%x-%x-%x' % (stat_result.st_ino,
+                         int(stat_result.st_mtime * 1000000),
+                         stat_result.st_size)
+
+
 class StaticApplication(Application):
     def __init__(self,
                  search_paths,
@@ -81,8 +91,7 @@ class StaticApplication(Application):
             if full_path is None:
                 raise NotFound()
             file_obj = open(full_path, 'rb')
-            mtime = get_file_mtime(full_path)
-            fsize = os.path.getsize(full_path)
+            stat_result = os.fstat(file_obj.fileno())
         except (ValueError, IOError, OSError):
             raise Forbidden()
         mimetype, encoding = mimetypes.guess_type(full_path)
@@ -94,11 +103,19 @@ class StaticApplication(Application):
             else:
                 mimetype = self.default_text_mime  # TODO: binary
 
+        mtime = datetime.utcfromtimestamp(round(stat_result.st_mtime))
+        fsize = stat_result.st_size
+        etag = get_stat_etag(stat_result)
+
         resp = Response('')
-        cached_mtime = request.if_modified_since
+        resp.set_etag(etag)
+        if 'HTTP_IF_NONE_MATCH' in request.environ:
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            not_modified = mtime == request.if_modified_since
         if self.cache_timeout:
             resp.cache_control.public = True
-            if mtime == cached_mtime:
+            if not_modified:
                 file_obj.close()
                 resp.status_code = 304
                 resp.cache_control.max_age = self.cache_timeout
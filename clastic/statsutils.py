@@ -0,0 +1,647 @@
+# -*- coding: utf-8 -*-
+"""
+Fixed-size data structures for collecting request statistics in
+long-running processes, where keeping every data point around isn't
+an option.
+"""
+
+import os
+import time
+import mmap
+import ctypes
+import threading
+from array import array
+from bisect import bisect_left
+from math import frexp, ldexp
+from multiprocessing import Lock as ProcessLock
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class HitRing(object):
+    """
+    A ring buffer of the last *size* hits, stored column-wise in
+    arrays rather than as one object per hit. Each hit is a start
+    time, an elapsed time, and two small integer indexes, for the
+    response status and the route, which the caller maps to values.
+    Once full, each new hit overwrites the oldest.
+    """
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError('expected size >= 1, not %r' % size)
+        self.size = size
+        self.start_times = array('d', [0.0]) * size
+        self.elapsed_times = array('d', [0.0]) * size
+        self.status_idxs = array('H', [0]) * size
+        self.route_idxs = array('H', [0]) * size
+        self.total_count = 0
+
+    def append(self, start_time, elapsed_time, status_idx, route_idx):
+        i = self.total_count % self.size
+        self.start_times[i] = start_time
+        self.elapsed_times[i] = elapsed_time
+        self.status_idxs[i] = status_idx
+        self.route_idxs[i] = route_idx
+        self.total_count += 1
+
+    def __len__(self):
+        return min(self.total_count, self.size)
+
+    def __iter__(self):
+        "Yields (start, elapsed, status_idx, route_idx), oldest first."
+        size, total_count = self.size, self.total_count
+        for j in xrange(total_count - len(self), total_count):
+            i = j % size
+            yield (self.start_times[i], self.elapsed_times[i],
+                   self.status_idxs[i], self.route_idxs[i])
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return '%s(size=%r)' % (cn, self.size)
+
+
+class LogHistogram(object):
+    """
+    A histogram with logarithmically-sized buckets, in the style of
+    HdrHistogram, for latencies and other positive values. Each power
+    of two between *min_value* and *max_value* is split into
+    *sub_buckets* equal buckets, so that values are recorded to within
+    a fixed relative error (about 3% with the default 32), whatever
+    their magnitude. Values outside the range are counted in the first
+    or last bucket.
+
+    Adding a value and getting any percentile both take constant time
+    and space, and histograms with the same bounds can be merged, for
+    instance to combine stats from several processes. The exact
+    count, total, minimum and maximum are kept too, except once values
+    have been subtract()ed, after which min and max are None.
+    """
+    def __init__(self, min_value=1e-6, max_value=3600.0, sub_buckets=32):
+        if not 0 < min_value < max_value:
+            raise ValueError('expected 0 < min_value < max_value, not %r, %r'
+                             % (min_value, max_value))
+        self.min_value = min_value
+        self.max_value = max_value
+        self.sub_buckets = sub_buckets
+        self._min_exp = frexp(min_value)[1]
+        exp_count = frexp(max_value)[1] - self._min_exp + 1
+        self.bucket_count = exp_count * sub_buckets
+        self.counts = array('L', [0]) * self.bucket_count
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def get_index(self, value):
+        if value < self.min_value:
+            return 0
+        mantissa, exp = frexp(value)  # 0.5 <= mantissa < 1
+        sub_buckets = self.sub_buckets
+        idx = ((exp - self._min_exp) * sub_buckets
+               + int((mantissa - 0.5) * 2 * sub_buckets))
+        return min(idx, self.bucket_count - 1)
+
+    def get_bounds(self, idx):
+        "Returns the (lower, upper) bounds of the values in bucket *idx*."
+        exp, sub_idx = divmod(idx, self.sub_buckets)
+        exp += self._min_exp
+        step = 0.5 / self.sub_buckets
+        return (ldexp(0.5 + sub_idx * step, exp),
+                ldexp(0.5 + (sub_idx + 1) * step, exp))
+
+    def add(self, value):
+        self.counts[self.get_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0.0
+        return self.total / self.count
+
+    def get_percentile(self, ptile):
+        """
+        Returns an estimate of the *ptile*-th percentile: the midpoint
+        of the bucket it falls in, clamped to the exact minimum and
+        maximum. Returns 0.0 if nothing has been added.
+        """
+        if not 0 <= ptile <= 100:
+            raise ValueError('expected 0 <= ptile <= 100, not %r' % ptile)
+        if not self.count:
+            return 0.0
+        min_val, max_val = self.min, self.max
+        if min_val is None:
+            start_idx, end_idx = 0, self.bucket_count - 1
+        elif ptile == 100:
+            return max_val  # even if it's out of range
+        else:
+            # only the buckets between the min and max can be occupied
+            start_idx = self.get_index(min_val)
+            end_idx = self.get_index(max_val)
+        target = max(1, ptile / 100.0 * self.count)
+        counts, seen = self.counts, 0
+        for idx in xrange(start_idx, end_idx + 1):
+            seen += counts[idx]
+            if seen >= target:
+                break
+        lower, upper = self.get_bounds(idx)
+        ret = (lower + upper) / 2.0
+        if min_val is None:
+            return ret
+        return min(max(ret, min_val), max_val)
+
+    def iter_buckets(self):
+        "Yields (upper bound, count) for every occupied bucket, in order."
+        counts = self.counts
+        for idx in xrange(self.bucket_count):
+            if counts[idx]:
+                yield self.get_bounds(idx)[1], counts[idx]
+
+    def merge(self, other):
+        "Adds the values from *other*, which must have the same bounds."
+        if (other.min_value, other.max_value, other.sub_buckets) != \
+                (self.min_value, self.max_value, self.sub_buckets):
+            raise ValueError('can only merge histograms with the same'
+                             ' bounds and sub_buckets')
+        if not other.count:
+            return
+        counts, other_counts = self.counts, other.counts
+        for idx in xrange(self.bucket_count):
+            if other_counts[idx]:
+                counts[idx] += other_counts[idx]
+        self.count += other.count
+        self.total += other.total
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+    def subtract(self, bucket_counts, total):
+        """
+        Removes values previously added, given as a mapping of bucket
+        index to count, and the values' *total*. The minimum and
+        maximum of what's left can't be known, so both become None.
+        """
+        counts = self.counts
+        for idx, count in bucket_counts.iteritems():
+            counts[idx] -= count
+            self.count -= count
+        self.total -= total
+        self.min = self.max = None
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return '%s(count=%r, mean=%r)' % (cn, self.count, self.mean)
+
+
+class RollingWindow(object):
+    """
+    The count, error count and latency distribution of requests over
+    the last *window* seconds, kept in *slot_count* time slots which
+    are recycled as they expire. The window moves a slot at a time,
+    so it covers between *window* less one slot and *window* seconds.
+
+    Each slot only keeps the histogram buckets its values fell in,
+    and expiring a slot subtracts those from the window's LogHistogram.
+    Adding a value and reading the rate, error rate or a percentile
+    all take constant time, however busy the window.
+    """
+    def __init__(self, window, slot_count=12, sub_buckets=16):
+        self.window = window
+        self.slot_count = slot_count
+        self.slot_seconds = float(window) / slot_count
+        self.hist = LogHistogram(sub_buckets=sub_buckets)
+        self.error_count = 0
+        self.start_time = time.time()
+        self._cur_slot_id = None
+        self._slot_counts = [0] * slot_count
+        self._slot_errors = [0] * slot_count
+        self._slot_totals = [0.0] * slot_count
+        self._slot_mins = [None] * slot_count
+        self._slot_maxes = [None] * slot_count
+        self._slot_buckets = [{} for i in xrange(slot_count)]
+
+    @property
+    def count(self):
+        return self.hist.count
+
+    def add(self, value, is_error=False, now=None):
+        if now is None:
+            now = time.time()
+        i = self._rotate(now)
+        hist = self.hist
+        idx = hist.get_index(value)
+        hist.counts[idx] += 1
+        hist.count += 1
+        hist.total += value
+        if hist.min is None or value < hist.min:
+            hist.min = value
+        if hist.max is None or value > hist.max:
+            hist.max = value
+        slot_buckets = self._slot_buckets[i]
+        slot_buckets[idx] = slot_buckets.get(idx, 0) + 1
+        if not self._slot_counts[i]:
+            self._slot_mins[i] = self._slot_maxes[i] = value
+        elif value < self._slot_mins[i]:
+            self._slot_mins[i] = value
+        elif value > self._slot_maxes[i]:
+            self._slot_maxes[i] = value
+        self._slot_counts[i] += 1
+        self._slot_totals[i] += value
+        if is_error:
+            self._slot_errors[i] += 1
+            self.error_count += 1
+
+    def _rotate(self, now):
+        slot_id = int(now // self.slot_seconds)
+        cur_slot_id = self._cur_slot_id
+        if cur_slot_id is not None and slot_id <= cur_slot_id:
+            # the current slot, or the clock went back; stay put
+            return cur_slot_id % self.slot_count
+        first_id = slot_id - self.slot_count + 1
+        if cur_slot_id is not None:
+            first_id = max(first_id, cur_slot_id + 1)
+        for expired_id in xrange(first_id, slot_id + 1):
+            self._clear_slot(expired_id % self.slot_count)
+        self._cur_slot_id = slot_id
+        return slot_id % self.slot_count
+
+    def _clear_slot(self, i):
+        if not self._slot_counts[i]:
+            return
+        self.hist.subtract(self._slot_buckets[i], self._slot_totals[i])
+        self.error_count -= self._slot_errors[i]
+        self._slot_counts[i] = self._slot_errors[i] = 0
+        self._slot_totals[i] = 0.0
+        self._slot_buckets[i] = {}
+        # the window's min and max are those of its remaining slots
+        counts = self._slot_counts
+        mins = [v for j, v in enumerate(self._slot_mins) if counts[j]]
+        maxes = [v for j, v in enumerate(self._slot_maxes) if counts[j]]
+        if mins:
+            self.hist.min, self.hist.max = min(mins), max(maxes)
+
+    def get_stats(self, now=None, others=()):
+        """
+        Returns the request count, rate (per second), error count and
+        error rate (as a fraction of requests), and the mean, median,
+        95th and 99th percentile latencies in milliseconds. Given
+        *others*, RollingWindows with the same settings, returns the
+        stats of them all combined.
+        """
+        if now is None:
+            now = time.time()
+        self._rotate(now)
+        hist, error_count = self.hist, self.error_count
+        if others:
+            hist = LogHistogram(sub_buckets=self.hist.sub_buckets)
+            hist.merge(self.hist)
+            for other in others:
+                other._rotate(now)
+                hist.merge(other.hist)
+                error_count += other.error_count
+        count = hist.count
+        covered = max(min(self.window, now - self.start_time),
+                      self.slot_seconds)
+        error_rate = 0.0
+        if count:
+            error_rate = round(float(error_count) / count, 4)
+        to_ms = lambda val: round(val * 1000, 2)
+        return {'count': count,
+                'rate': round(count / covered, 3),
+                'error_count': error_count,
+                'error_rate': error_rate,
+                'mean': to_ms(hist.mean),
+                'median': to_ms(hist.get_percentile(50)),
+                'ninefive': to_ms(hist.get_percentile(95)),
+                'ninenine': to_ms(hist.get_percentile(99))}
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return '%s(window=%r, slot_count=%r)' % (cn, self.window,
+                                                 self.slot_count)
+
+
+class BucketCounter(object):
+    """
+    Counts values into a fixed set of buckets, by the upper *bounds*
+    given, the way a Prometheus histogram does, along with their count
+    and total. Values above the last bound go in an overflow bucket.
+    """
+    def __init__(self, bounds):
+        self.bounds = tuple(sorted(bounds))
+        self.counts = array('L', [0]) * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def iter_cumulative(self):
+        """
+        Yields (bound, count of values <= bound) for each bound, and
+        finally (float('inf'), count).
+        """
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            yield bound, seen
+        yield float('inf'), self.count
+
+    def merge(self, other):
+        "Adds the values from *other*, which must have the same bounds."
+        if other.bounds != self.bounds:
+            raise ValueError('can only merge counters with the same bounds')
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return '%s(%r)' % (cn, self.bounds)
+
+
+class TopKCounter(object):
+    """
+    Approximately counts the most frequent of an unbounded stream of
+    keys, such as URL paths, in fixed memory, using the Space-Saving
+    algorithm. At most *capacity* keys are tracked. When a new key
+    arrives at a full counter, it replaces the key with the lowest
+    count, and inherits that count (recorded as its error).
+
+    Any key seen more than total_count / capacity times is guaranteed
+    to be tracked, and a tracked key's count overestimates its true
+    count by at most its error. Adding a key takes constant time.
+    """
+    def __init__(self, capacity=1000):
+        if capacity < 1:
+            raise ValueError('expected capacity >= 1, not %r' % capacity)
+        self.capacity = capacity
+        self.total_count = 0
+        self._counts = {}
+        self._errors = {}
+        self._buckets = {}  # count -> set of keys with that count
+        self._min_count = 0
+
+    def add(self, key):
+        self.total_count += 1
+        counts, buckets = self._counts, self._buckets
+        count = counts.get(key)
+        if count is not None:
+            bucket = buckets[count]
+            bucket.discard(key)
+            if not bucket:
+                del buckets[count]
+        elif len(counts) < self.capacity:
+            count = self._errors[key] = 0
+        else:
+            count = self._min_count
+            min_bucket = buckets[count]
+            evicted = min_bucket.pop()
+            if not min_bucket:
+                del buckets[count]
+            del counts[evicted]
+            del self._errors[evicted]
+            self._errors[key] = count
+        count += 1
+        counts[key] = count
+        try:
+            buckets[count].add(key)
+        except KeyError:
+            buckets[count] = set([key])
+        if count == 1 or self._min_count not in buckets:
+            self._min_count = count
+
+    def get_top(self, k=None):
+        "Returns (key, count, error) for the *k* highest counts."
+        errors = self._errors
+        top = sorted(self._counts.items(), key=lambda kc: kc[1],
+                     reverse=True)[:k]
+        return [(key, count, errors[key]) for key, count in top]
+
+    def get_counts(self):
+        return dict(self._counts)
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return '%s(capacity=%r)' % (cn, self.capacity)
+
+
+_SHARED_MAGIC = 'CLSTATS1'
+_PATTERN_SIZE = 256
+_STATUS_SIZE = 64
+
+
+class _SharedHeader(ctypes.Structure):
+    _fields_ = [('magic', ctypes.c_char * 8),
+                ('slot_size', ctypes.c_uint32),
+                ('max_slots', ctypes.c_uint32),
+                ('slot_count', ctypes.c_uint32),
+                ('in_flight', ctypes.c_int64),
+                ('overflow_count', ctypes.c_uint64)]
+
+
+def _make_slot_type(latency_bounds, size_bounds, bucket_count):
+    class _SharedSlot(ctypes.Structure):
+        _fields_ = [('pattern', ctypes.c_char * _PATTERN_SIZE),
+                    ('status', ctypes.c_char * _STATUS_SIZE),
+                    ('count', ctypes.c_uint64),
+                    ('total', ctypes.c_double),
+                    ('min', ctypes.c_double),
+                    ('max', ctypes.c_double),
+                    ('latency_counts',
+                     ctypes.c_uint64 * (len(latency_bounds) + 1)),
+                    ('size_count', ctypes.c_uint64),
+                    ('size_total', ctypes.c_double),
+                    ('size_counts', ctypes.c_uint64 * (len(size_bounds) + 1)),
+                    ('hist_counts', ctypes.c_uint64 * bucket_count)]
+    return _SharedSlot
+
+
+class SharedStats(object):
+    """
+    Per-route request counters and histograms in a shared memory map,
+    so that every worker process on a host records into, and can
+    report on, the same totals. Each (route pattern, status) pair gets
+    a slot, up to *max_slots*, holding a LogHistogram's buckets, plus
+    those of BucketCounters with *latency_bounds* and *size_bounds*.
+    Hits for pairs beyond that are only counted in overflow_count.
+
+    Without a *path*, the map is anonymous, and is shared with
+    processes forked after it's created, such as the workers of
+    Application.serve(processes=N). With a *path*, any process opening
+    the same file shares it. Updates are made under a lock: a
+    multiprocessing Lock for anonymous maps, and an fcntl lock (plus a
+    thread lock) on the file otherwise.
+    """
+    def __init__(self, latency_bounds, size_bounds, path=None,
+                 max_slots=256):
+        self.path = path
+        self.max_slots = max_slots
+        self.latency_bounds = tuple(sorted(latency_bounds))
+        self.size_bounds = tuple(sorted(size_bounds))
+        self._hist_layout = LogHistogram()
+        self._slot_type = _make_slot_type(self.latency_bounds,
+                                          self.size_bounds,
+                                          self._hist_layout.bucket_count)
+        slot_size = ctypes.sizeof(self._slot_type)
+        header_size = ctypes.sizeof(_SharedHeader)
+        map_size = header_size + slot_size * max_slots
+
+        if path is None:
+            self._fd = None
+            self._map = mmap.mmap(-1, map_size)
+            self._process_lock = ProcessLock()
+        else:
+            if fcntl is None:
+                raise ValueError('file-backed SharedStats need fcntl')
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+            if os.fstat(self._fd).st_size < map_size:
+                os.ftruncate(self._fd, map_size)
+            self._map = mmap.mmap(self._fd, map_size)
+            self._process_lock = None
+        self._thread_lock = threading.Lock()
+        self._header = _SharedHeader.from_buffer(self._map)
+        self._slots = (self._slot_type * max_slots).from_buffer(self._map,
+                                                                header_size)
+        self._slot_idxs = {}  # this process's cache of key -> slot index
+        with self._locked():
+            header = self._header
+            if header.magic != _SHARED_MAGIC:
+                header.magic = _SHARED_MAGIC
+                header.slot_size = slot_size
+                header.max_slots = max_slots
+            elif (header.slot_size, header.max_slots) != (slot_size,
+                                                          max_slots):
+                raise ValueError('%r was created with different settings'
+                                 % path)
+
+    def _locked(self):
+        return _SharedLockContext(self)
+
+    def _get_slot(self, pattern, status):
+        # called under the lock
+        key = (pattern, status)
+        try:
+            return self._slots[self._slot_idxs[key]]
+        except KeyError:
+            pass
+        header, slots = self._header, self._slots
+        for i in xrange(header.slot_count):  # maybe another process's
+            if slots[i].pattern == pattern and slots[i].status == status:
+                self._slot_idxs[key] = i
+                return slots[i]
+        if header.slot_count >= self.max_slots:
+            return None
+        i = header.slot_count
+        slots[i].pattern, slots[i].status = pattern, status
+        header.slot_count += 1
+        self._slot_idxs[key] = i
+        return slots[i]
+
+    def add(self, pattern, status, elapsed_time, resp_size=None):
+        pattern = _encode_field(pattern, _PATTERN_SIZE)
+        status = _encode_field(status, _STATUS_SIZE)
+        with self._locked():
+            slot = self._get_slot(pattern, status)
+            if slot is None:
+                self._header.overflow_count += 1
+                return
+            if not slot.count or elapsed_time < slot.min:
+                slot.min = elapsed_time
+            if not slot.count or elapsed_time > slot.max:
+                slot.max = elapsed_time
+            slot.count += 1
+            slot.total += elapsed_time
+            slot.hist_counts[self._hist_layout.get_index(elapsed_time)] += 1
+            slot.latency_counts[bisect_left(self.latency_bounds,
+                                            elapsed_time)] += 1
+            if resp_size is not None:
+                slot.size_count += 1
+                slot.size_total += resp_size
+                slot.size_counts[bisect_left(self.size_bounds,
+                                             resp_size)] += 1
+
+    def add_in_flight(self, delta):
+        with self._locked():
+            self._header.in_flight += delta
+
+    @property
+    def in_flight(self):
+        return self._header.in_flight
+
+    @property
+    def overflow_count(self):
+        return self._header.overflow_count
+
+    def get_route_stats(self):
+        """
+        Returns a snapshot of every slot, as a dict mapping (pattern,
+        status) to a tuple of a LogHistogram, and BucketCounters for
+        latencies and response sizes.
+        """
+        ret = {}
+        with self._locked():
+            for i in xrange(self._header.slot_count):
+                slot = self._slots[i]
+                hist = LogHistogram()
+                hist.counts = array('L', slot.hist_counts)
+                hist.count, hist.total = slot.count, slot.total
+                if slot.count:
+                    hist.min, hist.max = slot.min, slot.max
+                latencies = BucketCounter(self.latency_bounds)
+                latencies.counts = array('L', slot.latency_counts)
+                latencies.count, latencies.total = slot.count, slot.total
+                sizes = BucketCounter(self.size_bounds)
+                sizes.counts = array('L', slot.size_counts)
+                sizes.count, sizes.total = slot.size_count, slot.size_total
+                key = (slot.pattern.decode('utf-8', 'replace'),
+                       slot.status.decode('utf-8', 'replace'))
+                ret[key] = (hist, latencies, sizes)
+        return ret
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return '%s(path=%r, max_slots=%r)' % (cn, self.path,
+                                              self.max_slots)
+
+
+class _SharedLockContext(object):
+    def __init__(self, shared):
+        self.shared = shared
+
+    def __enter__(self):
+        shared = self.shared
+        if shared._process_lock is not None:
+            shared._process_lock.acquire()
+        else:
+            # fcntl locks only exclude other processes
+            shared._thread_lock.acquire()
+            fcntl.lockf(shared._fd, fcntl.LOCK_EX)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        shared = self.shared
+        if shared._process_lock is not None:
+            shared._process_lock.release()
+        else:
+            fcntl.lockf(shared._fd, fcntl.LOCK_UN)
+            shared._thread_lock.release()
+
+
+def _encode_field(value, size):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value[:size - 1]
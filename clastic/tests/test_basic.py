@@ -4,9 +4,11 @@ from __future__ import unicode_literals
 from nose.tools import raises, eq_, ok_
 
 from werkzeug.test import Client
-from werkzeug.wrappers import BaseResponse
+from werkzeug.wrappers import BaseResponse, Response
 
-from clastic.application import Application
+from clastic import render_basic
+from clastic.application import Application, SubApplication, MountRoute
+from clastic.middleware import Middleware
 
 from common import hello_world, DummyMiddleware, RequestProvidesName
 
@@ -105,3 +107,71 @@ def test_subapplication_basic():
     yield eq_, resp.data, 'Hello, Kurt!'
     resp = Client(app, BaseResponse).get('/larp4lyfe/')
     yield eq_, resp.status_code, 404
+
+
+def test_subapplication_delegate():
+    dum1 = DummyMiddleware()
+    name_app = Application([('/', hello_world),
+                            ('/foo', hello_world),
+                            ('/root', lambda request: request.script_root,
+                             render_basic)],
+                           resources={'name': 'Rajkumar'},
+                           middlewares=[dum1])
+    app = Application([('/', hello_world),
+                       SubApplication('/beta/', name_app, delegate=True),
+                       ('/beta/dne', hello_world)],
+                      resources={'name': 'Kurt'})
+
+    yield eq_, len(app.routes), 3
+    yield eq_, app.routes[1].prefix, '/beta'
+    yield ok_, isinstance(app.routes[1], MountRoute)
+
+    client = Client(app, BaseResponse)
+    resp = client.get('/')
+    yield eq_, resp.data, 'Hello, Kurt!'
+    resp = client.get('/beta/')
+    yield eq_, resp.data, 'Hello, Rajkumar!'
+    resp = client.get('/beta/foo')
+    yield eq_, resp.data, 'Hello, Rajkumar!'
+    resp = client.get('/beta/root')
+    yield eq_, resp.data, '/beta'
+    resp = client.get('/beta')
+    yield eq_, resp.status_code, 302
+    resp = client.get('/beta/dne')
+    yield eq_, resp.status_code, 404  # the mount owns its prefix
+    resp = client.get('/betamax')
+    yield eq_, resp.status_code, 404
+
+    # delegated mounts survive being mounted again
+    outer_app = Application([('/alpha', app)])
+    resp = Client(outer_app, BaseResponse).get('/alpha/beta/foo')
+    yield eq_, resp.data, 'Hello, Rajkumar!'
+
+
+class KeyMiddleware(Middleware):
+    def request(self, next, request):
+        if request.args.get('key') != 'sesame':
+            return Response('no key', status=403)
+        return next()
+
+
+def test_subapplication_delegate_parent_mw():
+    name_app = Application([('/', hello_world),
+                            ('/root', lambda request: request.script_root,
+                             render_basic)],
+                           resources={'name': 'Rajkumar'})
+    app = Application([SubApplication('/beta/gamma', name_app,
+                                      delegate=True)],
+                      middlewares=[KeyMiddleware()])
+    client = Client(app, BaseResponse)
+    resp = client.get('/beta/gamma/')
+    yield eq_, resp.status_code, 403  # the parent's middlewares run first
+    resp = client.get('/beta/gamma/?key=sesame')
+    yield eq_, resp.data, 'Hello, Rajkumar!'
+    # slash runs are collapsed, the same as for regex routes
+    resp = client.get('/beta//gamma//root?key=sesame')
+    yield eq_, resp.data, '/beta/gamma'
+
+    outer_app = Application([('/alpha', app)])
+    resp = Client(outer_app, BaseResponse).get('/alpha/beta/gamma/')
+    yield eq_, resp.status_code, 403
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+from gzip import GzipFile
+from StringIO import StringIO
+
+from nose.tools import eq_, ok_, raises
+
+from werkzeug.http import http_date
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse, Response
+
+from clastic import Application, Route, POST
+from clastic.middleware import (Middleware, HTTPCacheMiddleware,
+                                GzipMiddleware)
+from clastic.middleware.client_cache import ConditionalMiddleware
+
+
+MODIFIED = datetime.datetime(2014, 1, 2, 3, 4, 5)
+
+
+class Counter(object):
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, name):
+        self.count += 1
+        return Response('hi %s' % name)
+
+
+class CountingMiddleware(Middleware):
+    def __init__(self):
+        self.count = 0
+
+    def request(self, next):
+        self.count += 1
+        return next()
+
+
+def test_etag_func():
+    counter = Counter()
+    outer_mw = CountingMiddleware()
+    versions = {'a': 'v1'}
+
+    def get_version(name, versions):
+        return versions.get(name)
+
+    app = Application([Route('/<name>', counter, etag_func=get_version),
+                       POST('/post/<name>', counter,
+                            etag_func=get_version)],
+                      resources={'versions': versions},
+                      middlewares=[outer_mw, HTTPCacheMiddleware()])
+    client = Client(app, BaseResponse)
+
+    resp = client.get('/a')
+    yield eq_, resp.status_code, 200
+    yield eq_, resp.headers['ETag'], '"v1"'
+    resp = client.get('/a', headers={'If-None-Match': '"v1"'})
+    yield eq_, resp.status_code, 304
+    yield eq_, resp.headers['ETag'], '"v1"'
+    yield eq_, counter.count, 1  # the endpoint only ran once
+    yield eq_, outer_mw.count, 2  # but other middlewares still run
+
+    versions['a'] = 'v2'
+    resp = client.get('/a', headers={'If-None-Match': '"v1"'})
+    yield eq_, resp.status_code, 200
+    yield eq_, resp.headers['ETag'], '"v2"'
+
+    # no validator, so the body's etag is used
+    resp = client.get('/b')
+    yield ok_, resp.headers['ETag'] != '"None"'
+    resp = client.get('/b', headers={'If-None-Match': resp.headers['ETag']})
+    yield eq_, resp.status_code, 304
+    yield eq_, counter.count, 4
+
+    resp = client.post('/post/a', headers={'If-None-Match': '"v2"'})
+    yield eq_, resp.status_code, 200
+
+
+def test_last_modified_func():
+    counter = Counter()
+    app = Application([('/<name>', counter)])
+    app.add(Route('/lm/<name>', counter,
+                  last_modified_func=lambda: MODIFIED))
+    client = Client(app, BaseResponse)
+
+    resp = client.get('/lm/a')
+    yield eq_, resp.headers['Last-Modified'], http_date(MODIFIED)
+    resp = client.get('/lm/a',
+                      headers={'If-Modified-Since': http_date(MODIFIED)})
+    yield eq_, resp.status_code, 304
+    earlier = MODIFIED - datetime.timedelta(seconds=1)
+    resp = client.get('/lm/a',
+                      headers={'If-Modified-Since': http_date(earlier)})
+    yield eq_, resp.status_code, 200
+    # If-None-Match takes precedence, and there's no etag to match
+    resp = client.get('/lm/a',
+                      headers={'If-Modified-Since': http_date(MODIFIED),
+                               'If-None-Match': '"x"'})
+    yield eq_, resp.status_code, 200
+    yield eq_, counter.count, 3
+
+
+@raises(NameError)
+def test_validator_args():
+    Application([Route('/', lambda: 'hi', etag_func=lambda missing: 'v1')])
+
+
+@raises(ValueError)
+def test_no_validators():
+    ConditionalMiddleware()
+
+
+def test_stream_etags():
+    def stream():
+        resp = Response(iter(['streamed', ' body']))
+        resp.last_modified = MODIFIED
+        return resp
+
+    for stream_etags in (False, True):
+        app = Application([('/', stream)],
+                          middlewares=[HTTPCacheMiddleware(
+                              stream_etags=stream_etags)])
+        client = Client(app, BaseResponse)
+        resp = client.get('/')
+        yield eq_, resp.data, 'streamed body'
+        yield eq_, resp.headers.get('ETag'), None  # not known up front
+        resp = client.get('/')
+        yield eq_, resp.data, 'streamed body'
+        if not stream_etags:
+            yield eq_, resp.headers.get('ETag'), None
+            continue
+        etag = resp.headers['ETag']
+        resp = client.get('/', headers={'If-None-Match': etag})
+        yield eq_, resp.status_code, 304
+        yield eq_, resp.data, ''
+
+
+def test_dynamic_stream_etags():
+    counter = Counter()
+
+    def stream():
+        counter.count += 1
+        return Response(iter(['version %s' % counter.count]))
+
+    def sized_stream():
+        # the same length each time, so that can't tell versions apart
+        counter.count += 1
+        body = 'version %s' % (counter.count % 10)
+        resp = Response(iter([body]))
+        resp.content_length = len(body)
+        return resp
+
+    for endpoint in (stream, sized_stream):
+        counter.count = 0
+        app = Application([('/', endpoint)],
+                          middlewares=[GzipMiddleware(min_size=0),
+                                       HTTPCacheMiddleware(stream_etags=True)])
+        client = Client(app, BaseResponse)
+        for i in range(1, 4):
+            resp = client.get('/', headers={'Accept-Encoding': 'gzip'})
+            body = GzipFile(fileobj=StringIO(resp.data)).read()
+            yield eq_, body, 'version %s' % i
+            yield eq_, resp.headers.get('ETag'), None  # nothing to validate
+
+
+def test_stream_etags_vary():
+    def stream(request):
+        resp = Response(iter([request.headers.get('Accept-Language', '')]))
+        resp.last_modified = MODIFIED
+        resp.vary.add('Accept-Language')
+        return resp
+
+    app = Application([('/', stream)],
+                      middlewares=[HTTPCacheMiddleware(stream_etags=True)])
+    client = Client(app, BaseResponse)
+    etags = {}
+    for i in range(2):
+        for lang in ('en', 'fr'):
+            resp = client.get('/', headers={'Accept-Language': lang})
+            yield eq_, resp.data, lang
+            etags[lang] = resp.headers.get('ETag')
+    yield ok_, etags['en'] and etags['fr'] and etags['en'] != etags['fr']
+    resp = client.get('/', headers={'Accept-Language': 'fr',
+                                    'If-None-Match': etags['en']})
+    yield eq_, resp.status_code, 200
+    yield eq_, resp.data, 'fr'
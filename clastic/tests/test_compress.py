@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+
+from nose.tools import eq_, ok_
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse, Response
+
+from clastic import Application
+from clastic.middleware.compress import (GzipMiddleware,
+                                         compress,
+                                         iter_compress)
+
+
+BODY = ''.join(['line %s of a fairly compressible body\n' % i
+                for i in range(2000)])
+GZIP_HEADERS = {'Accept-Encoding': 'gzip'}
+
+
+def gunzip(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class ClosingIterable(object):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+def test_compress_funcs():
+    yield eq_, gunzip(compress(BODY)), BODY
+    chunks = list(iter_compress([BODY[:500], '', BODY[500:]], block_size=100))
+    yield ok_, len(chunks) > 2
+    yield eq_, gunzip(''.join(chunks)), BODY
+
+
+def test_gzip_sequence():
+    app = Application([('/', lambda: Response(BODY)),
+                       ('/tiny', lambda: Response('hi')),
+                       ('/304', lambda: Response(BODY, status=304))],
+                      middlewares=[GzipMiddleware()])
+    client = Client(app, BaseResponse)
+
+    resp = client.get('/', headers=GZIP_HEADERS)
+    yield eq_, resp.headers['Content-Encoding'], 'gzip'
+    yield eq_, int(resp.headers['Content-Length']), len(resp.data)
+    yield eq_, gunzip(resp.data), BODY
+
+    resp = client.get('/')
+    yield eq_, resp.headers.get('Content-Encoding'), None
+    yield eq_, resp.data, BODY
+
+    resp = client.get('/tiny', headers=GZIP_HEADERS)
+    yield eq_, resp.headers.get('Content-Encoding'), None
+    resp = client.get('/304', headers=GZIP_HEADERS)
+    yield eq_, resp.headers.get('Content-Encoding'), None
+
+
+def test_gzip_streamed():
+    body_iter = ClosingIterable([BODY[i:i + 1000]
+                                 for i in range(0, len(BODY), 1000)])
+
+    def stream():
+        resp = Response(body_iter)
+        resp.content_length = len(BODY)
+        resp.direct_passthrough = True
+        return resp
+
+    app = Application([('/', stream)],
+                      middlewares=[GzipMiddleware(block_size=4096)])
+    client = Client(app, BaseResponse)
+    resp = client.get('/', headers=GZIP_HEADERS)
+    yield eq_, resp.headers['Content-Encoding'], 'gzip'
+    yield eq_, resp.headers.get('Content-Length'), None
+    yield eq_, gunzip(resp.data), BODY
+    resp.close()
+    yield ok_, body_iter.closed
+
+
+def test_gzip_skips():
+    def image():
+        return Response(BODY, mimetype='image/png')
+
+    app = Application([('/img', image),
+                       ('/svg', lambda: Response(BODY,
+                                                 mimetype='image/svg+xml')),
+                       ('/small', lambda: Response(BODY[:100]))],
+                      middlewares=[GzipMiddleware(min_size=200)])
+    client = Client(app, BaseResponse)
+    resp = client.get('/img', headers=GZIP_HEADERS)
+    yield eq_, resp.headers.get('Content-Encoding'), None
+    resp = client.get('/svg', headers=GZIP_HEADERS)
+    yield eq_, resp.headers.get('Content-Encoding'), 'gzip'
+    resp = client.get('/small', headers=GZIP_HEADERS)
+    yield eq_, resp.headers.get('Content-Encoding'), None
+
+
+def test_gzip_cache():
+    def etagged():
+        resp = Response(iter([BODY]))
+        resp.set_etag('v1')
+        return resp
+
+    gzip_mw = GzipMiddleware()
+    app = Application([('/', lambda: Response(BODY)),
+                       ('/etag', etagged)],
+                      middlewares=[gzip_mw])
+    client = Client(app, BaseResponse)
+
+    for i in range(3):
+        resp = client.get('/', headers=GZIP_HEADERS)
+        yield eq_, gunzip(resp.data), BODY
+    stats = gzip_mw.get_stats()
+    yield eq_, (stats['hit_count'], stats['miss_count']), (2, 1)
+    yield eq_, stats['bytes_in'], 3 * len(BODY)
+    yield ok_, stats['bytes_saved'] > 2 * len(BODY)
+
+    resp = client.get('/etag', headers=GZIP_HEADERS)
+    yield eq_, resp.headers.get('Content-Length'), None  # streamed
+    yield eq_, gunzip(resp.data), BODY
+    resp = client.get('/etag', headers=GZIP_HEADERS)
+    yield eq_, int(resp.headers['Content-Length']), len(resp.data)
+    yield eq_, gunzip(resp.data), BODY
+    yield eq_, gzip_mw.get_stats()['hit_count'], 3
+
+    def weak_etagged():
+        resp = Response(iter(['weak body %s' % len(weak_bodies)]))
+        weak_bodies.append(resp)
+        resp.set_etag('v1', weak=True)
+        return resp
+
+    weak_bodies = []
+    weak_mw = GzipMiddleware(min_size=0)
+    app = Application([('/', weak_etagged)], middlewares=[weak_mw])
+    weak_client = Client(app, BaseResponse)
+    for i in range(3):
+        resp = weak_client.get('/', headers=GZIP_HEADERS)
+        yield eq_, gunzip(resp.data), 'weak body %s' % i
+    yield eq_, weak_mw.get_stats()['hit_count'], 0
+
+    no_cache_mw = GzipMiddleware(cache_bytes=0)
+    app = Application([('/', lambda: Response(BODY))],
+                      middlewares=[no_cache_mw])
+    resp = Client(app, BaseResponse).get('/', headers=GZIP_HEADERS)
+    yield eq_, gunzip(resp.data), BODY
+    yield eq_, no_cache_mw.get_stats()['hit_count'], 0
+
+
+def test_gzip_cache_variants():
+    def item(request):
+        body = BODY + request.args.get('p', '') + \
+            request.headers.get('Accept-Language', '')
+        resp = Response(iter([body]))
+        resp.set_etag('v3')  # the same etag for every variant
+        resp.vary.add('Accept-Language')
+        return resp
+
+    app = Application([('/items', item)], middlewares=[GzipMiddleware()])
+    client = Client(app, BaseResponse)
+    for i in range(2):
+        for query in ('p=1', 'p=2'):
+            for lang in ('en', 'fr'):
+                headers = dict(GZIP_HEADERS, **{'Accept-Language': lang})
+                resp = client.get('/items?' + query, headers=headers)
+                yield eq_, gunzip(resp.data), BODY + query[2:] + lang
+
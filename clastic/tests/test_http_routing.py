@@ -38,3 +38,23 @@ def test_http_method_routes():
     yield eq_, status_map[200], len(routes)
     yield eq_, status_map.get(405), len(routes) * (len(methods) - 1)
     return
+
+
+def test_allowed_methods():
+    ep = lambda _dispatch_state: repr(sorted(_dispatch_state.allowed_methods))
+    routes = [GET('/thing', ep, render_basic),
+              POST('/thing', ep, render_basic),
+              PUT('/thing/<thing_id>', ep, render_basic),
+              ('/<catch_all>', ep, render_basic)]
+    for use_trie in (False, True):
+        app = Application(routes, use_trie=use_trie)
+        client = Client(app, BaseResponse)
+        yield eq_, client.get('/thing').status_code, 200
+        yield eq_, client.put('/thing').status_code, 200
+        resp = client.delete('/thing/1')
+        yield eq_, resp.status_code, 405
+        yield eq_, app._get_allowed_methods('/thing/1', 'DELETE'), set(['PUT'])
+        resp = client.open('/thing/1', method='PURGE')
+        yield eq_, resp.status_code, 405
+        resp = client.get('/nothing/here')
+        yield eq_, resp.status_code, 404
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import unicode_literals
-from nose.tools import eq_, raises
 
-from werkzeug.test import Client
-from werkzeug.wrappers import BaseResponse
+import time
+import threading
 
-from clastic import Application
+from nose.tools import eq_, ok_, raises
+
+from werkzeug.test import Client, EnvironBuilder
+from werkzeug.wrappers import BaseResponse, Request
+
+from clastic import Application, MetaApplication, render_basic
 from clastic.middleware import Middleware, GetParamMiddleware
 from common import hello_world, hello_world_ctx, RequestProvidesName
 
@@ -72,3 +76,101 @@ def test_next_in_endpoint():
         return 'this endpoint is broke'
 
     Application([('/', nexter)])
+
+
+class RetryMiddleware(Middleware):
+    def request(self, next, request):
+        first = next()
+        return next() if first.status_code == 200 else first
+
+
+def test_flat_chains():
+    for flat in (False, True):
+        mws = [RetryMiddleware(), RequestProvidesName('Rajkumar'),
+               GetParamMiddleware(['date'])]
+        app = Application([('/', hello_world),
+                           ('/ctx', hello_world_ctx, render_basic)],
+                          middlewares=mws, flat_chains=flat)
+        c = Client(app, BaseResponse)
+        resp = c.get('/')
+        yield eq_, resp.data, 'Hello, Rajkumar!'
+        resp = c.get('/?name=Kurt')
+        yield eq_, resp.data, 'Hello, Kurt!'
+        resp = c.get('/ctx?name=Kurt')
+        yield ok_, 'Hello, Kurt!' in resp.data
+
+
+class SubrequestMiddleware(Middleware):
+    "Dispatches a request to /sub before each request to /."
+    def request(self, next, request, _application):
+        if request.path == '/':
+            sub_request = Request(EnvironBuilder('/sub').get_environ())
+            sub_resp = _application.dispatch(sub_request)
+            ret = next()
+            ret.data += ' / ' + sub_resp.data
+            return ret
+        return next()
+
+
+def test_flat_chain_reentry():
+    mws = [SubrequestMiddleware(), RequestProvidesName('Rajkumar')]
+    app = Application([('/', hello_world), ('/sub', hello_world)],
+                      middlewares=mws, flat_chains=True)
+    c = Client(app, BaseResponse)
+    resp = c.get('/?name=Kurt')
+    yield eq_, resp.data, 'Hello, Kurt! / Hello, Rajkumar!'
+
+
+class ThreadedMiddleware(Middleware):
+    "Calls next() from another thread, as a timeout wrapper might."
+    def request(self, next, request):
+        ret = []
+        thread = threading.Thread(target=lambda: ret.append(next()))
+        thread.start()
+        thread.join()
+        return ret[0]
+
+
+def test_flat_chain_threads():
+    for flat in (False, True):
+        mws = [ThreadedMiddleware(), RequestProvidesName('bob'),
+               ThreadedMiddleware()]
+        app = Application([('/', hello_world)],
+                          middlewares=mws, flat_chains=flat)
+        resp = Client(app, BaseResponse).get('/')
+        yield eq_, resp.status_code, 200
+        yield eq_, resp.data, 'Hello, bob!'
+
+
+class SlowPostMiddleware(Middleware):
+    def request(self, next, request):
+        ret = next()
+        time.sleep(0.01)
+        return ret
+
+
+def test_instrument_chains():
+    for flat in (False, True):
+        mws = [SlowPostMiddleware(), RequestProvidesName('Rajkumar')]
+        app = Application([('/', hello_world),
+                           ('/ctx', hello_world_ctx, render_basic),
+                           ('/_meta', MetaApplication())],
+                          middlewares=mws, flat_chains=flat,
+                          instrument_chains=True)
+        c = Client(app, BaseResponse)
+        resp = c.get('/ctx?name=Kurt')
+        yield ok_, 'Hello, Kurt!' in resp.data
+        rows = dict([((r['stage'], r['section']), r)
+                     for r in app.routes[1].chain_timings.get_rows()])
+        slow_post = rows[('SlowPostMiddleware.request', 'post')]
+        yield eq_, slow_post['count'], 1
+        yield ok_, slow_post['total'] >= 10, slow_post
+        yield ok_, rows[('SlowPostMiddleware.request', 'pre')]['total'] < 10
+        yield eq_, rows[('render', 'call')]['count'], 1
+        yield ok_, ('endpoint (hello_world_ctx)', 'call') in rows
+        resp = c.get('/_meta/')
+        yield ok_, 'Middleware Timings' in resp.data
+        yield ok_, 'SlowPostMiddleware.request' in resp.data
+
+    app = Application([('/', hello_world)])
+    yield eq_, app.routes[0].chain_timings, None
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import tempfile
+
+from nose.tools import eq_, ok_
+
+from werkzeug.test import Client, EnvironBuilder
+from werkzeug.wrappers import BaseResponse, Request
+
+from clastic import Application, SubApplication, render_basic
+from clastic.middleware import (SimpleProfileMiddleware,
+                                SamplingProfileMiddleware,
+                                SlowRequestProfileMiddleware)
+from clastic.middleware.profile import (create_sampling_profile_app,
+                                        create_slow_profile_app,
+                                        get_flame_text)
+
+
+def hello(name='world'):
+    return 'hello %s' % name
+
+
+def slow_hello(name):
+    time.sleep(0.05)
+    return 'hello %s' % name
+
+
+def broken():
+    raise ValueError('nope')
+
+
+def test_simple_profile():
+    app = Application([('/', hello, render_basic),
+                       ('/broken', broken, render_basic)],
+                      middlewares=[SimpleProfileMiddleware()])
+    client = Client(app, BaseResponse)
+    yield eq_, client.get('/').data, 'hello world'
+    resp = client.get('/?_prof=1')
+    yield ok_, 'function calls' in resp.data
+    resp = client.get('/broken?_prof=1')
+    yield eq_, resp.status_code, 500
+    yield ok_, 'function calls' in resp.data
+
+
+def test_simple_profile_raise_exc():
+    app = Application([('/broken', broken, render_basic)],
+                      middlewares=[SimpleProfileMiddleware(raise_exc=True)])
+    resp = Client(app, BaseResponse).get('/broken?_prof=1')
+    yield eq_, resp.status_code, 500
+    yield ok_, 'function calls' not in resp.data  # the usual error page
+
+
+def test_sampling_profile():
+    profile_mw = SamplingProfileMiddleware(interval=0.001)
+    app = Application([SubApplication('/_prof',
+                                      create_sampling_profile_app()),
+                       ('/<name>', slow_hello, render_basic)],
+                      middlewares=[profile_mw])
+    client = Client(app, BaseResponse)
+    try:
+        yield eq_, client.get('/a').data, 'hello a'
+    finally:
+        profile_mw.stop()
+    yield ok_, profile_mw.sample_count > 0
+
+    stacks = profile_mw.get_stacks('/<name>')
+    yield ok_, any(['slow_hello' in stack[-1] for stack in stacks])
+    lines = client.get('/_prof/').data.splitlines()
+    yield ok_, lines and all([line.startswith('/<name>;') for line in lines])
+    yield ok_, 'slow_hello' in get_flame_text(stacks)
+    resp = client.get('/_prof/flame', query_string={'route': '/nope'})
+    yield eq_, resp.data, '0 samples\n'
+
+
+def test_sampling_profile_nested():
+    def outer(request, _application):
+        sub_request = Request(EnvironBuilder('/inner').get_environ())
+        return 'outer ' + _application.dispatch(sub_request).data
+
+    profile_mw = SamplingProfileMiddleware(interval=0.001, max_depth=1)
+    app = Application([('/outer', outer, render_basic),
+                       ('/<name>', slow_hello, render_basic)],
+                      middlewares=[profile_mw])
+    client = Client(app, BaseResponse)
+    try:
+        yield eq_, client.get('/outer').data, 'outer hello inner'
+    finally:
+        profile_mw.stop()
+    yield eq_, profile_mw._active, {}
+
+    stacks = profile_mw.get_stacks('/<name>')
+    yield ok_, all([len(stack) == 1 for stack in stacks])
+    # truncation keeps the innermost frame
+    yield ok_, any(['slow_hello' in stack[0] for stack in stacks])
+
+
+def test_slow_request_profile():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        dump_dir = os.path.join(tmp_dir, 'dumps')
+        profile_mw = SlowRequestProfileMiddleware(dump_dir, sample_rate=1,
+                                                  threshold=0.02,
+                                                  max_dumps=2)
+        app = Application([('/fast', hello, render_basic),
+                           ('/<name>', slow_hello, render_basic)],
+                          middlewares=[profile_mw])
+        client = Client(app, BaseResponse)
+        for path in ('/a', '/fast', '/b', '/c'):
+            client.get(path)
+        dumps = profile_mw.get_dumps()
+        yield eq_, [d['path'] for d in dumps], ['/c', '/b']  # newest first
+        yield eq_, dumps[0]['pattern'], '/<name>'
+        yield eq_, dumps[0]['status'], 200
+        yield ok_, dumps[0]['elapsed_time'] >= 0.05
+        yield eq_, len(os.listdir(dump_dir)), 4
+
+        index_app = create_slow_profile_app(profile_mw)
+        index_client = Client(index_app, BaseResponse)
+        resp = index_client.get('/', headers={'Accept': 'application/json'})
+        yield ok_, dumps[0]['id'] in resp.data
+        resp = index_client.get('/' + dumps[0]['id'] + '?sort=time')
+        yield ok_, 'slow_hello' in resp.data
+        yield eq_, index_client.get('/../dumps').status_code, 404
+        yield eq_, index_client.get('/nope').status_code, 404
+
+        with open(os.path.join(dump_dir, 'notes.json'), 'w') as f:
+            f.write('{}')
+        yield eq_, [d['path'] for d in profile_mw.get_dumps()], ['/c', '/b']
+        client.get('/d')  # prunes around the stray file
+        yield eq_, [d['path'] for d in profile_mw.get_dumps()], ['/d', '/c']
+        yield ok_, os.path.exists(os.path.join(dump_dir, 'notes.json'))
+
+        shutil.rmtree(dump_dir)  # dumps fail, requests still succeed
+        resp = client.get('/e')
+        yield eq_, resp.status_code, 200
+        yield eq_, resp.data, 'hello e'
+
+        never_mw = SlowRequestProfileMiddleware(tmp_dir, sample_rate=0,
+                                                threshold=0)
+        app = Application([('/<name>', slow_hello, render_basic)],
+                          middlewares=[never_mw])
+        Client(app, BaseResponse).get('/a')
+        yield eq_, never_mw.get_dumps(), []
+    finally:
+        shutil.rmtree(tmp_dir)
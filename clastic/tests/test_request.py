@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from nose.tools import eq_, ok_
+
+from werkzeug.test import Client, EnvironBuilder
+from werkzeug.wrappers import BaseResponse, Request
+
+from clastic import Application, render_basic
+from clastic.application import SubApplication
+from clastic.request import LightRequest
+
+
+COMPARED_ATTRS = ('path', 'script_root', 'full_path', 'url', 'base_url',
+                  'url_root', 'host_url', 'host', 'method', 'query_string',
+                  'args', 'form', 'values', 'cookies', 'mimetype',
+                  'content_length', 'is_xhr', 'is_secure', 'remote_addr',
+                  'access_route', 'accept_mimetypes', 'accept_encodings',
+                  'accept_languages', 'if_none_match', 'if_modified_since')
+
+ENV_KWARGS = [{'path': '/'},
+              {'path': '/a/b/', 'query_string': 'x=1&x=2&y=3',
+               'base_url': 'https://example.com/root/'},
+              {'path': '/form', 'method': 'POST',
+               'data': {'name': 'Kurt', 'lang': 'en'}},
+              {'path': '/headers',
+               'headers': {'Accept': 'application/json;q=0.9,text/html',
+                           'Accept-Encoding': 'gzip, deflate',
+                           'Accept-Language': 'en-US,en;q=0.8',
+                           'Cookie': 'session=abc; theme=dark',
+                           'If-None-Match': '"xyz"',
+                           'If-Modified-Since':
+                           'Sun, 06 Nov 1994 08:49:37 GMT',
+                           'X-Requested-With': 'XMLHttpRequest',
+                           'X-Forwarded-For': '10.0.0.1, 10.0.0.2'}}]
+
+
+def _str_attr(request, attr):
+    val = getattr(request, attr)
+    if hasattr(val, 'to_dict'):
+        return val.to_dict(flat=False)
+    elif isinstance(val, list):
+        return list(val)
+    return str(val)
+
+
+def test_matches_werkzeug_request():
+    for env_kwargs in ENV_KWARGS:
+        full_req = Request(EnvironBuilder(**env_kwargs).get_environ())
+        light_req = LightRequest(EnvironBuilder(**env_kwargs).get_environ())
+        for attr in COMPARED_ATTRS:
+            yield (eq_, _str_attr(light_req, attr),
+                   _str_attr(full_req, attr), attr)
+
+
+def test_lazy_slots():
+    req = LightRequest(EnvironBuilder(path='/', data='raw').get_environ())
+    yield ok_, not hasattr(req, '__dict__')
+    yield ok_, req.args is req.args
+    yield eq_, req.get_data(), b'raw'
+    yield eq_, req.data, b'raw'
+
+
+def test_light_request_app():
+    class LightApplication(Application):
+        request_type = LightRequest
+
+    def greet(request, name):
+        return '%s %s %s' % (type(request).__name__,
+                             name, request.args.get('punct', '!'))
+
+    sub_app = LightApplication([('/<name>', greet, render_basic)])
+    app = LightApplication([('/hi/<name>', greet, render_basic),
+                            ('/form', lambda request: request.form['name'],
+                             render_basic),
+                            SubApplication('/sub', sub_app, delegate=True)])
+    client = Client(app, BaseResponse)
+    yield eq_, client.get('/hi/Kurt?punct=?').data, b'LightRequest Kurt ?'
+    yield eq_, client.post('/form', data={'name': 'Kurt'}).data, b'Kurt'
+    yield eq_, client.get('/sub/Kurt').data, b'LightRequest Kurt !'
+    yield eq_, client.get('/dne').status_code, 404
+    # methods are uppercased, as with werkzeug's Request
+    resp = client.open('/hi/Kurt', method='get')
+    yield eq_, resp.data, b'LightRequest Kurt !'
@@ -6,7 +6,7 @@ from nose.tools import raises, eq_, ok_
 from werkzeug.test import Client
 from werkzeug.wrappers import BaseResponse
 
-from clastic import Application, render_basic
+from clastic import Application, MetaApplication, render_basic
 from clastic.application import BaseApplication
 
 from clastic.route import BaseRoute, Route
@@ -57,6 +57,34 @@ def test_base_application_basics():
     yield eq_, res.data, 'lolporte'
 
 
+def test_dispatch_injectables():
+    def render_error(request, _error, name):
+        word = request.path_params['word']
+        return BaseResponse('%s %s %s' % (_error.code, name, word))
+
+    def ep(name, word, _route, _application):
+        return BaseResponse('%s %s' % (name, word))
+
+    br = BaseRoute('/base/<word>',
+                   lambda request, name, word: BaseResponse(name + word))
+    app = Application([('/<word>', ep),
+                       ('/missing/<word>', lambda word: NotFound()),
+                       br],
+                      resources={'name': 'Kurt'},
+                      render_error=render_error)
+    client = Client(app, BaseResponse)
+    yield eq_, client.get('/hi').data, 'Kurt hi'
+    yield eq_, client.get('/base/!').data, 'Kurt!'
+    yield eq_, client.get('/missing/hi').data, '404 Kurt hi'
+
+    # resources changed after construction are seen by endpoints and
+    # render_error alike
+    app.resources['name'] = 'Rajkumar'
+    yield eq_, client.get('/hi').data, 'Rajkumar hi'
+    yield eq_, client.get('/base/!').data, 'Rajkumar!'
+    yield eq_, client.get('/missing/hi').data, '404 Rajkumar hi'
+
+
 def test_nonbreaking_exc():
     app = Application([('/', lambda: NotFound(is_breaking=False)),
                        ('/', lambda: 'so hot in here', render_basic)])
@@ -107,6 +135,55 @@ def test_create_route_order_incr():
     return
 
 
+def test_add_routes():
+    app = BaseApplication([('/<one>/<two>', two_segments, render_basic)])
+    app.add_routes([('/api/<api_path+>', api, render_basic),
+                    ('/<one>/<two>/<three>', three_segments, render_basic)],
+                   index=0)
+    patterns = [rt.pattern for rt in app.routes]
+    yield eq_, patterns, ['/api/<api_path+>', '/<one>/<two>/<three>',
+                          '/<one>/<two>']
+    client = Client(app, BaseResponse)
+    yield eq_, client.get('/api/a/b').data, 'api: a/b'
+    yield eq_, client.get('/a/b/c').data, 'three_segments: a, b, c'
+
+    # one unbindable route and none of the batch gets added
+    try:
+        app.add_routes([('/ok', NO_OP), ('/bad', api)])
+    except NameError:
+        pass
+    yield eq_, len(app.routes), 3
+    yield eq_, client.get('/ok').status_code, 404
+
+
+def test_lazy_chains():
+    app = Application([('/<one>/<two>', two_segments, render_basic)],
+                      lazy_chains=True)
+    route = app.routes[0]
+    yield eq_, route._execute, None
+    client = Client(app, BaseResponse)
+    yield eq_, client.get('/a/b').data, 'two_segments: a, b'
+    yield ok_, callable(route._execute)
+
+
+def test_shared_chains():
+    routes = [('/a/<one>/<two>', two_segments, render_basic),
+              ('/b/<one>/<two>', two_segments, render_basic),
+              ('/c/<one>/<two>/<three>', three_segments, render_basic)]
+    app = Application(routes)
+    first, second, third = app.routes
+    yield ok_, first._execute is second._execute  # same shape, one batch
+    yield ok_, first._execute is not third._execute
+    client = Client(app, BaseResponse)
+    yield eq_, client.get('/b/x/y').data, 'two_segments: x, y'
+
+    app.add(('/d/<one>/<two>', two_segments, render_basic))
+    yield ok_, app.routes[-1]._execute is not first._execute
+
+    app = Application(routes, instrument_chains=True)
+    yield ok_, app.routes[0]._execute is not app.routes[1]._execute
+
+
 """
 New routing testing strategy notes
 ==================================
@@ -212,3 +289,130 @@ def test_slashing_behaviors():
     yield eq_, cl_strict.get('/dne/dne//').status_code, 404
     yield eq_, cl_rewrite.get('/dne/dne//').status_code, 404
     yield eq_, cl_redirect.get('/dne/dne//').status_code, 404
+
+
+def test_trie_matches_linear():
+    "the route trie should only ever narrow down, never change results"
+    ep = lambda _route: _route.pattern
+    patterns = (no_arg_routes + arg_routes +
+                ['/api/<api_path+>',
+                 '/api/v1/items/<item_id:int>',
+                 '/api/v1/items/<item_id:int>/detail',
+                 '/api/v1/<service>/<item_id:float>/',
+                 '/files.json',
+                 '/files.<fmt>'])
+    paths = ['/', '/alpha', '/alpha/', '//alpha//', '/beta/', '/gamma',
+             '/delta/epsilon/', '/zeta/eta', '/a/b/c/d/e',
+             '/iota/k/l/mu', '/1/2.0/x/y', '/api', '/api/v1/items/3',
+             '/api/v1/items/three', '/api/v1/items/3/detail',
+             '/api/v1/items/3.5/', '/files.json', '/filesxjson',
+             '/files.xml', '/dne/dne//']
+    for mode in MODES:
+        routes = [(p, ep, render_basic) for p in patterns]
+        linear_app = Application(routes, slash_mode=mode)
+        trie_app = Application(routes, slash_mode=mode, use_trie=True)
+        linear_cl = Client(linear_app, BaseResponse)
+        trie_cl = Client(trie_app, BaseResponse)
+        for path in paths:
+            linear_resp = linear_cl.get(path)
+            trie_resp = trie_cl.get(path)
+            yield eq_, linear_resp.status_code, trie_resp.status_code, path
+            yield eq_, linear_resp.data, trie_resp.data, path
+
+
+def test_trie_route_order_incr():
+    routes = [('/<one>/<two>', two_segments, render_basic),
+              ('/api/<api_path+>', api, render_basic)]
+    app = Application(use_trie=True)
+    client = Client(app, BaseResponse)
+    for r in routes:
+        app.add(r)
+    yield eq_, client.get('/api/a').data, 'two_segments: api, a'
+    app.add(('/api/a', lambda: 'inserted', render_basic), index=0)
+    yield eq_, client.get('/api/a').data, 'inserted'
+    yield eq_, client.get('/api/a/b').data, 'api: a/b'
+
+
+def test_dispatch_cache():
+    routes = [('/api/<api_path+>', api, render_basic),
+              ('/<one>/<two>', two_segments, render_basic),
+              ('/<one>/<two>/<three>', three_segments, render_basic)]
+    app = Application(routes, dispatch_cache_size=2)
+    client = Client(app, BaseResponse)
+    for i in range(3):
+        yield eq_, client.get('/api/a/b').data, 'api: a/b'
+    yield eq_, app.get_dispatch_cache_stats()['hit_count'], 2
+    yield eq_, client.post('/api/a/b').data, 'api: a/b'
+    yield eq_, client.get('/x/y/z').data, 'three_segments: x, y, z'
+    yield eq_, app.get_dispatch_cache_stats()['size'], 2
+
+    app.add(('/api/<one>/<two>', two_segments, render_basic), index=0)
+    yield eq_, app.get_dispatch_cache_stats()['size'], 0
+    yield eq_, client.get('/api/a/b').data, 'two_segments: a, b'
+
+    uncached_app = Application(routes)
+    yield eq_, uncached_app.get_dispatch_cache_stats(), None
+
+    app.add(('/_meta', MetaApplication()), index=0)
+    resp = client.get('/_meta/')
+    yield eq_, resp.data.count('Dispatch cache'), 1
+
+
+def test_dispatch_cache_list_params():
+    def pop_first(rest):
+        return 'first: %s' % rest.pop(0)
+
+    app = Application([('/c/<rest*>', pop_first, render_basic)],
+                      dispatch_cache_size=10)
+    client = Client(app, BaseResponse)
+    for i in range(3):  # the cached params aren't changed by the endpoint
+        resp = client.get('/c/a/b')
+        yield eq_, resp.status_code, 200
+        yield eq_, resp.data, 'first: a'
+
+
+def test_dispatch_cache_nonbreaking():
+    app = Application([('/', lambda: NotFound(is_breaking=False)),
+                       ('/', lambda: 'so hot in here', render_basic)],
+                      dispatch_cache_size=10)
+    client = Client(app, BaseResponse)
+    for i in range(2):
+        resp = client.get('/')
+        yield eq_, resp.status_code, 200
+        yield eq_, resp.data, 'so hot in here'
+
+
+def _converter_map_match(route, path):
+    "match_path() as done with the converter map, for reference"
+    match = route.regex.match(path)
+    if not match:
+        return None
+    groups, ret = match.groupdict(), {}
+    try:
+        for conv_name, conv in route.converters.items():
+            ret[conv_name] = conv(groups[conv_name])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return ret
+
+
+def test_compiled_matchers():
+    paths = ['/', '/alpha', '/alpha/', '/iota/k/l/mu/', '/1/2.5/x/y/',
+             '/-1/.5e3/x/y', '/a', '/a/b/c', '//a//b//', '/1/x/y/z/']
+    for mode in MODES:
+        for patt in no_arg_routes + arg_routes:
+            rt = BaseRoute(patt, slash_mode=mode)
+            for path in paths:
+                yield (eq_, rt.match_path(path),
+                       _converter_map_match(rt, path), (mode, patt, path))
+
+
+def test_shared_matchers():
+    first = BaseRoute('/a/<x:int>')
+    second = BaseRoute('/b/<x:int>')
+    # same shape, so same code, but each only refers to its own regex
+    yield ok_, first._match_path.func_code is second._match_path.func_code
+    yield ok_, 'regex' not in second._match_path.func_globals
+    yield eq_, first.match_path('/a/1'), {'x': 1}
+    yield eq_, second.match_path('/b/2'), {'x': 2}
+    yield eq_, second.match_path('/a/1'), None
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import tempfile
+
+from nose.tools import eq_, ok_
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse, Response
+
+from clastic import Application, POST
+from clastic.middleware.server_cache import (ResponseCacheMiddleware,
+                                             MemoryCacheBackend,
+                                             SQLiteCacheBackend)
+
+
+class Counter(object):
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, request):
+        self.count += 1
+        return Response('%s %s' % (request.path, self.count))
+
+
+class BusyBackend(MemoryCacheBackend):
+    "Some other request is always refreshing stale entries."
+    def claim(self, key, timeout):
+        return False
+
+
+def test_cache_basic():
+    counter = Counter()
+
+    def varied(request):
+        resp = counter(request)
+        resp.data += ' ' + request.headers.get('Accept-Language', '')
+        resp.headers['Vary'] = 'Accept-Language'
+        return resp
+
+    def cookied(request):
+        resp = counter(request)
+        resp.set_cookie('sid', 'abc')
+        return resp
+
+    cache_mw = ResponseCacheMiddleware(route_ttls={'/uncached': 0})
+    app = Application([('/', counter),
+                       ('/uncached', counter),
+                       ('/varied', varied),
+                       ('/cookied', cookied),
+                       POST('/post', counter)],
+                      middlewares=[cache_mw])
+    # requests with cookies aren't cached, so don't send back /cookied's
+    client = Client(app, BaseResponse, use_cookies=False)
+
+    yield eq_, client.get('/').data, '/ 1'
+    resp = client.get('/')
+    yield eq_, resp.data, '/ 1'
+    yield eq_, resp.headers['Age'], '0'
+    yield eq_, client.get('/?a=b').data, '/ 2'
+    yield eq_, client.get('/?a=b').data, '/ 2'
+
+    yield eq_, client.get('/uncached').data, '/uncached 3'
+    yield eq_, client.get('/uncached').data, '/uncached 4'
+    yield eq_, client.post('/post').data, '/post 5'
+    yield eq_, client.post('/post').data, '/post 6'
+    yield eq_, client.get('/cookied').data, '/cookied 7'
+    yield eq_, client.get('/cookied').data, '/cookied 8'
+
+    en, fr = {'Accept-Language': 'en'}, {'Accept-Language': 'fr'}
+    yield eq_, client.get('/varied', headers=en).data, '/varied 9 en'
+    yield eq_, client.get('/varied', headers=fr).data, '/varied 10 fr'
+    yield eq_, client.get('/varied', headers=en).data, '/varied 9 en'
+    yield eq_, client.get('/varied', headers=fr).data, '/varied 10 fr'
+
+    stats = cache_mw.get_stats()
+    yield eq_, stats['hit_count'], 4
+
+    cache_mw.purge('/varied')
+    yield eq_, client.get('/varied', headers=en).data, '/varied 11 en'
+    yield eq_, client.get('/').data, '/ 1'
+    cache_mw.purge()
+    yield eq_, client.get('/').data, '/ 12'
+
+
+def test_cache_cookies():
+    counter = Counter()
+
+    def session_page(request):
+        resp = counter(request)
+        resp.data += ' ' + request.cookies.get('sid', '')
+        return resp
+
+    def varied(request):
+        resp = session_page(request)
+        resp.headers['Vary'] = 'Cookie'
+        return resp
+
+    cache_mw = ResponseCacheMiddleware(cookie_route_patterns=['/varied'])
+    app = Application([('/', session_page), ('/varied', varied)],
+                      middlewares=[cache_mw])
+    alice, bob = {'Cookie': 'sid=alice'}, {'Cookie': 'sid=bob'}
+    client = Client(app, BaseResponse)
+
+    yield eq_, client.get('/', headers=alice).data, '/ 1 alice'
+    yield eq_, client.get('/', headers=bob).data, '/ 2 bob'
+    yield eq_, client.get('/', headers=alice).data, '/ 3 alice'
+    yield eq_, client.get('/').data, '/ 4 '
+    yield eq_, client.get('/').data, '/ 4 '
+
+    yield eq_, client.get('/varied', headers=alice).data, '/varied 5 alice'
+    yield eq_, client.get('/varied', headers=bob).data, '/varied 6 bob'
+    yield eq_, client.get('/varied', headers=alice).data, '/varied 5 alice'
+
+
+def test_cache_vary_non_ascii():
+    def varied(request):
+        resp = Response(request.environ.get('HTTP_ACCEPT_LANGUAGE', ''))
+        resp.headers['Vary'] = 'Accept-Language'
+        return resp
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'cache.db')
+        for backend in (MemoryCacheBackend(), SQLiteCacheBackend(path)):
+            cache_mw = ResponseCacheMiddleware(backend=backend)
+            app = Application([('/', varied)], middlewares=[cache_mw])
+            client = Client(app, BaseResponse)
+            headers = {'Accept-Language': u'\xe9t\xe9'.encode('utf-8')}
+            for i in range(2):
+                resp = client.get('/', headers=headers)
+                yield eq_, resp.status_code, 200
+                yield eq_, resp.data, headers['Accept-Language']
+            yield eq_, cache_mw.get_stats()['hit_count'], 1
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_cache_stale():
+    counter = Counter()
+    fresh_mw = ResponseCacheMiddleware(ttl=0.01, stale_ttl=60)
+    busy_mw = ResponseCacheMiddleware(ttl=0.01, stale_ttl=60,
+                                      backend=BusyBackend())
+    for cache_mw in (fresh_mw, busy_mw):
+        app = Application([('/', counter)], middlewares=[cache_mw])
+        client = Client(app, BaseResponse)
+        first = client.get('/').data
+        time.sleep(0.02)
+        second = client.get('/').data
+        if cache_mw is busy_mw:
+            yield eq_, second, first  # served stale
+            yield eq_, cache_mw.get_stats()['stale_count'], 1
+        else:
+            yield ok_, second != first  # refreshed
+
+
+def test_sqlite_backend():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'cache.db')
+        counter = Counter()
+        apps = []
+        for i in range(2):  # two "workers" sharing one cache file
+            cache_mw = ResponseCacheMiddleware(
+                backend=SQLiteCacheBackend(path))
+            apps.append(Application([('/', counter)],
+                                    middlewares=[cache_mw]))
+        first, second = [Client(app, BaseResponse) for app in apps]
+        yield eq_, first.get('/').data, '/ 1'
+        yield eq_, second.get('/').data, '/ 1'
+        yield eq_, second.get('/?x=y').data, '/ 2'
+
+        backend = SQLiteCacheBackend(path, max_bytes=4096, max_entries=3)
+        yield eq_, backend.get_stats()['size'], 4  # 2 vary + 2 entries
+        backend.purge()
+        for i in range(5):
+            backend.set('key%s' % i, ('value',), u'/path%s' % i)
+        yield eq_, backend.get_stats()['size'], 3
+        yield eq_, backend.get('key0'), None
+        yield eq_, backend.get('key4'), ('value',)
+        backend.set('big', ('x' * 8192,), u'/big')
+        yield eq_, backend.get('big'), None
+        backend.purge('/path4')
+        yield eq_, backend.get('key4'), None
+
+        yield ok_, backend.claim('key3', 10)
+        yield ok_, not SQLiteCacheBackend(path).claim('key3', 10)
+        backend.release('key3')
+        yield ok_, SQLiteCacheBackend(path).claim('key3', 10)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_sqlite_backend_fork():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        backend = SQLiteCacheBackend(os.path.join(tmp_dir, 'cache.db'))
+        backend.get('warm up the parent connection')
+        pid = os.fork()
+        if not pid:
+            try:
+                backend.set('from child', ('value',), u'/')
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        yield eq_, backend.get('from child'), ('value',)
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+from nose.tools import eq_, ok_, raises
+
+from clastic.sinter import inject, get_injector, _inject_uncached
+
+
+def args_func(request, name, greeting='Hello', punct=None):
+    return '%s, %s%s' % (greeting, name, punct or '!')
+
+
+def kwargs_func(request, name='world', **kw):
+    return name, sorted(kw)
+
+
+class Greeter(object):
+    def __init__(self, greeting):
+        self.greeting = greeting
+
+    def greet(self, name):
+        return '%s, %s!' % (self.greeting, name)
+
+    def __call__(self, name):
+        return self.greet(name)
+
+
+def test_inject_matches_uncached():
+    injectables_list = [{'request': None, 'name': 'Kurt'},
+                        {'request': None, 'name': 'Kurt', 'punct': '?'},
+                        {'request': None, 'name': 'Kurt', 'extra': 1},
+                        {'request': None, 'greeting': 'Hi', 'name': 'Kurt'}]
+    for func in (args_func, kwargs_func):
+        for injectables in injectables_list:
+            yield (eq_, inject(func, injectables),
+                   _inject_uncached(func, injectables))
+
+
+def test_injector_cache():
+    yield ok_, get_injector(args_func) is get_injector(args_func)
+    hi, hey = Greeter('Hi'), Greeter('Hey')
+    yield ok_, get_injector(hi.greet) is get_injector(hey.greet)
+    yield eq_, inject(hi.greet, {'name': 'Kurt'}), 'Hi, Kurt!'
+    yield eq_, inject(hey.greet, {'name': 'Kurt'}), 'Hey, Kurt!'
+    yield eq_, inject(hey, {'name': 'Kurt'}), 'Hey, Kurt!'  # uncached
+
+
+@raises(TypeError)
+def test_inject_missing_arg():
+    inject(args_func, {'request': None})
@@ -27,3 +27,18 @@ def test_basic_static_serve():
     yield eq_, resp.status_code, 200
     resp = c.get('/static/_ashes_tmpls/../../core.py')
     yield eq_, resp.status_code, 403
+
+
+def test_static_etag():
+    static_app = StaticApplication(_CUR_DIR)
+    app = Application([('/static/', static_app)])
+
+    c = Client(app, Response)
+    resp = c.get('/static/test_static.py')
+    etag = resp.headers['ETag']
+    yield eq_, resp.status_code, 200
+    resp = c.get('/static/test_static.py', headers={'If-None-Match': etag})
+    yield eq_, resp.status_code, 304
+    yield eq_, resp.headers['ETag'], etag
+    resp = c.get('/static/test_static.py', headers={'If-None-Match': '"x"'})
+    yield eq_, resp.status_code, 200
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_, ok_, raises
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from clastic import Application, render_basic
+from clastic.errors import NotFound
+from clastic import MetaApplication, SubApplication
+from clastic.statsutils import (HitRing, LogHistogram, RollingWindow,
+                               BucketCounter, TopKCounter, SharedStats)
+from clastic.middleware.stats import (StatsMiddleware,
+                                      create_metrics_app,
+                                      _get_stats_dict)
+
+
+def hello(name=None):
+    if name == 'missing':
+        raise NotFound()
+    return 'hello %s' % name
+
+
+def test_hit_ring():
+    ring = HitRing(3)
+    yield eq_, list(ring), []
+    for i in range(5):
+        ring.append(float(i), i / 10.0, i, i * 2)
+    yield eq_, len(ring), 3
+    yield eq_, ring.total_count, 5
+    yield eq_, [hit[0] for hit in ring], [2.0, 3.0, 4.0]
+    yield eq_, list(ring)[-1], (4.0, 0.4, 4, 8)
+
+
+def test_log_histogram():
+    hist = LogHistogram()
+    yield eq_, hist.get_percentile(50), 0.0
+    for i in range(1, 1001):
+        hist.add(i / 1000.0)  # 1ms to 1s
+    yield eq_, (hist.count, hist.min, hist.max), (1000, 0.001, 1.0)
+    yield eq_, round(hist.mean, 4), 0.5005
+    yield eq_, hist.get_percentile(0), 0.001
+    yield eq_, hist.get_percentile(100), 1.0
+    for ptile in (50, 90, 99, 99.9):
+        rel_error = abs(hist.get_percentile(ptile) / (ptile / 100.0) - 1)
+        yield ok_, rel_error < 0.03, (ptile, rel_error)
+    yield eq_, sum([count for _, count in hist.iter_buckets()]), 1000
+
+    other = LogHistogram()
+    for i in range(1000):
+        other.add(2.0)
+    hist.merge(other)
+    yield eq_, (hist.count, hist.max), (2000, 2.0)
+    yield eq_, hist.get_percentile(75), 2.0
+    hist.add(0)
+    hist.add(1e9)  # out of range, but still counted
+    yield eq_, (hist.min, hist.max), (0, 1e9)
+    yield eq_, hist.get_percentile(100), 1e9
+
+
+@raises(ValueError)
+def test_log_histogram_merge_mismatch():
+    LogHistogram().merge(LogHistogram(sub_buckets=8))
+
+
+def test_rolling_window():
+    window = RollingWindow(60, slot_count=6)
+    window.start_time = 1000.0
+    for i in range(60):  # one request a second, every tenth an error
+        window.add(0.01 * (i + 1), is_error=(i % 10 == 0), now=1000.0 + i)
+    stats = window.get_stats(now=1059.0)
+    yield eq_, stats['count'], 60
+    yield eq_, stats['error_count'], 6
+    yield eq_, stats['error_rate'], 0.1
+    yield eq_, stats['rate'], round(60 / 59.0, 3)  # up for 59 seconds
+    yield ok_, 295 < stats['median'] < 315, stats['median']
+
+    # 15 seconds on, the first slot and a half have expired
+    stats = window.get_stats(now=1075.0)
+    yield eq_, stats['count'], 40
+    yield eq_, stats['error_count'], 4
+    yield ok_, 390 < stats['median'] < 415, stats['median']
+
+    stats = window.get_stats(now=5000.0)
+    yield eq_, (stats['count'], stats['error_count']), (0, 0)
+    yield eq_, stats['median'], 0.0
+    window.add(0.5, now=5000.0)
+    yield eq_, window.get_stats(now=5000.0)['median'], 500.0
+
+
+def test_bucket_counter():
+    counter = BucketCounter([1, 0.1, 10])
+    for val in (0.05, 0.1, 0.5, 20):
+        counter.add(val)
+    yield eq_, list(counter.iter_cumulative()), [(0.1, 2), (1, 3), (10, 3),
+                                                  (float('inf'), 4)]
+    yield eq_, (counter.count, counter.total), (4, 20.65)
+
+
+def test_shared_stats():
+    shared = SharedStats([0.1, 1], [100], max_slots=2)
+    shared.add('/', '200', 0.05, 10)
+    pid = os.fork()
+    if not pid:
+        try:
+            shared.add('/', '200', 0.5, 1000)
+            shared.add('/<name>', '404', 0.01)
+            shared.add('/<name>', '500', 0.01)  # out of slots
+            shared.add_in_flight(1)
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    route_stats = shared.get_route_stats()
+    yield eq_, sorted(route_stats), [('/', '200'), ('/<name>', '404')]
+    hist, latencies, sizes = route_stats[('/', '200')]
+    yield eq_, (hist.count, hist.min, hist.max), (2, 0.05, 0.5)
+    yield eq_, list(latencies.iter_cumulative()), [(0.1, 1), (1, 2),
+                                                    (float('inf'), 2)]
+    yield eq_, (sizes.count, sizes.total), (2, 1010)
+    yield eq_, (shared.in_flight, shared.overflow_count), (1, 1)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'stats')
+        first = SharedStats([0.1], [100], path=path)
+        first.add(u'/caf\xe9', '200', 0.05)
+        second = SharedStats([0.1], [100], path=path)
+        second.add(u'/caf\xe9', '200', 0.05)
+        hist = first.get_route_stats()[(u'/caf\xe9', u'200')][0]
+        yield eq_, hist.count, 2
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+@raises(ValueError)
+def test_shared_stats_mismatch():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'stats')
+        SharedStats([0.1], [100], path=path)
+        SharedStats([0.1, 1], [100], path=path)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_top_k_counter():
+    counter = TopKCounter(capacity=10)
+    for key in 'aaaabbbc':
+        counter.add(key)
+    yield eq_, counter.get_top(), [('a', 4, 0), ('b', 3, 0), ('c', 1, 0)]
+    for i in range(20):  # a flood of one-off keys
+        counter.add('noise%s' % i)
+    yield eq_, len(counter), 10
+    yield eq_, counter.total_count, 28
+    # keys seen more than 28 / 10 times are always kept
+    counts = counter.get_counts()
+    yield ok_, 'a' in counts and 'b' in counts
+    for key, count, error in counter.get_top():
+        yield ok_, count - error <= 4
+
+
+def test_stats_mw():
+    stats_mw = StatsMiddleware(max_hits=4)
+    app = Application([('/', hello, render_basic),
+                       ('/<name>', hello, render_basic),
+                       ('/_stats', _get_stats_dict, render_basic)],
+                      middlewares=[stats_mw])
+    client = Client(app, BaseResponse)
+    for name in ('', 'a', 'b', 'a', 'missing', 'a'):
+        client.get('/' + name)
+
+    yield eq_, len(stats_mw.get_hits()), 4
+    stats = _get_stats_dict(app)
+    yield eq_, stats['resp_counts']['/a'], 3
+    yield eq_, stats['top_urls'][0], {'url': '/a', 'count': 3, 'max_error': 0}
+    name_stats = stats['route_stats']['/<name>']
+    yield eq_, name_stats['200']['count'], 4  # beyond the hit ring's size
+    yield eq_, name_stats['404']['count'], 1
+    yield ok_, name_stats['200']['max'] >= name_stats['200']['ninenine']
+    yield eq_, stats['route_stats']['/']['200']['count'], 1
+
+    windows = stats['windows']
+    yield eq_, windows['all']['1m']['count'], 6
+    yield eq_, windows['all']['1h']['error_count'], 0  # 404s aren't errors
+    yield eq_, windows['routes']['/<name>']['5m']['count'], 5
+
+    resp = client.get('/_stats', headers={'Accept': 'application/json'})
+    yield eq_, resp.status_code, 200
+
+
+def test_stats_meta():
+    app = Application([('/', hello, render_basic),
+                       ('/_meta', MetaApplication())],
+                      middlewares=[StatsMiddleware()])
+    client = Client(app, BaseResponse)
+    client.get('/')
+    resp = client.get('/_meta/')
+    yield eq_, resp.status_code, 200
+    yield ok_, 'Request Statistics' in resp.data
+    yield ok_, '(all routes)' in resp.data
+
+
+def test_metrics_app():
+    stats_mw = StatsMiddleware()
+    app = Application([SubApplication('/metrics', create_metrics_app()),
+                       ('/', hello, render_basic),
+                       ('/<name>', hello, render_basic)],
+                      middlewares=[stats_mw])
+    client = Client(app, BaseResponse)
+    for name in ('', 'a', 'missing'):
+        client.get('/' + name)
+    resp = client.get('/metrics/')
+    yield eq_, resp.status_code, 200
+    yield ok_, resp.headers['Content-Type'].startswith('text/plain')
+    lines = resp.data.splitlines()
+    yield ok_, ('clastic_requests_total'
+                '{route="/<name>",status="404"} 1') in lines
+    yield ok_, ('clastic_request_duration_seconds_bucket'
+                '{route="/",status="200",le="+Inf"} 1') in lines
+    yield ok_, 'clastic_response_size_bytes_count{route="/"} 1' in lines
+    yield ok_, 'clastic_requests_in_flight 1' in lines  # this request
+    yield ok_, '# TYPE clastic_request_duration_seconds histogram' in lines
+
+    # a "worker" forked off with a shared backend
+    stats_mw = StatsMiddleware(shared=True)
+    app = Application([SubApplication('/metrics', create_metrics_app()),
+                       ('/', hello, render_basic)],
+                      middlewares=[stats_mw])
+    client = Client(app, BaseResponse)
+    pid = os.fork()
+    if not pid:
+        try:
+            client.get('/')
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    client.get('/')
+    lines = client.get('/metrics/').data.splitlines()
+    yield ok_, 'clastic_requests_total{route="/",status="200"} 2' in lines
+    yield eq_, len(stats_mw.get_hits()), 2  # just this process's hits
+
+    bare_app = Application([SubApplication('/metrics',
+                                           create_metrics_app())])
+    resp = Client(bare_app, BaseResponse).get('/metrics/')
+    yield eq_, resp.status_code, 404
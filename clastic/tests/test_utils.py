@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+from nose.tools import eq_, ok_
+
+from clastic.utils import LRU, SizedLRU
+
+
+def test_lru():
+    lru = LRU(max_size=2)
+    lru['a'], lru['b'] = 1, 2
+    yield eq_, lru['a'], 1
+    lru['c'] = 3  # 'b' is now the least recently used
+    yield eq_, lru.keys(), ['a', 'c']
+    yield eq_, lru.get('b'), None
+    stats = lru.get_stats()
+    yield eq_, (stats['hit_count'], stats['miss_count']), (1, 1)
+
+
+def test_sized_lru():
+    lru = SizedLRU(max_bytes=10)
+    lru['a'], lru['b'] = 'xxxx', 'yyyy'
+    yield eq_, lru.byte_count, 8
+    lru['c'] = 'zzzz'
+    yield eq_, lru.keys(), ['b', 'c']
+    yield eq_, lru.byte_count, 8
+
+    lru['b'] = 'y'
+    yield eq_, lru.byte_count, 5
+    lru['d'] = 'w' * 11  # too big to store at all
+    yield ok_, 'd' not in lru
+    yield eq_, lru.byte_count, 5
+
+    lru.pop('b')
+    yield eq_, lru.byte_count, 4
+    lru.clear()
+    yield eq_, (len(lru), lru.byte_count), (0, 0)
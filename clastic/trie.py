@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+A segment trie for narrowing down which routes could possibly match a
+given URL path, so that an application with many routes does not have
+to run every route's regex on every request.
+
+The trie is only ever a filter. Each candidate it yields is still
+checked with :meth:`BaseRoute.match_path`, which does the real regex
+match and type conversion, and candidates come back in the order
+their routes were inserted. First-match semantics are unchanged.
+"""
+
+from .route import BINDING, TYPE_PATT_MAP, _SEGMENT_PATTERNS
+
+
+# segment kinds
+_STATIC, _SINGLE, _TAIL = 'static', 'single', 'tail'
+
+# static segments are spliced into route regexes unescaped
+_REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
+
+
+def _classify_segment(segment):
+    match = BINDING.match(segment)
+    if not match:
+        if _REGEX_SPECIAL.intersection(segment):
+            return _TAIL
+        return _STATIC
+    op, type_name = match.group('op'), match.group('type') or 'unicode'
+    if op not in ('', ':'):
+        return _TAIL  # optional and multi-segment bindings
+    if TYPE_PATT_MAP.get(type_name) not in _SEGMENT_PATTERNS:
+        return _TAIL  # custom converter, could match anything
+    return _SINGLE
+
+
+def split_path(path):
+    # slash runs are collapsed, same as the regexes in the default
+    # slash modes; strict routes still reject them in match_path()
+    return [s for s in path.split('/') if s]
+
+
+class _TrieNode(object):
+    __slots__ = ('children', 'wildcard', 'leaves', 'tails')
+
+    def __init__(self):
+        self.children = {}
+        self.wildcard = None
+        self.leaves = []  # routes whose pattern ends at this node
+        self.tails = []   # routes which may match anything from here on
+
+
+class RouteTrie(object):
+    def __init__(self, routes=None):
+        self.root = _TrieNode()
+        self.routes = []
+        for route in routes or []:
+            self.append(route)
+
+    def append(self, route):
+        "Adds *route* after all previously inserted routes."
+        index = len(self.routes)
+        self.routes.append(route)
+        node = self.root
+        for segment in split_path(route.pattern):
+            kind = _classify_segment(segment)
+            if kind == _TAIL:
+                node.tails.append(index)
+                return
+            elif kind == _SINGLE:
+                if node.wildcard is None:
+                    node.wildcard = _TrieNode()
+                node = node.wildcard
+            else:
+                child = node.children.get(segment)
+                if child is None:
+                    child = node.children[segment] = _TrieNode()
+                node = child
+        node.leaves.append(index)
+
+    def get_candidates(self, path):
+        """
+        Returns the list of routes which might match *path*, in
+        insertion order.
+        """
+        segments = split_path(path)
+        seg_count = len(segments)
+        found = []
+        stack = [(self.root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            found.extend(node.tails)
+            if depth == seg_count:
+                found.extend(node.leaves)
+                continue
+            child = node.children.get(segments[depth])
+            if child is not None:
+                stack.append((child, depth + 1))
+            if node.wildcard is not None:
+                stack.append((node.wildcard, depth + 1))
+        found.sort()
+        routes = self.routes
+        return [routes[i] for i in found]
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __repr__(self):
+        return '<%s routes=%r>' % (self.__class__.__name__, len(self.routes))
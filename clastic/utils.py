@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+from threading import RLock
 
 from werkzeug.utils import redirect
 
@@ -72,3 +73,210 @@ def rel_datetime(d, other=None):
         return '1 hour ago'
     else:
         return '{0} hours ago'.format(s / 3600)
+
+
+_MISSING = object()
+_PREV, _NEXT, _KEY, _VALUE = range(4)  # link field indices
+
+
+class LRU(object):
+    """
+    A bounded, thread-safe mapping which evicts the least recently
+    used key once it holds more than *max_size* items. Lookups via
+    get() and [] are counted in hit_count and miss_count.
+    """
+    def __init__(self, max_size=128):
+        if max_size < 1:
+            raise ValueError('expected max_size >= 1, not %r' % max_size)
+        self.max_size = max_size
+        self.hit_count = self.miss_count = 0
+        self._lock = RLock()
+        self._link_map = {}
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def _unlink(self, link):
+        prev, next_ = link[_PREV], link[_NEXT]
+        prev[_NEXT], next_[_PREV] = next_, prev
+
+    def _link_newest(self, link):
+        root = self._root
+        last = root[_PREV]
+        link[_PREV], link[_NEXT] = last, root
+        last[_NEXT] = root[_PREV] = link
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                link = self._link_map[key]
+            except KeyError:
+                self.miss_count += 1
+                return default
+            self.hit_count += 1
+            self._unlink(link)
+            self._link_newest(link)
+            return link[_VALUE]
+
+    def __getitem__(self, key):
+        ret = self.get(key, _MISSING)
+        if ret is _MISSING:
+            raise KeyError(key)
+        return ret
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            link = self._link_map.get(key)
+            if link is not None:
+                link[_VALUE] = value
+                self._unlink(link)
+            else:
+                link = self._link_map[key] = [None, None, key, value]
+            self._link_newest(link)
+            while len(self._link_map) > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        oldest = self._root[_NEXT]
+        self._unlink(oldest)
+        del self._link_map[oldest[_KEY]]
+        return oldest
+
+    def pop(self, key, default=_MISSING):
+        with self._lock:
+            link = self._link_map.pop(key, None)
+            if link is None:
+                if default is _MISSING:
+                    raise KeyError(key)
+                return default
+            self._unlink(link)
+            return link[_VALUE]
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __contains__(self, key):
+        return key in self._link_map
+
+    def __len__(self):
+        return len(self._link_map)
+
+    def keys(self):
+        "Returns keys from least to most recently used."
+        with self._lock:
+            ret, link = [], self._root[_NEXT]
+            while link is not self._root:
+                ret.append(link[_KEY])
+                link = link[_NEXT]
+            return ret
+
+    def items(self):
+        """
+        Returns (key, value) pairs from least to most recently used,
+        without counting as lookups.
+        """
+        with self._lock:
+            ret, link = [], self._root[_NEXT]
+            while link is not self._root:
+                ret.append((link[_KEY], link[_VALUE]))
+                link = link[_NEXT]
+            return ret
+
+    def clear(self):
+        with self._lock:
+            self._link_map.clear()
+            self._root[:] = [self._root, self._root, None, None]
+
+    def get_stats(self):
+        return {'size': len(self),
+                'max_size': self.max_size,
+                'hit_count': self.hit_count,
+                'miss_count': self.miss_count}
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return '%s(max_size=%r)' % (cn, self.max_size)
+
+
+class SizedLRU(LRU):
+    """
+    An LRU which is also bounded by the total size of its values, as
+    measured by *size_func* (len() by default), evicting the least
+    recently used items while it holds more than *max_bytes*. Values
+    bigger than *max_bytes* on their own are not stored.
+    """
+    def __init__(self, max_bytes, max_size=1024, size_func=len):
+        super(SizedLRU, self).__init__(max_size)
+        if max_bytes < 1:
+            raise ValueError('expected max_bytes >= 1, not %r' % max_bytes)
+        self.max_bytes = max_bytes
+        self.size_func = size_func
+        self.byte_count = 0
+        self._sizes = {}
+
+    def __setitem__(self, key, value):
+        size = self.size_func(value)
+        with self._lock:
+            if size > self.max_bytes:
+                self.pop(key, None)
+                return
+            self.byte_count += size - self._sizes.get(key, 0)
+            self._sizes[key] = size
+            super(SizedLRU, self).__setitem__(key, value)
+            while self.byte_count > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        oldest = super(SizedLRU, self)._evict()
+        self.byte_count -= self._sizes.pop(oldest[_KEY])
+        return oldest
+
+    def pop(self, key, default=_MISSING):
+        with self._lock:
+            ret = super(SizedLRU, self).pop(key, default)
+            self.byte_count -= self._sizes.pop(key, 0)
+            return ret
+
+    def clear(self):
+        with self._lock:
+            super(SizedLRU, self).clear()
+            self._sizes.clear()
+            self.byte_count = 0
+
+    def get_stats(self):
+        ret = super(SizedLRU, self).get_stats()
+        ret['byte_count'] = self.byte_count
+        ret['max_bytes'] = self.max_bytes
+        return ret
+
+    def __repr__(self):
+        cn = self.__class__.__name__
+        return '%s(max_bytes=%r, max_size=%r)' % (cn, self.max_bytes,
+                                                  self.max_size)
+
+
+def get_vary_names(resp):
+    "Returns the header names in *resp*'s Vary header, lowercased."
+    ret = set()
+    for value in resp.headers.getlist('Vary'):
+        ret.update([v.strip().lower() for v in value.split(',')])
+    ret.discard('')
+    return sorted(ret)
+
+
+def get_vary_items(environ, vary_names):
+    """
+    Returns a tuple of (name, value) pairs of the request headers in
+    *environ* named by *vary_names*, for keying caches of responses
+    which vary on them. Missing headers have empty values.
+    """
+    ret = []
+    for name in vary_names:
+        # header names come back unicode, but environ values are
+        # bytes, which may not be ASCII, so the pairs are all bytes
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        env_name = 'HTTP_' + name.upper().replace('-', '_')
+        if name == 'content-type':
+            env_name = 'CONTENT_TYPE'
+        ret.append((name, environ.get(env_name, '')))
+    return tuple(ret)